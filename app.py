@@ -4,118 +4,464 @@
 
     Contains `chalice` app for running an AWS Lambda function responsible for receiving GitHub webhook requests.
 """
-import chalice
+import time
 import typing
 
-from chalicelib import auth, conf, hub, payload, response
+import chalice
+
+from chalicelib import auth, conf, dedup, installations, jobs, journal, metrics, payload, policy, response, safety, \
+    shadow
 
 
 app = chalice.Chalice(app_name=conf.APPLICATION_NAME, debug=conf.DEBUG_MODE)
 
 
+#: Seconds reserved at the end of a scheduled invocation to finish the repositories being swept.
+BACKFILL_TIME_MARGIN = 120
+
+
+#: Name of the SQS queue that the worker function consumes deletion jobs from, if any.
+DELETION_QUEUE_NAME = jobs.queue_name(conf.DELETION_QUEUE)
+
+
+def get_hub(configuration: conf.Configuration):
+    """
+    Import the GitHub API module on first use and apply the configured rate limit settings to it.
+
+    PyGithub dominates the import time of the function, so cold starts that only reject requests or
+    enqueue deletions never import it.
+
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: The :mod:`~lopper.hub` module
+    :rtype: Module
+    """
+    from chalicelib import hub
+
+    hub.governor.configure(configuration.api_requests_per_second, configuration.api_request_burst,
+                           configuration.api_max_retries, configuration.api_max_rate_limit_wait)
+    return hub
+
+
 @app.route('/lopper', methods=['POST'])
 def handler():
-    # Validate the loaded configuration.
-    resp = is_configuration_valid(conf)
-    if not resp:
-        return resp
+    # Retrieve the configuration that is validated once per container.
+    try:
+        configuration = conf.get()
+    except RuntimeError as e:
+        return response.server_error(str(e))
+
+    # Record the duration of every stage and the outcome of the request, if metrics are enabled.
+    collector = metrics.start(configuration.metrics_sink, configuration.metrics_namespace,
+                              dict(Function=configuration.application_name))
+    try:
+        resp = handle_request(app.current_request, configuration, collector)
+    except Exception:
+        collector.finish(500)
+        raise
+    collector.finish(resp.status_code)
+    return resp
+
+
+def handle_request(request, configuration: conf.Configuration, collector):
+    """
+    Run the request through every stage of the webhook pipeline, timing each stage with the given collector.
 
+    :param request: Request object of the webhook delivery
+    :type request: :class:`~chalice.app.Request`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :param collector: Collector of the metrics of the request
+    :type: :class:`~lopper.metrics.Collector`
+    :return: Response object of the first stage that rejected the request or of processing it
+    :rtype: :class:`~lopper.response.Response`
+    """
     # Authorize the request by validating it's signature against our shared secret token.
-    resp = is_request_authentic(app.current_request)
+    with collector.time('Authentication'):
+        route = configuration.secrets.route_for(request.headers.get('X-GitHub-Hook-ID'), request.raw_body)
+        resp = is_request_authentic(request, route.secrets, configuration.webhook_max_payload_size)
     if not resp:
         return resp
 
-    # Example the request payload to determine if it's an event we should process.
-    resp = is_request_acceptable(app.current_request)
+    # Reject events that can't be a closed pull request before paying to decode the request body.
+    with collector.time('Event'):
+        resp = is_event_acceptable(request)
     if not resp:
+        # Pull requests that were opened still keep the index of branches in use current.
+        if resp is payload.NOT_CLOSED and configuration.safety_ttl:
+            with collector.time('Safety'):
+                observe_request(request, route, configuration)
         return resp
 
-    # Process the request with the goal of deleting the head branch of a merged pull request.
-    return process_request(app.current_request)
+    # Decode the request body once and pass it along to the remaining stages.
+    with collector.time('Parse'):
+        body = parse_request(request)
+    if not body:
+        return payload.INVALID_BODY
 
+    # Only trust the decoded event once its owners match the secrets that verified the signature.
+    event = payload.extract(body)
+    if not configuration.secrets.authorizes(route, event):
+        return auth.OWNER_MISMATCH
 
-def is_configuration_valid(configuration) -> response.Response:
-    """
-    Example the loaded configuration in order to determine if it is valid.
+    # Forget the branches of the closed pull request before checking whether its head branch is still in use.
+    if configuration.safety_ttl:
+        safety.get_index(configuration.safety_ttl).observe(body)
 
-    :param configuration: Configuration module to validate
-    :type: Module
-    :return: A response instance indicating the validity of the configuration
-    :rtype: :class:`~lopper.response.Response`
-    """
+    # Example the request payload to determine if it's an event we should process.
+    with collector.time('Acceptance'):
+        rule, resp = is_request_acceptable(event, configuration.policy)
+    if not resp:
+        return resp
+
+    # Answer redelivered and duplicate events without invoking the GitHub API again.
+    with collector.time('Deduplication'):
+        keys = dedup.keys_for(request.headers.get('X-GitHub-Delivery'), event)
+        new = is_request_new(keys, configuration)
+    if not new:
+        return dedup.ALREADY_PROCESSED
+
+    # Process the request with the goal of deleting the head branch of a merged pull request.
     try:
-        configuration.validate()
-        return response.success('Configuration is valid')
-    except RuntimeError as e:
-        return response.server_error(str(e))
+        with collector.time('Processing'):
+            resp = process_request(event, rule, configuration)
+    except BaseException:
+        # Chalice answers 500 for the error, so the redelivery must not be answered as a duplicate.
+        forget_request(keys, configuration)
+        raise
+
+    # Let GitHub redeliver events that failed with a server error.
+    if resp.status_code >= 500:
+        forget_request(keys, configuration)
+    return resp
 
 
-def is_request_authentic(request, secret_token: bytes = conf.WEBHOOK_SECRET_TOKEN):
+def is_request_authentic(request, secrets: typing.Sequence[bytes], max_payload_size: int = None):
     """
     Examine the given request object to determine if it was sent by an authorized source.
 
+    The SHA-256 "X-Hub-Signature-256" header is preferred over the legacy SHA-1 "X-Hub-Signature" header.
+
     :param request: Request object to examine for authenticity
     :type request: :class:`~chalice.app.Request`
-    :param secret_token: Shared secret token used to create payload hash
-    :type: :class:`~bytes`
+    :param secrets: Secret tokens routed to the webhook ID or repository owner of the request, see
+        :meth:`~lopper.auth.SecretRouter.route_for`
+    :type: :class:`~tuple`
+    :param max_payload_size: Maximum number of payload bytes to accept; default: unlimited
+    :type: :class:`~int`
     :return: Response object indicating whether or not the request is authentic
     :rtype: :class:`~lopper.response.Response`
     """
-    signature = request.headers.get('X-Hub-Signature')
+    signature = request.headers.get('X-Hub-Signature-256') or request.headers.get('X-Hub-Signature')
     if not signature:
-        return response.unauthorized('Missing "X-Hub-Signature" header')
+        return auth.MISSING_SIGNATURE
 
-    return auth.is_authentic(signature, request.raw_body, secret_token)
+    return auth.is_authentic(signature, request.raw_body, secrets, max_payload_size)
 
 
-def is_request_acceptable(request,
-                          head_branch: str = conf.HEAD_BRANCH_PATTERN,
-                          base_branch: str = conf.BASE_BRANCH_PATTERN,
-                          repository_owner: str = conf.REPOSITORY_OWNER,
-                          repository_name: str = conf.REPOSITORY_NAME,
-                          head_branch_exclusion: typing.List[str] = conf.HEAD_BRANCH_EXCLUSION):
+def is_event_acceptable(request):
     """
-    Examine the given request object to determine if it's a merged pull request that should be processed.
+    Examine the event type and action of the given request object to determine if it could be a closed
+    pull request without decoding the request body.
 
-    :param request: Request object to examine for authenticity
+    :param request: Request object to examine
     :type request: :class:`~chalice.app.Request`
-    :param head_branch: Regular expression to match head branches to accept
-    :type: :class:`~str`
-    :param base_branch: Regular expression to match base branches to accept
-    :type: :class:`~str`
-    :param repository_owner: Regular expression to match repository owners to accept
-    :type: :class:`~str`
-    :param head_branch_exclusion: List of branch names to not accept
-    :type: :class: `~list`
-    :param repository_name: Regular expression to match repository names to accept
-    :return: Response object indicating whether or not the request should be further processed
+    :return: Response object indicating whether or not the request body should be decoded
     :rtype: :class:`~lopper.response.Response`
     """
-    # Nothing we can do if we received a request w/o a body or it wasn't using 'application/json' content-type.
-    body = request.json_body
-    if not body:
-        return response.unprocessable_entity('Request body is not JSON or empty')
+    event = request.headers.get('X-GitHub-Event')
+    if not event:
+        return payload.MISSING_EVENT
+
+    return payload.is_acceptable_event(event, request.raw_body)
+
+
+def observe_request(request, route: auth.Route, configuration: conf.Configuration) -> None:
+    """
+    Apply a "pull_request" event that opened or changed a pull request to the index of branches in use.
+
+    :param request: Request object of an authentic "pull_request" event
+    :type request: :class:`~chalice.app.Request`
+    :param route: Route of the secrets that verified the signature of the request
+    :type: :class:`~lopper.auth.Route`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: Nothing
+    :rtype: :class:`~NoneType`
+    """
+    if payload.scan_action(request.raw_body) not in safety.OPENING_ACTIONS:
+        return
 
-    return payload.is_acceptable_payload(body, head_branch, base_branch, repository_owner,
-                                         repository_name, head_branch_exclusion)
+    body = parse_request(request)
+    if body and configuration.secrets.authorizes(route, payload.extract(body)):
+        safety.get_index(configuration.safety_ttl).observe(body)
 
 
-def process_request(request, api_access_token: str = conf.API_ACCESS_TOKEN):
+def parse_request(request):
     """
-    Examine the given request to find the merged head branch and invoke the GitHub API to delete it.
+    Decode the JSON body of the given request object.
 
-    :param request: Request object to process deleting the merged head branch of
+    :param request: Request object to decode the body of
     :type request: :class:`~chalice.app.Request`
+    :return: Decoded request body or None if it isn't 'application/json' content or empty
+    :rtype: :class:`~dict`
+    """
+    content_type = request.headers.get('Content-Type', '')
+    if not content_type.startswith('application/json'):
+        return None
+
+    return payload.parse(request.raw_body)
+
+
+def is_request_acceptable(event: payload.MergeEvent, rules: policy.Policy):
+    """
+    Examine the record of the request event to determine if it's a merged pull request that should be processed.
+
+    :param event: Record of the request event to examine, see :func:`~lopper.payload.extract`
+    :type event: :class:`~lopper.payload.MergeEvent`
+    :param rules: Policy of compiled rules of the configuration
+    :type: :class:`~lopper.policy.Policy`
+    :return: Tuple of the rule accepting the event (or None) and the response object indicating whether or not
+        the request should be further processed
+    :rtype: :class:`~tuple`
+    """
+    return payload.match_rule(event, rules)
+
+
+def is_request_new(keys, configuration: conf.Configuration) -> bool:
+    """
+    Record the given event keys to determine if the event is seen for the first time.
+
+    :param keys: Keys of the event, see :func:`~lopper.dedup.keys_for`
+    :type: :class:`~list`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: Boolean indicating if the event should be processed
+    :rtype: :class:`~bool`
+    """
+    if not configuration.dedup_cache_size:
+        return True
+    return dedup.get_deduplicator(configuration.dedup_cache_size, configuration.dedup_ttl,
+                                  configuration.dedup_database).claim(keys)
+
+
+def forget_request(keys, configuration: conf.Configuration) -> None:
+    """
+    Forget the given event keys so a redelivery of the event is processed again.
+
+    :param keys: Keys of the event, see :func:`~lopper.dedup.keys_for`
+    :type: :class:`~list`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: Nothing
+    :rtype: :class:`~NoneType`
+    """
+    if configuration.dedup_cache_size:
+        dedup.get_deduplicator(configuration.dedup_cache_size, configuration.dedup_ttl,
+                               configuration.dedup_database).release(keys)
+
+
+def process_request(event: payload.MergeEvent, rule: policy.FilterSet, configuration: conf.Configuration):
+    """
+    Invoke the GitHub API to delete the merged head branch of the given request event.
+
+    :param event: Record of the accepted request event to process deleting the merged head branch of
+    :type event: :class:`~lopper.payload.MergeEvent`
+    :param rule: Policy rule that accepted the request event
+    :type: :class:`~lopper.policy.FilterSet`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: Response object indicating the success of deleting the merged head branch
+    :rtype: :class:`~lopper.response.Response`
+    """
+    job = jobs.for_event(event, configuration.policy.key(rule))
+
+    # Only record the intended deletion when evaluating the policy in dry run mode.
+    if configuration.dry_run:
+        return shadow.record(job)
+
+    # Hand the deletion off to the queue worker and return immediately when running asynchronously.
+    if configuration.deletion_queue:
+        return enqueue_request(jobs.get_queue(configuration.deletion_queue), job)
+
+    # Record the deletion so it's replayed when it fails or the function dies before it finished.
+    entry_id = journal_request(job, configuration)
+
+    # Use the access token of the rule that accepted the payload or of the GitHub App installation that sent it.
+    tokens = installations.from_configuration(configuration)
+    try:
+        api_access_token = jobs.token_for(job, configuration.policy, configuration.api_access_token, tokens)
+    except RuntimeError as e:
+        return response.server_error(str(e))
+
+    resp = delete_request(api_access_token, configuration, job.repo, job.ref)
+    jobs.release_token(job, resp, tokens)
+    if entry_id:
+        journal.get_journal(configuration.journal).complete(entry_id, resp.status_code)
+    return resp
+
+
+def journal_request(job: jobs.Job, configuration: conf.Configuration):
+    """
+    Record that a job to delete the merged head branch was accepted, if a journal is configured.
+
+    :param job: Accepted job
+    :type: :class:`~lopper.jobs.Job`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: ID of the journal entry of the job or None when deletions are not journaled
+    :rtype: :class:`~str`
+    """
+    if not configuration.journal:
+        return None
+    return journal.get_journal(configuration.journal).accept(job)
+
+
+def delete_request(api_access_token: str, configuration: conf.Configuration, repo: str, ref: str):
+    """
+    Invoke the GitHub API to delete the merged head branch unless it's still in use.
+
     :param api_access_token: Access token for GitHub API client
     :type api_access_token: :class:`~str`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :param repo: GitHub repository that owns the ref
+    :type repo: :class:`~str`
+    :param ref: GitHub branch ref to delete
+    :type ref: :class:`~str`
     :return: Response object indicating the success of deleting the merged head branch
     :rtype: :class:`~lopper.response.Response`
     """
-    # Nothing we can do if we received a request w/o a body or it wasn't using 'application/json' content-type.
-    body = request.json_body
-    if not body:
-        return response.unprocessable_entity('Request body is not JSON or empty')
+    # Answer the delivery right away instead of waiting for rate limits; waiting is left to the queue worker.
+    hub = get_hub(configuration)
+    with hub.without_waiting():
+        # Keep head branches that are protected or still back another open pull request.
+        if configuration.safety_ttl:
+            index = safety.get_index(configuration.safety_ttl)
+            resp = index.check(api_access_token, repo, ref, configuration.api_base_url)
+            if not resp:
+                return resp
+
+        # Grab ref of merged pull request head branch and delete it.
+        return hub.delete_branch(api_access_token, repo, ref, base_url=configuration.api_base_url)
+
+
+def enqueue_request(queue, job: jobs.Job) -> response.Response:
+    """
+    Send a job to delete the merged head branch to the deletion queue.
+
+    :param queue: Queue to send the job to
+    :type queue: :class:`~lopper.jobs.SQSQueue`
+    :param job: Job of the accepted request
+    :type: :class:`~lopper.jobs.Job`
+    :return: Response object indicating the deletion was accepted for processing
+    :rtype: :class:`~lopper.response.Response`
+    """
+    queue.put(job)
+    return response.accepted('Queued deletion of "{}" from repository "{}"'.format(job.ref, job.repo))
+
+
+def process_jobs(batch, configuration: conf.Configuration):
+    """
+    Delete the branches of a batch of queued jobs.
+
+    :param batch: Jobs to process
+    :type batch: :class:`~collections.Iterable`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: Response object of each job in batch order
+    :rtype: :class:`~list`
+    """
+    get_hub(configuration)
+    index = safety.get_index(configuration.safety_ttl) if configuration.safety_ttl else None
+    return jobs.process(batch, configuration.policy, configuration.api_access_token, configuration.api_base_url,
+                        configuration.deletion_max_workers, index, configuration.deletion_mode,
+                        installations.from_configuration(configuration))
+
+
+def drain_queue(queue, configuration: conf.Configuration = None):
+    """
+    Process all jobs of a local (memory or file backed) deletion queue in batches.
+
+    :param queue: Queue to consume jobs from
+    :type queue: :class:`~lopper.jobs.MemoryQueue`
+    :param configuration: Validated configuration snapshot; default: :func:`~lopper.conf.get`
+    :type: :class:`~lopper.conf.Configuration`
+    :return: Response object of each processed job
+    :rtype: :class:`~list`
+    """
+    configuration = configuration or conf.get()
+
+    responses = []
+    batch = queue.get_batch(configuration.deletion_batch_size)
+    while batch:
+        responses.extend(process_jobs(batch, configuration))
+        batch = queue.get_batch(configuration.deletion_batch_size)
+    return responses
+
+
+def process_records(records, configuration: conf.Configuration) -> dict:
+    """
+    Delete the branches of the jobs of a batch of SQS records.
+
+    :param records: SQS records of the batch, each with a job as its body
+    :type records: :class:`~list`
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: Partial batch response with the message IDs of jobs that should be redelivered
+    :rtype: :class:`~dict`
+    """
+    responses = process_jobs([jobs.loads(record.body) for record in records], configuration)
+    return batch_item_failures(records, responses)
+
+
+def batch_item_failures(records, responses: typing.List[response.Response]) -> dict:
+    """
+    Build the partial batch response of an SQS batch that names the messages of the failed jobs.
+
+    :param records: SQS records of the batch
+    :type records: :class:`~list`
+    :param responses: Response object of each job in batch order
+    :type responses: :class:`~list`
+    :return: Partial batch response with the message IDs of jobs that should be redelivered
+    :rtype: :class:`~dict`
+    """
+    failures = [dict(itemIdentifier=record.to_dict()['messageId'])
+                for record, resp in zip(records, responses) if resp.status_code >= 500]
+    if failures:
+        app.log.warning('Failed to process %d of %d deletion jobs', len(failures), len(responses))
+    return dict(batchItemFailures=failures)
+
+
+if DELETION_QUEUE_NAME:
+    @app.on_sqs_message(queue=DELETION_QUEUE_NAME, batch_size=conf.DELETION_BATCH_SIZE)
+    def worker(event):
+        """
+        Process a batch of deletion jobs delivered from the SQS deletion queue.
+
+        Jobs that failed with a server error or were deferred by the rate limit are reported as batch item
+        failures, so SQS only redelivers those. This requires the "ReportBatchItemFailures" function response
+        type on the event source mapping.
+        """
+        return process_records(list(event), conf.get())
+
+
+if conf.BACKFILL_SCHEDULE:
+    @app.schedule(conf.BACKFILL_SCHEDULE)
+    def backfill(event):
+        """
+        Sweep repositories for branches of previously merged pull requests until the invocation runs out of time.
+
+        Repositories not started in time are picked up by the next invocation through the checkpoint.
+        """
+        from chalicelib import sweep
 
-    # Grab ref of merged pull request head branch and delete it.
-    metadata = payload.get_target_branch_metadata(body)
-    return hub.delete_branch(api_access_token, **metadata)
+        configuration = conf.get()
+        get_hub(configuration)
+        remaining = app.lambda_context.get_remaining_time_in_millis() / 1000.0
+        owners = sorted(set(configuration.backfill_owners) | configuration.policy.owners)
+        counts = sweep.sweep(owners, configuration.policy, configuration.api_access_token, configuration.api_base_url,
+                             sweep.Checkpoint(configuration.backfill_checkpoint_file),
+                             configuration.backfill_max_workers, configuration.deletion_max_workers,
+                             time.monotonic() + remaining - BACKFILL_TIME_MARGIN, configuration.deletion_mode)
+        app.log.info('Backfill sweep finished: %s', dict(counts))
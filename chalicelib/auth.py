@@ -4,41 +4,253 @@
 
     Handles authenticating incoming requests.
 """
+import collections
+import functools
 import hashlib
 import hmac
+import typing
 
+from chalicelib import payload as payloads
 from chalicelib import response
 
 
-def is_authentic(payload_signature: str, payload: str, secret_token: bytes) -> response.Response:
+#: Number of payload bytes hashed per update of the signature computation.
+CHUNK_SIZE = 64 * 1024
+
+
+#: Hash functions of the supported signature algorithms, keyed by the prefix of the signature header value.
+ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'sha1': hashlib.sha1
+}
+
+
+#: Response for requests without a signature header.
+MISSING_SIGNATURE = response.fixed('signature_missing',
+                                   'Missing "X-Hub-Signature-256" or "X-Hub-Signature" header', 401)
+
+
+#: Response for payloads whose signature matches one of the secret tokens.
+SIGNATURE_MATCH = response.fixed('signature_match', 'Request signature match')
+
+
+#: Response for signatures of an algorithm other than those in :data:`~lopper.auth.ALGORITHMS`.
+UNSUPPORTED_ALGORITHM = response.fixed('signature_algorithm_unsupported',
+                                       'Request signature algorithm is not supported', 401)
+
+
+#: Response for signatures that are not hex encoded.
+MALFORMED_SIGNATURE = response.fixed('signature_malformed', 'Request signature is malformed', 401)
+
+
+#: Response for payloads whose signature doesn't match any of the secret tokens.
+SIGNATURE_MISMATCH = response.fixed('signature_mismatch', 'Request signature does not match', 401)
+
+
+#: Response for authentic payloads of repository owners that the secret they were signed with isn't routed to.
+OWNER_MISMATCH = response.fixed('signature_owner_mismatch',
+                                'Request signature is not valid for the repository owner of the event', 401)
+
+
+#: Secrets a request could be signed with and the repository owners whose events they may sign; None allows
+#: every owner that has no secrets of its own.
+Route = collections.namedtuple('Route', ['secrets', 'owners'])
+
+
+class SecretRouter:
+    """
+    Active webhook secret tokens routed by webhook ID or repository owner.
+
+    Each route holds the secrets of a webhook in order of preference, so the signature of a request is
+    only checked against the few secrets of its route instead of every configured secret. During a
+    rotation the new secret is listed first and the previous one only costs an extra HMAC for requests
+    still signed with it.
+
+    Routes are picked from the "X-GitHub-Hook-ID" header and a scan of the raw payload, both of which the
+    sender controls, so the owners of the decoded event must be checked with
+    :meth:`~lopper.auth.SecretRouter.authorizes` as well. Secrets of an owner only sign events of that owner
+    and secrets of a webhook only those of the owners listed for it. Default secrets and webhook secrets
+    without owners sign events of every owner that has no secrets of its own.
+    """
+    def __init__(self, default: typing.Sequence[bytes] = (), hooks: typing.Dict[str, typing.Sequence[bytes]] = None,
+                 owners: typing.Dict[str, typing.Sequence[bytes]] = None,
+                 hook_owners: typing.Dict[str, typing.Iterable[str]] = None):
+        self.default = Route(tuple(default), None)
+        self.hooks = {str(hook): Route(tuple(secrets), None) for hook, secrets in (hooks or {}).items()}
+        self.owners = {owner: Route(tuple(secrets), frozenset([owner])) for owner, secrets in (owners or {}).items()}
+        for hook, allowed in (hook_owners or {}).items():
+            self.hooks[str(hook)] = self.hooks[str(hook)]._replace(owners=frozenset(allowed))
+
+    def __bool__(self):
+        return bool(self.default.secrets or self.hooks or self.owners)
+
+    @classmethod
+    def from_document(cls, document: typing.Optional[dict], default: typing.Sequence[bytes] = ()) -> 'SecretRouter':
+        """
+        Create a router from the ``secrets`` section of a policy document.
+
+        The section may contain a list of ``default`` secrets, added after the given ones, and mappings of
+        ``hooks`` (webhook ID) and ``owners`` (repository owner login) to a secret or a list of secrets.
+        A webhook may also be mapped to a mapping of its ``secrets`` and the ``owners`` it delivers events of.
+
+        :param document: The ``secrets`` section of a policy document, if any
+        :type: :class:`~dict`
+        :param default: Secrets used for requests without a route
+        :type: :class:`~collections.Sequence`
+        :return: Router of the configured secrets
+        :rtype: :class:`~lopper.auth.SecretRouter`
+        :raises: :class:`~RuntimeError` when the section is malformed
+        """
+        document = document or {}
+        if not isinstance(document, dict):
+            raise RuntimeError('Policy secrets must be a mapping: {}'.format(type(document).__name__))
+
+        routes, hook_owners = {}, {}
+        for name in ('hooks', 'owners'):
+            section = document.get(name) or {}
+            if not isinstance(section, dict):
+                raise RuntimeError('Policy secrets "{}" must be a mapping'.format(name))
+            routes[name] = {}
+            for key, value in section.items():
+                if name == 'hooks' and isinstance(value, dict):
+                    owners = value.get('owners')
+                    if owners is not None:
+                        if not isinstance(owners, list) or not all(isinstance(owner, str) for owner in owners):
+                            raise RuntimeError('Policy secrets "owners" of webhook {} must be a list'.format(key))
+                        hook_owners[str(key)] = owners
+                    value = value.get('secrets')
+                routes[name][str(key)] = _secrets(value)
+        return cls(tuple(default) + _secrets(document.get('default') or ()), hook_owners=hook_owners, **routes)
+
+    def route_for(self, hook_id: typing.Optional[str], payload: bytes) -> Route:
+        """
+        Retrieve the route of the secrets a request could be signed with.
+
+        The repository owner is only scanned from the raw payload when owner routes are configured.
+
+        :param hook_id: Webhook ID from the "X-GitHub-Hook-ID" header
+        :type: :class:`~str`
+        :param payload: Raw request payload
+        :type: :class:`~bytes`
+        :return: Route of the secrets in order of preference
+        :rtype: :class:`~lopper.auth.Route`
+        """
+        if hook_id and self.hooks:
+            route = self.hooks.get(hook_id)
+            if route:
+                return route
+        if self.owners:
+            route = self.owners.get(payloads.scan_repository_owner(payload))
+            if route:
+                return route
+        return self.default
+
+    def authorizes(self, route: Route, event: payloads.MergeEvent) -> bool:
+        """
+        Determine if the secrets of the route that authenticated a request may sign the decoded event.
+
+        The owner of the repository, the owner part of its full name and of the full name of the head
+        repository are checked, so a payload can't name one owner for routing and another for processing.
+
+        :param route: Route that authenticated the request, see :meth:`~lopper.auth.SecretRouter.route_for`
+        :type: :class:`~lopper.auth.Route`
+        :param event: Record of the decoded request event, see :func:`~lopper.payload.extract`
+        :type: :class:`~lopper.payload.MergeEvent`
+        :return: Boolean indicating if the route covers the owner of every repository of the event
+        :rtype: :class:`~bool`
+        """
+        owners = {event.owner}
+        owners.update(repo.split('/', 1)[0] for repo in (event.repo, event.head_repo) if repo)
+        owners.discard(None)
+        if route.owners is not None:
+            return all(owner in route.owners for owner in owners)
+        return not any(owner in self.owners for owner in owners)
+
+
+def _secrets(value: typing.Union[str, typing.Sequence[str]]) -> typing.Tuple[bytes, ...]:
+    """
+    Encode a secret or list of secrets of a policy document.
+    """
+    values = [value] if isinstance(value, str) else value
+    if not isinstance(values, (list, tuple)) or not all(isinstance(secret, str) and secret for secret in values):
+        raise RuntimeError('Policy secrets must be non-empty strings or lists of them')
+    return tuple(secret.encode() for secret in values)
+
+
+def is_authentic(payload_signature: str, payload: bytes,
+                 secret_tokens: typing.Union[bytes, typing.Sequence[bytes]],
+                 max_payload_size: int = None) -> response.Response:
     """
     Perform signature comparison to determine if the given data payload is authentic.
 
+    The signature is either a "sha256=<hex>" value of the "X-Hub-Signature-256" header or a "sha1=<hex>"
+    value of the legacy "X-Hub-Signature" header. Payloads larger than the maximum size are rejected
+    before they are hashed.
+
     :param payload_signature: Signature sent with payload to validate
     :type: :class:`~str`
     :param payload: Request payload
-    :type: :class:`~str`
-    :param secret_token: Shared secret token used to create payload hash
     :type: :class:`~bytes`
+    :param secret_tokens: Shared secret token, or active secret tokens in order of preference, used to
+        create payload hash
+    :type: :class:`~bytes` or :class:`~collections.Sequence`
+    :param max_payload_size: Maximum number of payload bytes to accept; default: unlimited
+    :type: :class:`~int`
     :return: Response object indicating if the payload is authentic
     :rtype: :class:`~lopper.response.Response`
     """
-    match = hmac.compare_digest(payload_signature, _signature(payload, secret_token))
+    if max_payload_size is not None and len(payload) > max_payload_size:
+        return response.payload_too_large('Request payload exceeds {} bytes'.format(max_payload_size))
+
+    algorithm, _, signature = payload_signature.partition('=')
+    if algorithm not in ALGORITHMS:
+        return UNSUPPORTED_ALGORITHM
+    try:
+        expected = bytes.fromhex(signature)
+    except ValueError:
+        return MALFORMED_SIGNATURE
+
+    if isinstance(secret_tokens, bytes):
+        secret_tokens = (secret_tokens,)
+    match = any(hmac.compare_digest(expected, _digest(payload, secret_token, algorithm))
+                for secret_token in secret_tokens)
     if not match:
-        return response.unauthorized('Request signature does not match')
-    return response.success('Request signature match')
+        return SIGNATURE_MISMATCH
+    return SIGNATURE_MATCH
+
+
+@functools.lru_cache(maxsize=None)
+def _keyed(secret_token: bytes, algorithm: str) -> hmac.HMAC:
+    """
+    Retrieve the HMAC state keyed with the secret token, computed once per secret and algorithm.
+
+    The returned state must not be updated; :meth:`~hmac.HMAC.copy` it instead.
+    """
+    return hmac.new(secret_token, digestmod=ALGORITHMS[algorithm])
 
 
-def _signature(payload: str, secret_token: bytes) -> str:
+def _digest(payload: bytes, secret_token: bytes, algorithm: str) -> bytes:
     """
-    Compute a SHA-1 signature for the given data payload based on our shared secret.
+    Compute the HMAC digest of the payload incrementally over chunks of it without copying them.
+    """
+    mac = _keyed(secret_token, algorithm).copy()
+    view = memoryview(payload)
+    for offset in range(0, len(view), CHUNK_SIZE):
+        mac.update(view[offset:offset + CHUNK_SIZE])
+    return mac.digest()
+
+
+def _signature(payload: bytes, secret_token: bytes, algorithm: str = 'sha1') -> str:
+    """
+    Compute a signature for the given data payload based on our shared secret.
 
     :param payload: Request payload
-    :type: :class:`~str`
+    :type: :class:`~bytes`
     :param secret_token: Shared secret token used to create payload hash
     :type: :class:`~bytes`
+    :param algorithm: Signature algorithm, one of :data:`~lopper.auth.ALGORITHMS`; default: "sha1"
+    :type: :class:`~str`
     :return: Computed signature string for the payload
     :rtype: :class:`~str`
     """
-    digest = hmac.new(secret_token, payload, hashlib.sha1).hexdigest()
-    return 'sha1={}'.format(digest)
+    return '{}={}'.format(algorithm, _digest(payload, secret_token, algorithm).hex())
@@ -0,0 +1,130 @@
+"""
+    lopper/batch
+    ~~~~~~~~~~~~
+
+    Contains functionality for coalescing branch deletions of the same repository into batches.
+"""
+import concurrent.futures
+import threading
+import typing
+
+from chalicelib import response
+
+
+#: Default number of seconds deletions of a repository are collected before they are sent together.
+DEFAULT_WINDOW = 0.5
+
+
+#: Default maximum number of deletions of a repository sent together.
+DEFAULT_MAX_SIZE = 50
+
+
+#: Callable that deletes the given (repo, ref) branches with an access token and returns a response per branch.
+Deleter = typing.Callable[[str, typing.List[typing.Tuple[str, str]]], typing.List[response.Response]]
+
+
+class Coalescer:
+    """
+    Micro-batcher that groups branch deletions by access token and repository.
+
+    The first deletion of a repository opens a batch that is sent once the window elapsed or it reached the
+    maximum size, whatever comes first, so a burst of merges in one repository, e.g. from a merge train,
+    costs one batched deletion instead of one per branch. A window of zero sends every deletion right away.
+    Batches are sent on the given executor, or on the thread that completed them when there is none.
+    """
+    def __init__(self, delete: Deleter, window: float = DEFAULT_WINDOW, max_size: int = DEFAULT_MAX_SIZE,
+                 executor: concurrent.futures.Executor = None):
+        self.delete = delete
+        self.window = window
+        self.max_size = max_size
+        self.executor = executor
+        self._pending = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(group) for group in self._pending.values())
+
+    def submit(self, api_access_token: str, repo: str, ref: str) -> concurrent.futures.Future:
+        """
+        Add a branch deletion to the open batch of its repository.
+
+        :param api_access_token: Access token for GitHub API client
+        :type api_access_token: :class:`~str`
+        :param repo: GitHub repository that owns the ref
+        :type repo: :class:`~str`
+        :param ref: GitHub branch ref to delete
+        :type ref: :class:`~str`
+        :return: Future of the response object of the deletion
+        :rtype: :class:`~concurrent.futures.Future`
+        """
+        key = (api_access_token, repo)
+        future = concurrent.futures.Future()
+        with self._lock:
+            group = self._pending.setdefault(key, [])
+            group.append((ref, future))
+            if len(group) >= self.max_size or self.window <= 0:
+                group = self._pop(key)
+            else:
+                if len(group) == 1:
+                    timer = self._timers[key] = threading.Timer(self.window, self._expire, (key,))
+                    timer.daemon = True
+                    timer.start()
+                group = None
+
+        if group:
+            self._send(key, group)
+        return future
+
+    def flush(self) -> None:
+        """
+        Send all open batches right away.
+
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            groups = [(key, self._pop(key)) for key in list(self._pending)]
+        for key, group in groups:
+            self._send(key, group)
+
+    def _expire(self, key: typing.Tuple[str, str]) -> None:
+        """
+        Send the batch of the key once its window elapsed, unless it was already sent.
+        """
+        with self._lock:
+            group = self._pop(key)
+        if group:
+            self._send(key, group)
+
+    def _pop(self, key: typing.Tuple[str, str]) -> typing.Optional[list]:
+        """
+        Remove the open batch of the key and cancel its timer.
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        return self._pending.pop(key, None)
+
+    def _send(self, key: typing.Tuple[str, str], group: list) -> None:
+        """
+        Send a batch on the executor, if any.
+        """
+        if self.executor is None:
+            return self._delete(key, group)
+        self.executor.submit(self._delete, key, group)
+
+    def _delete(self, key: typing.Tuple[str, str], group: list) -> None:
+        """
+        Delete the branches of a batch and resolve the future of every deletion with its response.
+        """
+        api_access_token, repo = key
+        try:
+            responses = self.delete(api_access_token, [(repo, ref) for ref, _ in group])
+        except Exception as e:
+            for _, future in group:
+                future.set_exception(e)
+            return
+        for (_, future), resp in zip(group, responses):
+            future.set_result(resp)
@@ -4,7 +4,12 @@
 
     Contains access to configuration values.
 """
+import collections
 import os
+import threading
+import urllib.parse
+
+from chalicelib import auth, jobs, journal, metrics, policy
 
 
 #: Environment variable to configure the application name.
@@ -15,6 +20,11 @@ APPLICATION_NAME = os.environ.get('LOPPER_APPLICATION_NAME', 'lopper')
 DEBUG_MODE = 'LOPPER_DEBUG_MODE' in os.environ
 
 
+#: Environment variable to configure dry run (shadow) mode; accepted deletions are only logged and counted in the
+#: metrics instead of invoking the GitHub API.
+DRY_RUN = 'LOPPER_DRY_RUN' in os.environ
+
+
 #: Environment variable to configure the base (target) branch of a pull request merge to consider for closing.
 BASE_BRANCH_PATTERN = os.environ.get('GITHUB_BASE_BRANCH_PATTERN', '^master$')
 
@@ -40,17 +50,203 @@ REPOSITORY_NAME = os.environ.get('GITHUB_REPOSITORY_NAME_PATTERN', '\w+')
 API_ACCESS_TOKEN = os.environ.get('GITHUB_API_ACCESS_TOKEN')
 
 
+#: Environment variable to configure the ID of the GitHub App to authenticate as; deliveries of its installations
+#: are processed with the access token of the installation that sent them. Zero disables GitHub App authentication.
+APP_ID = int(os.environ.get('GITHUB_APP_ID', '0'))
+
+
+#: Environment variable to configure the PEM encoded private key of the GitHub App.
+APP_PRIVATE_KEY = os.environ.get('GITHUB_APP_PRIVATE_KEY', '')
+
+
+#: Environment variable to configure the path of a file with the PEM encoded private key of the GitHub App, used
+#: when the key is not configured directly.
+APP_PRIVATE_KEY_FILE = os.environ.get('GITHUB_APP_PRIVATE_KEY_FILE')
+
+
+#: Environment variable to configure the base URL of the Github API, e.g. for GitHub Enterprise installations.
+API_BASE_URL = os.environ.get('GITHUB_API_BASE_URL', 'https://api.github.com')
+
+
+#: Environment variable to configure the number of GitHub API requests per second sent with a single access
+#: token; zero disables pacing.
+API_REQUESTS_PER_SECOND = float(os.environ.get('LOPPER_API_REQUESTS_PER_SECOND', '10'))
+
+
+#: Environment variable to configure the number of GitHub API requests sent back to back before pacing kicks in.
+API_REQUEST_BURST = int(os.environ.get('LOPPER_API_REQUEST_BURST', '20'))
+
+
+#: Environment variable to configure the number of times a GitHub API request is retried after a transient
+#: server error or a rate limit response.
+API_MAX_RETRIES = int(os.environ.get('LOPPER_API_MAX_RETRIES', '3'))
+
+
+#: Environment variable to configure the maximum number of seconds to wait for an exhausted GitHub API rate
+#: limit to reset; requests that would wait longer are deferred.
+API_MAX_RATE_LIMIT_WAIT = float(os.environ.get('LOPPER_API_MAX_RATE_LIMIT_WAIT', '60'))
+
+
+#: Environment variable to configure the queue that branch deletions are sent to instead of being processed
+#: during the webhook request; one of "sqs://<queue-name>", "file://<path>" or "memory://".
+DELETION_QUEUE = os.environ.get('LOPPER_DELETION_QUEUE')
+
+
+#: Environment variable to configure the maximum number of queued deletions processed per worker invocation.
+DELETION_BATCH_SIZE = int(os.environ.get('LOPPER_DELETION_BATCH_SIZE', '10'))
+
+
+#: Environment variable to configure the maximum number of concurrent branch deletions of a batch.
+DELETION_MAX_WORKERS = int(os.environ.get('LOPPER_DELETION_MAX_WORKERS', '4'))
+
+
+#: Environment variable to configure how queue workers and backfill sweeps delete branches; "rest" for one request
+#: per branch or "graphql" for two batched requests per batch of branches.
+DELETION_MODE = os.environ.get('LOPPER_DELETION_MODE', 'rest')
+
+
+#: Environment variable to configure the maximum number of accepted deletions the long-lived server keeps queued;
+#: webhooks arriving while the queue is full are answered with "503 Service Unavailable" for GitHub to redeliver.
+SERVER_QUEUE_SIZE = int(os.environ.get('LOPPER_SERVER_QUEUE_SIZE', '1000'))
+
+
+#: Environment variable to configure the number of seconds the long-lived server collects deletions of the same
+#: repository before sending them together; zero sends every deletion right away.
+COALESCE_WINDOW = float(os.environ.get('LOPPER_COALESCE_WINDOW', '0'))
+
+
+#: Environment variable to configure the maximum number of deletions of the same repository sent together.
+COALESCE_MAX_SIZE = int(os.environ.get('LOPPER_COALESCE_MAX_SIZE', '50'))
+
+
+#: Environment variable to configure the journal that accepted branch deletions and their outcomes are recorded
+#: in, so failed and unfinished ones can be replayed; one of "file://<path>", "sqlite://<path>" or "memory://".
+#: When not set, deletions are not journaled.
+JOURNAL = os.environ.get('LOPPER_JOURNAL')
+
+
+#: Environment variable to configure the list of organizations or users whose repositories are swept for
+#: branches of previously merged pull requests, in addition to the exact owners of policy rules.
+BACKFILL_OWNERS = [owner for owner in os.environ.get('LOPPER_BACKFILL_OWNERS', '').split(',') if owner]
+
+
+#: Environment variable to configure the schedule expression, e.g. "rate(1 day)", of the backfill sweep.
+#: When not set, the sweep is only available from the command line.
+BACKFILL_SCHEDULE = os.environ.get('LOPPER_BACKFILL_SCHEDULE')
+
+
+#: Environment variable to configure the path of the file that backfill sweep progress is stored in.
+BACKFILL_CHECKPOINT_FILE = os.environ.get('LOPPER_BACKFILL_CHECKPOINT_FILE')
+
+
+#: Environment variable to configure the maximum number of repositories swept concurrently.
+BACKFILL_MAX_WORKERS = int(os.environ.get('LOPPER_BACKFILL_MAX_WORKERS', '4'))
+
+
+#: Environment variable to configure the number of processed webhook events remembered in memory to answer
+#: redeliveries and duplicates without invoking the GitHub API; zero disables deduplication.
+DEDUP_CACHE_SIZE = int(os.environ.get('LOPPER_DEDUP_CACHE_SIZE', '1024'))
+
+
+#: Environment variable to configure the number of seconds a processed webhook event is remembered.
+DEDUP_TTL = float(os.environ.get('LOPPER_DEDUP_TTL', '86400'))
+
+
+#: Environment variable to configure the path of a SQLite database that processed webhook events are
+#: additionally remembered in, so they survive cold starts.
+DEDUP_DATABASE = os.environ.get('LOPPER_DEDUP_DATABASE')
+
+
+#: Environment variable to configure the number of seconds the protected branches and open pull requests of a
+#: repository are trusted before they are loaded again; branches they use are not deleted. Zero disables the check.
+SAFETY_TTL = float(os.environ.get('LOPPER_SAFETY_TTL', '0'))
+
+
+#: Environment variable to configure the sink that per-request stage timings and GitHub API call metrics are
+#: emitted to; "emf" for CloudWatch embedded metric format log lines or "memory". When not set, metrics are disabled.
+METRICS_SINK = os.environ.get('LOPPER_METRICS_SINK')
+
+
+#: Environment variable to configure the CloudWatch namespace of emitted metrics.
+METRICS_NAMESPACE = os.environ.get('LOPPER_METRICS_NAMESPACE', 'Lopper')
+
+
 #: Environment variable to configure the Github Webhook Secret Token used to authenticate all incoming
 #: webhook HTTP request payloads.
 WEBHOOK_SECRET_TOKEN = os.environ.get('GITHUB_WEBHOOK_SECRET_TOKEN', '').encode()
 
 
-def validate() -> None:
+#: Environment variable to configure the previous Github Webhook Secret Token that is still accepted while
+#: webhooks are rotated to the current one.
+WEBHOOK_PREVIOUS_SECRET_TOKEN = os.environ.get('GITHUB_WEBHOOK_PREVIOUS_SECRET_TOKEN', '').encode()
+
+
+#: Environment variable to configure the maximum size in bytes of webhook request payloads; larger payloads
+#: are rejected before their signature is computed. GitHub caps payloads at 25 MB.
+WEBHOOK_MAX_PAYLOAD_SIZE = int(os.environ.get('LOPPER_WEBHOOK_MAX_PAYLOAD_SIZE', str(25 * 1024 * 1024)))
+
+
+#: Environment variable to configure the path of a JSON/YAML policy file with rules for multiple repositories
+#: and, optionally, webhook secrets per webhook ID or repository owner. When not set, a single rule built from
+#: the pattern environment variables above is used.
+POLICY_FILE = os.environ.get('LOPPER_POLICY_FILE')
+
+
+#: Immutable snapshot of the validated configuration, including the values derived from it such as the compiled
+#: default filters, the policy and the router of webhook secrets.
+Configuration = collections.namedtuple('Configuration', [
+    'application_name', 'dry_run', 'api_access_token', 'app_id', 'app_private_key', 'api_base_url',
+    'api_requests_per_second', 'api_request_burst', 'api_max_retries', 'api_max_rate_limit_wait', 'deletion_queue',
+    'deletion_batch_size', 'deletion_max_workers', 'deletion_mode', 'server_queue_size', 'coalesce_window',
+    'coalesce_max_size', 'journal', 'backfill_owners', 'backfill_checkpoint_file', 'backfill_max_workers',
+    'dedup_cache_size', 'dedup_ttl', 'dedup_database', 'safety_ttl', 'metrics_sink', 'metrics_namespace',
+    'webhook_max_payload_size', 'filters', 'policy', 'secrets'
+])
+
+
+#: Configuration snapshot of the process, built by :func:`~lopper.conf.get` on first use.
+_snapshot = None
+
+
+#: Lock guarding building the configuration snapshot.
+_snapshot_lock = threading.Lock()
+
+
+def get() -> Configuration:
+    """
+    Retrieve the configuration snapshot, validating and building it once per process.
+
+    :return: Validated configuration
+    :rtype: :class:`~lopper.conf.Configuration`
+    :raises: :class:`~RuntimeError` when any configuration values are invalid
+    """
+    snapshot = _snapshot
+    if snapshot is not None:
+        return snapshot
+    return reload()
+
+
+def reload() -> Configuration:
+    """
+    Validate the current configuration values and replace the configuration snapshot with them.
+
+    :return: Validated configuration
+    :rtype: :class:`~lopper.conf.Configuration`
+    :raises: :class:`~RuntimeError` when any configuration values are invalid
+    """
+    global _snapshot
+
+    with _snapshot_lock:
+        _snapshot = validate()
+        return _snapshot
+
+
+def validate() -> Configuration:
     """
     Perform late bound configuration validation to allow for patching after import.
 
-    :return: Nothing
-    :rtype: :class:`~NoneType`
+    :return: Validated configuration; it's not stored as the snapshot, see :func:`~lopper.conf.reload`
+    :rtype: :class:`~lopper.conf.Configuration`
     :raises: :class:`~RuntimeError` when any configuration values are invalid
     """
     if not APPLICATION_NAME:
@@ -63,7 +259,98 @@ def validate() -> None:
         raise RuntimeError('Must supply a regex pattern for matching repository owners')
     if not REPOSITORY_NAME:
         raise RuntimeError('Must supply a regex pattern for matching repository name')
-    if not API_ACCESS_TOKEN:
-        raise RuntimeError('Must supply a Github API access token')
-    if not WEBHOOK_SECRET_TOKEN:
+    if not API_BASE_URL:
+        raise RuntimeError('Must supply a Github API base URL')
+    if WEBHOOK_MAX_PAYLOAD_SIZE < 1:
+        raise RuntimeError('Must supply a positive maximum webhook payload size')
+    if API_REQUESTS_PER_SECOND < 0:
+        raise RuntimeError('Must supply a non-negative number of API requests per second')
+    if API_REQUEST_BURST < 1:
+        raise RuntimeError('Must supply a positive API request burst')
+    if API_MAX_RETRIES < 0:
+        raise RuntimeError('Must supply a non-negative number of API retries')
+    if METRICS_SINK and METRICS_SINK not in metrics.SINKS:
+        raise RuntimeError('Must supply one of {} as metrics sink'.format(', '.join(sorted(metrics.SINKS))))
+    if DEDUP_CACHE_SIZE < 0:
+        raise RuntimeError('Must supply a non-negative deduplication cache size')
+    if SAFETY_TTL < 0:
+        raise RuntimeError('Must supply a non-negative safety index TTL')
+    if DELETION_BATCH_SIZE < 1:
+        raise RuntimeError('Must supply a positive deletion batch size')
+    if DELETION_MAX_WORKERS < 1:
+        raise RuntimeError('Must supply a positive number of deletion workers')
+    if SERVER_QUEUE_SIZE < 1:
+        raise RuntimeError('Must supply a positive server queue size')
+    if COALESCE_WINDOW < 0:
+        raise RuntimeError('Must supply a non-negative coalesce window')
+    if COALESCE_MAX_SIZE < 1:
+        raise RuntimeError('Must supply a positive coalesce maximum size')
+    if DELETION_MODE not in jobs.DELETION_MODES:
+        raise RuntimeError('Must supply one of {} as deletion mode'.format(', '.join(jobs.DELETION_MODES)))
+    if JOURNAL and urllib.parse.urlparse(JOURNAL).scheme not in journal.SCHEMES:
+        raise RuntimeError('Must supply a journal URL with one of {} as scheme'.format(', '.join(journal.SCHEMES)))
+    if BACKFILL_MAX_WORKERS < 1:
+        raise RuntimeError('Must supply a positive number of backfill workers')
+
+    app_private_key = APP_PRIVATE_KEY
+    if not app_private_key and APP_PRIVATE_KEY_FILE:
+        try:
+            with open(APP_PRIVATE_KEY_FILE) as f:
+                app_private_key = f.read()
+        except OSError as e:
+            raise RuntimeError('Unable to load GitHub App private key file "{}": {}'.format(APP_PRIVATE_KEY_FILE, e))
+    if APP_ID < 0:
+        raise RuntimeError('Must supply a non-negative GitHub App ID')
+    if bool(APP_ID) != bool(app_private_key):
+        raise RuntimeError('Must supply both the ID and the private key of the GitHub App')
+
+    filters = policy.compile_filters(HEAD_BRANCH_PATTERN, BASE_BRANCH_PATTERN, REPOSITORY_OWNER, REPOSITORY_NAME,
+                                     tuple(HEAD_BRANCH_EXCLUSION))
+    document = policy.load_document(POLICY_FILE) if POLICY_FILE else None
+    rules = policy.from_document(document, filters, POLICY_FILE) if POLICY_FILE else policy.Policy.from_filters(filters)
+
+    section = document.get('secrets') if isinstance(document, dict) else None
+    default_secrets = tuple(token for token in (WEBHOOK_SECRET_TOKEN, WEBHOOK_PREVIOUS_SECRET_TOKEN) if token)
+    secrets = auth.SecretRouter.from_document(section, default_secrets)
+
+    if not secrets:
         raise RuntimeError('Must supply a Github secret token to validate webhook requests')
+    if not API_ACCESS_TOKEN and not APP_ID and rules.requires_default_token:
+        raise RuntimeError('Must supply a Github API access token')
+    if not API_ACCESS_TOKEN and BACKFILL_SCHEDULE:
+        raise RuntimeError('Must supply a Github API access token for backfill sweeps, GitHub App installation '
+                           'tokens are only used for webhook deliveries')
+
+    return Configuration(
+        application_name=APPLICATION_NAME,
+        dry_run=DRY_RUN,
+        api_access_token=API_ACCESS_TOKEN,
+        app_id=APP_ID,
+        app_private_key=app_private_key,
+        api_base_url=API_BASE_URL,
+        api_requests_per_second=API_REQUESTS_PER_SECOND,
+        api_request_burst=API_REQUEST_BURST,
+        api_max_retries=API_MAX_RETRIES,
+        api_max_rate_limit_wait=API_MAX_RATE_LIMIT_WAIT,
+        deletion_queue=DELETION_QUEUE,
+        deletion_batch_size=DELETION_BATCH_SIZE,
+        deletion_max_workers=DELETION_MAX_WORKERS,
+        deletion_mode=DELETION_MODE,
+        server_queue_size=SERVER_QUEUE_SIZE,
+        coalesce_window=COALESCE_WINDOW,
+        coalesce_max_size=COALESCE_MAX_SIZE,
+        journal=JOURNAL,
+        backfill_owners=tuple(BACKFILL_OWNERS),
+        backfill_checkpoint_file=BACKFILL_CHECKPOINT_FILE,
+        backfill_max_workers=BACKFILL_MAX_WORKERS,
+        dedup_cache_size=DEDUP_CACHE_SIZE,
+        dedup_ttl=DEDUP_TTL,
+        dedup_database=DEDUP_DATABASE,
+        safety_ttl=SAFETY_TTL,
+        metrics_sink=METRICS_SINK,
+        metrics_namespace=METRICS_NAMESPACE,
+        webhook_max_payload_size=WEBHOOK_MAX_PAYLOAD_SIZE,
+        filters=filters,
+        policy=rules,
+        secrets=secrets
+    )
@@ -0,0 +1,187 @@
+"""
+    lopper/dedup
+    ~~~~~~~~~~~~
+
+    Contains functionality for recognizing redelivered and duplicate webhook events.
+"""
+import collections
+import functools
+import threading
+import time
+import typing
+
+from chalicelib import payload, response
+
+
+#: Default number of keys kept in the in-process cache.
+DEFAULT_CACHE_SIZE = 1024
+
+
+#: Default number of seconds a processed event is remembered.
+DEFAULT_TTL = 86400
+
+
+#: Response for redelivered and duplicate events.
+ALREADY_PROCESSED = response.fixed('event_duplicate', 'Event was already processed')
+
+
+def keys_for(delivery: typing.Optional[str], event: payload.MergeEvent) -> typing.List[str]:
+    """
+    Build the keys that identify an accepted event: its delivery and the merge it reports.
+
+    The delivery key catches redeliveries of the same webhook, the merge key catches separate
+    deliveries of a duplicate "closed" event of the same merge.
+
+    :param delivery: GitHub delivery ID from the "X-GitHub-Delivery" header
+    :type: :class:`~str`
+    :param event: Record of an accepted merged pull request event
+    :type: :class:`~lopper.payload.MergeEvent`
+    :return: List of keys
+    :rtype: :class:`~list`
+    """
+    keys = ['merge:{}:{}:{}'.format(event.head_repo, event.head_ref, event.merge_commit_sha)]
+    if delivery:
+        keys.append('delivery:{}'.format(delivery))
+    return keys
+
+
+class SQLiteBackend:
+    """
+    Persistent store of processed event keys in a local SQLite database shared by all processes on a host.
+    """
+    def __init__(self, path: str):
+        import sqlite3
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS events (key TEXT PRIMARY KEY, expires_at REAL)')
+
+    def claim(self, keys: typing.Sequence[str], now: float, expires_at: float) -> bool:
+        """
+        Record the keys unless any of them is already recorded and has not expired.
+
+        :param keys: Keys of the event
+        :type: :class:`~collections.Sequence`
+        :param now: Current time as seconds since the epoch
+        :type: :class:`~float`
+        :param expires_at: Time as seconds since the epoch after which the keys are forgotten
+        :type: :class:`~float`
+        :return: Boolean indicating if the keys were recorded
+        :rtype: :class:`~bool`
+        """
+        placeholders = ','.join('?' * len(keys))
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute('SELECT 1 FROM events WHERE key IN ({}) AND expires_at > ? LIMIT 1'.format(placeholders),
+                               (*keys, now))
+                new = cursor.fetchone() is None
+                if new:
+                    cursor.executemany('INSERT OR REPLACE INTO events (key, expires_at) VALUES (?, ?)',
+                                       [(key, expires_at) for key in keys])
+                    cursor.execute('DELETE FROM events WHERE expires_at <= ?', (now,))
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            return new
+
+    def release(self, keys: typing.Sequence[str]) -> None:
+        """
+        Forget the keys, e.g. when processing the event failed and a redelivery should be processed.
+
+        :param keys: Keys of the event
+        :type: :class:`~collections.Sequence`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            self._connection.executemany('DELETE FROM events WHERE key = ?', [(key,) for key in keys])
+
+
+class Deduplicator:
+    """
+    Bounded in-process LRU cache of processed event keys that expire after a TTL, optionally backed by a
+    persistent store so warm and cold instances share what was processed.
+
+    The in-process cache answers repeats without touching the backend.
+    """
+    def __init__(self, size: int = DEFAULT_CACHE_SIZE, ttl: float = DEFAULT_TTL, backend: SQLiteBackend = None):
+        self.size = size
+        self.ttl = ttl
+        self.backend = backend
+        self._expires_at = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expires_at)
+
+    def claim(self, keys: typing.Sequence[str]) -> bool:
+        """
+        Record the keys of an event unless it was already processed.
+
+        :param keys: Keys of the event, see :func:`~lopper.dedup.keys_for`
+        :type: :class:`~collections.Sequence`
+        :return: Boolean indicating if the event is new and should be processed
+        :rtype: :class:`~bool`
+        """
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            if any(self._contains(key, now) for key in keys):
+                return False
+
+            new = self.backend is None or self.backend.claim(keys, now, expires_at)
+            for key in keys:
+                self._expires_at[key] = expires_at
+                self._expires_at.move_to_end(key)
+            while len(self._expires_at) > self.size:
+                self._expires_at.popitem(last=False)
+            return new
+
+    def release(self, keys: typing.Sequence[str]) -> None:
+        """
+        Forget the keys of an event so a redelivery of it is processed again.
+
+        :param keys: Keys of the event, see :func:`~lopper.dedup.keys_for`
+        :type: :class:`~collections.Sequence`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            for key in keys:
+                self._expires_at.pop(key, None)
+        if self.backend is not None:
+            self.backend.release(keys)
+
+    def _contains(self, key: str, now: float) -> bool:
+        """
+        Determine if the key is cached and has not expired, dropping it when it has.
+        """
+        expires_at = self._expires_at.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= now:
+            del self._expires_at[key]
+            return False
+        self._expires_at.move_to_end(key)
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def get_deduplicator(size: int = DEFAULT_CACHE_SIZE, ttl: float = DEFAULT_TTL, path: str = None) -> Deduplicator:
+    """
+    Retrieve the deduplicator for the given settings, creating it once per process.
+
+    :param size: Maximum number of keys kept in the in-process cache
+    :type: :class:`~int`
+    :param ttl: Number of seconds a processed event is remembered
+    :type: :class:`~float`
+    :param path: Path of the SQLite database to persist keys in; default: in-process cache only
+    :type: :class:`~str`
+    :return: Deduplicator instance
+    :rtype: :class:`~lopper.dedup.Deduplicator`
+    """
+    return Deduplicator(size, ttl, SQLiteBackend(path) if path else None)
@@ -4,43 +4,855 @@
 
     Contains functionality for interacting with the GitHub API.
 """
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import random
+import re
+import threading
+import time
+import typing
+import urllib.parse
+
 import github
+import requests
+
+from chalicelib import metrics, response
+
+
+#: Default base URL of the GitHub API.
+DEFAULT_BASE_URL = 'https://api.github.com'
+
+
+#: Maximum number of API clients to keep alive in the registry.
+CLIENT_REGISTRY_SIZE = 8
+
+
+#: Maximum number of keep-alive connections kept in the pool of each API host.
+CONNECTION_POOL_SIZE = 10
+
+
+#: Default maximum number of concurrent requests used by :func:`~lopper.hub.delete_branches`. GitHub
+#: recommends avoiding concurrent requests for a single token, so this is deliberately small.
+DEFAULT_MAX_WORKERS = 4
+
+
+#: Default number of requests per second sent with a single access token; bursts are allowed up to
+#: :data:`~lopper.hub.DEFAULT_REQUEST_BURST`. A value of zero disables pacing.
+DEFAULT_REQUESTS_PER_SECOND = 10.0
+
+
+#: Default maximum number of requests sent back to back with a single access token before pacing kicks in.
+DEFAULT_REQUEST_BURST = 20
+
+
+#: Default number of times a request is retried after a transient server error or a rate limit response.
+DEFAULT_RETRIES = 3
+
+
+#: Default maximum number of seconds a request waits for a rate limit to reset before it is deferred.
+DEFAULT_MAX_RATE_LIMIT_WAIT = 60.0
+
+
+#: Seconds to back off before retrying a request that failed with a transient server error; doubled
+#: for every retry and jittered.
+RETRY_BACKOFF = 1.0
+
+
+#: Seconds to pause all requests of an access token after hitting the secondary rate limit without
+#: a "Retry-After" header; doubled for every retry and jittered.
+SECONDARY_RATE_LIMIT_BACKOFF = 60.0
+
+
+#: Phrases of GitHub error messages that indicate the secondary rate limit was hit.
+SECONDARY_RATE_LIMIT_MESSAGES = ('secondary rate limit', 'abuse detection')
+
+
+#: Number of items requested per page of paginated API listings.
+PAGE_SIZE = 100
+
+
+#: Deletion mode that deletes every branch with its own REST request.
+REST = 'rest'
+
+
+#: Deletion mode that looks up and deletes many branches with two aliased GraphQL requests.
+GRAPHQL = 'graphql'
+
+
+#: Maximum number of branches looked up and deleted per GraphQL request.
+GRAPHQL_BATCH_SIZE = 50
 
-from chalicelib import response
+
+#: Regular expression to find the URL of the next page in a "Link" response header.
+NEXT_LINK_PATTERN = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+
+#: Errors of requests that never got a response, re-raised by the governor once its retries are exhausted.
+CONNECTION_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+
+#: Registry of API clients keyed by (access token, base url) that survives across warm invocations.
+_clients = collections.OrderedDict()
+
+
+#: Keep-alive HTTP sessions keyed by (protocol, host, port) shared by all API clients.
+_sessions = {}
+
+
+#: Lock guarding access to the client and session registries.
+_clients_lock = threading.Lock()
+
+
+#: Whether requests of the current context answer a webhook delivery and must not wait, see
+#: :func:`~lopper.hub.without_waiting`.
+_without_waiting = contextvars.ContextVar('lopper.hub.without_waiting', default=False)
+
+
+class PooledConnection:
+    """
+    HTTP connection compatible with :class:`~github.Requester.Requester` that sends all requests
+    through a shared :class:`~requests.Session` per API host so connections are kept alive and pooled.
+    """
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None, protocol='https', **kwargs):
+        self.host = host
+        self.port = port or (443 if protocol == 'https' else 80)
+        self.protocol = protocol
+        self.timeout = timeout
+        self.verify = kwargs.get('verify', True)
+        self.session = _get_session(protocol, self.host, self.port, retry)
+        self.args = None
+
+    def request(self, verb, url, input, headers):
+        self.args = (verb, url, input, headers)
+
+    def getresponse(self):
+        verb, url, input, headers = self.args
+
+        def send():
+            return self.session.request(verb, '{}://{}:{}{}'.format(self.protocol, self.host, self.port, url),
+                                        headers=headers, data=input, timeout=self.timeout, verify=self.verify,
+                                        allow_redirects=False)
+
+        started = time.perf_counter()
+        resp = governor.send((self.host, headers.get('Authorization')), send)
+        metrics.active().api_call(time.perf_counter() - started, resp.status_code)
+        return github.Requester.RequestsResponse(resp)
+
+    def close(self):
+        return
+
+
+class PooledHTTPConnection(PooledConnection):
+    """
+    Plain HTTP variant of :class:`~lopper.hub.PooledConnection`, e.g. for GitHub Enterprise or local stand-ins.
+    """
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None, **kwargs):
+        super().__init__(host, port, strict, timeout, retry, protocol='http', **kwargs)
+
+
+github.Requester.Requester.injectConnectionClasses(PooledHTTPConnection, PooledConnection)
+
+
+class RateLimitDeferred(github.GithubException):
+    """
+    Raised instead of sending a request when the rate limit of its access token resets too far in the future.
+
+    It is converted to a '503 Service Unavailable' response so queued deletions are retried later.
+    """
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(503, dict(message='Rate limit exceeded, retry after {:.0f} seconds'.format(retry_after)))
+
+
+class RateLimitGovernor:
+    """
+    Paces and retries the requests of all API clients based on the rate limits reported by GitHub.
+
+    Requests are paced per access token with a token bucket. The "X-RateLimit-Remaining", "X-RateLimit-Reset"
+    and "Retry-After" headers of every response are tracked, so once a limit is exhausted all requests of
+    that token wait for it to reset instead of failing. Transient server errors and secondary rate limits
+    are retried with jittered exponential backoff. Requests that would have to wait longer than ``max_wait``
+    are deferred by raising :class:`~lopper.hub.RateLimitDeferred`.
+
+    Within :func:`~lopper.hub.without_waiting` requests are neither paced, retried nor held back; any
+    request that would have to wait is deferred right away.
+    """
+    def __init__(self, rate: float = DEFAULT_REQUESTS_PER_SECOND, burst: int = DEFAULT_REQUEST_BURST,
+                 retries: int = DEFAULT_RETRIES, max_wait: float = DEFAULT_MAX_RATE_LIMIT_WAIT):
+        self.configure(rate, burst, retries, max_wait)
+        self._buckets = {}
+        self._blocked_until = {}
+        self._lock = threading.Lock()
+
+    def configure(self, rate: float, burst: int, retries: int, max_wait: float) -> None:
+        """
+        Change the settings of the governor while keeping the state of all access tokens.
+
+        :param rate: Number of requests per second sent with a single access token; zero disables pacing
+        :type rate: :class:`~float`
+        :param burst: Maximum number of requests sent back to back with a single access token
+        :type burst: :class:`~int`
+        :param retries: Number of times a request is retried
+        :type retries: :class:`~int`
+        :param max_wait: Maximum number of seconds to wait for a rate limit to reset
+        :type max_wait: :class:`~float`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.retries = retries
+        self.max_wait = max_wait
+
+    def reset(self) -> None:
+        """
+        Forget the pacing and rate limit state of all access tokens.
+
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            self._buckets.clear()
+            self._blocked_until.clear()
+
+    def send(self, key: typing.Hashable, request: typing.Callable[[], requests.Response]) -> requests.Response:
+        """
+        Send a request once the rate limits of the given key allow it, retrying transient failures.
+
+        :param key: Identity of the rate limit the request counts against, e.g. its access token
+        :type key: :class:`~collections.Hashable`
+        :param request: Function that sends the request and returns its response
+        :type request: :class:`~collections.Callable`
+        :return: Response of the last attempt
+        :rtype: :class:`~requests.Response`
+        :raises: :class:`~lopper.hub.RateLimitDeferred` when the rate limit is still exhausted
+        """
+        retries = 0 if _without_waiting.get() else self.retries
+        attempt = 0
+        while True:
+            self.acquire(key)
+            try:
+                resp = request()
+            except CONNECTION_ERRORS:
+                if attempt >= retries:
+                    raise
+                time.sleep(_jitter(RETRY_BACKOFF, attempt))
+                attempt += 1
+                continue
+
+            rate_limited = self.observe(key, resp, attempt)
+            if attempt >= retries:
+                if rate_limited:
+                    raise RateLimitDeferred(max(self._blocked_until.get(key, 0) - time.time(), 0))
+                return resp
+            if not rate_limited and resp.status_code < 500:
+                return resp
+            if not rate_limited:
+                time.sleep(_jitter(RETRY_BACKOFF, attempt))
+            attempt += 1
+
+    def acquire(self, key: typing.Hashable) -> None:
+        """
+        Block until a request may be sent for the given key.
+
+        :param key: Identity of the rate limit the request counts against
+        :type key: :class:`~collections.Hashable`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        :raises: :class:`~lopper.hub.RateLimitDeferred` when the rate limit resets after the maximum wait
+        """
+        immediate = _without_waiting.get()
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = self._blocked_until.get(key, 0) - now
+                if wait > (0 if immediate else self.max_wait):
+                    raise RateLimitDeferred(wait)
+                if wait <= 0:
+                    if not self.rate:
+                        return
+                    tokens, updated = self._buckets.get(key, (self.burst, now))
+                    tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                    if tokens >= 1:
+                        self._buckets[key] = (tokens - 1, now)
+                        return
+                    self._buckets[key] = (tokens, now)
+                    wait = (1 - tokens) / self.rate
+            if immediate:
+                raise RateLimitDeferred(wait)
+            time.sleep(wait)
+
+    def observe(self, key: typing.Hashable, resp: requests.Response, attempt: int = 0) -> bool:
+        """
+        Track the rate limit headers of a response and determine if it was rejected by a rate limit.
+
+        :param key: Identity of the rate limit the request counted against
+        :type key: :class:`~collections.Hashable`
+        :param resp: Response to examine
+        :type resp: :class:`~requests.Response`
+        :param attempt: Number of previous attempts of the request
+        :type attempt: :class:`~int`
+        :return: Boolean indicating if the request was rejected by a rate limit and should be retried
+        :rtype: :class:`~bool`
+        """
+        headers = resp.headers
+        now = time.time()
+        retry_after = _number(headers.get('Retry-After'))
+        exhausted = headers.get('X-RateLimit-Remaining') == '0'
+        reset = _number(headers.get('X-RateLimit-Reset'))
+
+        resume_at = None
+        if retry_after is not None:
+            resume_at = now + retry_after
+        elif exhausted and reset is not None:
+            resume_at = reset
+
+        rate_limited = resp.status_code in (403, 429) and (resume_at is not None or _is_secondary_rate_limit(resp))
+        if rate_limited and resume_at is None:
+            resume_at = now + _jitter(SECONDARY_RATE_LIMIT_BACKOFF, attempt)
+
+        if resume_at is not None:
+            with self._lock:
+                self._blocked_until[key] = max(self._blocked_until.get(key, 0), resume_at)
+        return rate_limited
+
+
+#: Rate limit governor that paces and retries the requests of all pooled connections.
+governor = RateLimitGovernor()
+
+
+@contextlib.contextmanager
+def without_waiting() -> typing.Iterator[None]:
+    """
+    Context manager for requests sent while answering a webhook delivery, which GitHub times out after ten
+    seconds. Requests sent within it are not retried and are deferred with a '503 Service Unavailable' response
+    instead of waiting for pacing, backoff or a rate limit reset, so the deletion is retried by the journal
+    or a redelivery instead of blocking the function.
+
+    :return: Nothing
+    :rtype: :class:`~NoneType`
+    """
+    token = _without_waiting.set(True)
+    try:
+        yield
+    finally:
+        _without_waiting.reset(token)
+
+
+def _jitter(backoff: float, attempt: int) -> float:
+    """
+    Compute a random backoff between half and all of the exponential backoff of the given attempt.
+    """
+    delay = backoff * 2 ** attempt
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _number(value: typing.Optional[str]) -> typing.Optional[float]:
+    """
+    Parse a numeric header value, ignoring missing and malformed values.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_secondary_rate_limit(resp: requests.Response) -> bool:
+    """
+    Determine if the error message of the response indicates the secondary rate limit was hit.
+    """
+    message = resp.text.lower()
+    return any(phrase in message for phrase in SECONDARY_RATE_LIMIT_MESSAGES)
+
+
+def _get_session(protocol: str, host: str, port: int, retry=None) -> requests.Session:
+    """
+    Retrieve the keep-alive HTTP session for the given API host, creating it if necessary.
+
+    :param protocol: URL scheme of the API host
+    :type protocol: :class:`~str`
+    :param host: Hostname of the API host
+    :type host: :class:`~str`
+    :param port: Port of the API host
+    :type port: :class:`~int`
+    :param retry: Retry configuration passed through by the API client
+    :type retry: :class:`~int` or :class:`~urllib3.util.retry.Retry`
+    :return: HTTP session with a pool of keep-alive connections to the host
+    :rtype: :class:`~requests.Session`
+    """
+    key = (protocol, host, port)
+    with _clients_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=CONNECTION_POOL_SIZE,
+                                                    max_retries=retry or 0)
+            session.mount('{}://'.format(protocol), adapter)
+        return session
+
+
+def get_client(api_access_token: str, base_url: str = DEFAULT_BASE_URL) -> github.Github:
+    """
+    Retrieve the pooled API client for the given access token, creating it if necessary.
+
+    Clients are kept in a bounded registry so warm invocations reuse their keep-alive connections.
+    Once a token rotates, the client of the previous token ages out of the registry.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: API client authenticated with the access token
+    :rtype: :class:`~github.Github`
+    """
+    key = (api_access_token, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+
+        client = _clients[key] = github.Github(api_access_token, base_url=base_url)
+        while len(_clients) > CLIENT_REGISTRY_SIZE:
+            _clients.popitem(last=False)
+        return client
+
+
+def invalidate_client(api_access_token: str, base_url: str = DEFAULT_BASE_URL) -> None:
+    """
+    Remove the API client for the given access token from the registry, e.g. after it was revoked.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: Nothing
+    :rtype: :class:`~NoneType`
+    """
+    with _clients_lock:
+        _clients.pop((api_access_token, base_url), None)
+
+
+def reset_clients() -> None:
+    """
+    Remove all API clients and their keep-alive connections from the registry and forget tracked rate limits.
+
+    :return: Nothing
+    :rtype: :class:`~NoneType`
+    """
+    with _clients_lock:
+        _clients.clear()
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+    governor.reset()
 
 
 def exception_to_response(func):
     """
     Decorator that catches :class:`~github.GithubException` and converts them to
     :class:`~lopper.response.Response` instances.
+
+    Clients whose access token was rejected are removed from the registry so a rotated token
+    does not keep reusing them. Connection errors and timeouts that outlasted the retries are
+    converted to '503 Service Unavailable' responses, like :class:`~lopper.hub.RateLimitDeferred`,
+    so the deletion is retried later.
     """
     def decorator(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except github.GithubException as e:
+            if isinstance(e, github.BadCredentialsException) and args:
+                invalidate_client(args[0], kwargs.get('base_url', DEFAULT_BASE_URL))
             partial = response.partial_for_status(e.status)
             return partial(str(e))
+        except CONNECTION_ERRORS as e:
+            return unreachable(e)
     return decorator
 
 
+def unreachable(error: Exception) -> response.Response:
+    """
+    Convert a connection error or timeout of a request to the GitHub API to a :class:`~lopper.response.Response`.
+
+    :param error: Error raised by :mod:`~requests`, see :data:`~lopper.hub.CONNECTION_ERRORS`
+    :type: :class:`~Exception`
+    :return: Response object indicating the API can't be reached right now
+    :rtype: :class:`~lopper.response.Response`
+    """
+    return response.service_unavailable('Unable to reach the GitHub API: {}'.format(error))
+
+
 @exception_to_response
-def delete_branch(api_access_token: str, repo: str, ref: str) -> response.Response:
+def delete_branch(api_access_token: str, repo: str, ref: str, base_url: str = DEFAULT_BASE_URL) -> response.Response:
     """
     Delete the remote branch on the given repo at the given ref.
 
+    The ref is deleted with a single ``DELETE /repos/{repo}/git/refs/heads/{ref}`` request instead of
+    looking up the repository and ref first.
+
     :param api_access_token: Access token for GitHub API client
     :type api_access_token: :class:`~str`
     :param repo: GitHub repository that owns the ref
     :type repo: :class:`~str`
     :param ref: GitHub branch ref to delete
     :type ref: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
     :return: Response object indicating result of branch deletion
     :rtype: :class:`~lopper.response.Response`
     """
-    api = github.Github(api_access_token)
+    return _delete_ref(get_client(api_access_token, base_url), repo, ref)
+
+
+def delete_branches(api_access_token: str, branches: typing.Iterable[typing.Tuple[str, str]],
+                    max_workers: int = DEFAULT_MAX_WORKERS, base_url: str = DEFAULT_BASE_URL,
+                    mode: str = REST) -> typing.List[response.Response]:
+    """
+    Delete many remote branches concurrently using one pooled API client.
 
-    repository = api.get_repo(repo)
-    repository_ref = repository.get_git_ref('heads/{}'.format(ref))
+    Requests of all workers are paced and retried by the rate limit :data:`~lopper.hub.governor`, so
+    hitting a rate limit pauses every worker using the access token. In :data:`~lopper.hub.GRAPHQL`
+    mode the branches are deleted by :func:`~lopper.hub.delete_branches_graphql` instead.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param branches: Pairs of GitHub repository and branch ref to delete
+    :type branches: :class:`~collections.Iterable`
+    :param max_workers: Maximum number of concurrent deletions
+    :type max_workers: :class:`~int`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :param mode: Deletion mode, :data:`~lopper.hub.REST` or :data:`~lopper.hub.GRAPHQL`
+    :type mode: :class:`~str`
+    :return: Response object indicating result of each branch deletion, in the order given
+    :rtype: :class:`~list`
+    """
+    if mode == GRAPHQL:
+        return delete_branches_graphql(api_access_token, branches, base_url)
+
+    branches = list(branches)
+
+    def delete(branch):
+        repo, ref = branch
+        return delete_branch(api_access_token, repo, ref, base_url=base_url)
+
+    if max_workers <= 1 or len(branches) <= 1:
+        return [delete(branch) for branch in branches]
+
+    # Run every deletion in a copy of the caller's context so its API calls are recorded by the active metrics.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(branches))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, delete, branch) for branch in branches]
+        return [future.result() for future in futures]
+
+
+def _delete_ref(api: github.Github, repo: str, ref: str) -> response.Response:
+    """
+    Delete the remote branch with a single request using the given API client.
+    """
+    repository = api.get_repo(repo, lazy=True)
+    url = '{}/git/refs/heads/{}'.format(repository.url, urllib.parse.quote(ref))
+    repository_ref = github.GitRef.GitRef(repository._requester, {}, dict(url=url), completed=True)
     repository_ref.delete()
 
     return response.success('Successfully deleted "{}" from repository "{}"'.format(ref, repo))
+
+
+def delete_branches_graphql(api_access_token: str, branches: typing.Iterable[typing.Tuple[str, str]],
+                            base_url: str = DEFAULT_BASE_URL) -> typing.List[response.Response]:
+    """
+    Delete many remote branches with batched GraphQL requests.
+
+    For every :data:`~lopper.hub.GRAPHQL_BATCH_SIZE` branches one aliased query resolves the IDs of their
+    refs and one aliased mutation runs a ``deleteRef`` for each ref that exists, so a batch costs two
+    requests against the GraphQL point budget instead of one REST request per branch.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param branches: Pairs of GitHub repository and branch ref to delete
+    :type branches: :class:`~collections.Iterable`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: Response object indicating result of each branch deletion, in the order given
+    :rtype: :class:`~list`
+    """
+    branches = list(branches)
+    responses = []
+    for start in range(0, len(branches), GRAPHQL_BATCH_SIZE):
+        responses.extend(_delete_refs_graphql(api_access_token, branches[start:start + GRAPHQL_BATCH_SIZE], base_url))
+    return responses
+
+
+def graphql_url(base_url: str = DEFAULT_BASE_URL) -> str:
+    """
+    Build the URL of the GraphQL endpoint that belongs to the given REST API base URL.
+
+    GitHub serves it at "/graphql" and GitHub Enterprise at "/api/graphql" next to the "/api/v3" REST API.
+
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: URL of the GraphQL endpoint
+    :rtype: :class:`~str`
+    """
+    url = urllib.parse.urlparse(base_url)
+    path = url.path.rstrip('/')
+    if path.endswith('/v3'):
+        path = path[:-len('/v3')]
+    return urllib.parse.urlunparse(url._replace(path='{}/graphql'.format(path)))
+
+
+def _delete_refs_graphql(api_access_token: str, branches: typing.List[typing.Tuple[str, str]],
+                         base_url: str) -> typing.List[response.Response]:
+    """
+    Delete a single batch of remote branches with one lookup query and one deletion mutation.
+    """
+    requester = _requester(get_client(api_access_token, base_url))
+    url = graphql_url(base_url)
+    responses = [None] * len(branches)
+
+    try:
+        data, errors = _graphql(requester, url, *_ref_lookup(branches))
+        ids = {}
+        for index, (repo, ref) in enumerate(branches):
+            alias = 'r{}'.format(index)
+            node = (data.get(alias) or {}).get('ref')
+            if alias in errors:
+                responses[index] = _graphql_error_response(errors[alias])
+            elif not node:
+                responses[index] = response.unprocessable_entity(
+                    'Reference "{}" does not exist in repository "{}"'.format(ref, repo))
+            else:
+                ids[index] = node['id']
+
+        if ids:
+            data, errors = _graphql(requester, url, *_ref_deletion(ids))
+            for index in ids:
+                alias = 'd{}'.format(index)
+                repo, ref = branches[index]
+                if alias in errors:
+                    responses[index] = _graphql_error_response(errors[alias])
+                else:
+                    responses[index] = response.success(
+                        'Successfully deleted "{}" from repository "{}"'.format(ref, repo))
+    except github.GithubException as e:
+        if isinstance(e, github.BadCredentialsException):
+            invalidate_client(api_access_token, base_url)
+        partial = response.partial_for_status(e.status)
+        return [resp or partial(str(e)) for resp in responses]
+    except CONNECTION_ERRORS as e:
+        return [resp or unreachable(e) for resp in responses]
+
+    return responses
+
+
+def _ref_lookup(branches: typing.List[typing.Tuple[str, str]]) -> typing.Tuple[str, dict]:
+    """
+    Build the aliased GraphQL query and its variables that resolve the ref IDs of the given branches.
+    """
+    parameters, fields, variables = [], [], {}
+    for index, (repo, ref) in enumerate(branches):
+        owner, _, name = repo.partition('/')
+        variables.update({'o{}'.format(index): owner, 'n{}'.format(index): name,
+                          'q{}'.format(index): 'refs/heads/{}'.format(ref)})
+        parameters.append('$o{0}:String!,$n{0}:String!,$q{0}:String!'.format(index))
+        fields.append('r{0}:repository(owner:$o{0},name:$n{0}){{ref(qualifiedName:$q{0}){{id}}}}'.format(index))
+    return 'query({}){{{}}}'.format(','.join(parameters), ' '.join(fields)), variables
+
+
+def _ref_deletion(ids: typing.Dict[int, str]) -> typing.Tuple[str, dict]:
+    """
+    Build the aliased GraphQL mutation and its variables that delete the refs with the given IDs.
+    """
+    parameters, fields, variables = [], [], {}
+    for index, ref_id in ids.items():
+        variables['i{}'.format(index)] = ref_id
+        parameters.append('$i{}:ID!'.format(index))
+        fields.append('d{0}:deleteRef(input:{{refId:$i{0}}}){{clientMutationId}}'.format(index))
+    return 'mutation({}){{{}}}'.format(','.join(parameters), ' '.join(fields)), variables
+
+
+def _graphql(requester: github.Requester.Requester, url: str, query: str,
+             variables: dict) -> typing.Tuple[dict, typing.Dict[str, dict]]:
+    """
+    Send a GraphQL request and split its result into the data and the errors keyed by top-level alias.
+
+    :raises: :class:`~github.GithubException` when the request failed or has errors not tied to an alias
+    """
+    _, output = requester.requestJsonAndCheck('POST', url, input=dict(query=query, variables=variables))
+    output = output or {}
+
+    errors = {}
+    for error in output.get('errors') or ():
+        path = error.get('path') or ()
+        if not path:
+            status = 503 if error.get('type') == 'RATE_LIMITED' else 500
+            raise github.GithubException(status, output)
+        errors.setdefault(path[0], error)
+    return output.get('data') or {}, errors
+
+
+def _graphql_error_response(error: dict) -> response.Response:
+    """
+    Convert the GraphQL error of a single alias to a :class:`~lopper.response.Response`.
+    """
+    message = error.get('message', 'GraphQL request failed')
+    if error.get('type') == 'NOT_FOUND':
+        return response.not_found(message)
+    return response.unprocessable_entity(message)
+
+
+def iter_items(api_access_token: str, url: str, parameters: dict = None,
+               base_url: str = DEFAULT_BASE_URL) -> typing.Iterator[dict]:
+    """
+    Stream the raw items of a paginated API listing, fetching one page at a time.
+
+    Unlike :class:`~github.PaginatedList.PaginatedList`, pages are not retained once consumed.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param url: URL of the listing, relative to the base URL
+    :type url: :class:`~str`
+    :param parameters: Query parameters of the first page
+    :type parameters: :class:`~dict`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: Iterator of raw items
+    :rtype: :class:`~collections.Iterator`
+    :raises: :class:`~github.GithubException` when a page can't be fetched
+    """
+    requester = _requester(get_client(api_access_token, base_url))
+    parameters = dict(parameters or {}, per_page=PAGE_SIZE)
+
+    while url:
+        headers, items = requester.requestJsonAndCheck('GET', url, parameters=parameters)
+        yield from items or ()
+
+        match = NEXT_LINK_PATTERN.search(headers.get('link', ''))
+        url, parameters = (match.group(1), None) if match and items else (None, None)
+
+
+def iter_repositories(api_access_token: str, owner: str,
+                      base_url: str = DEFAULT_BASE_URL) -> typing.Iterator[dict]:
+    """
+    Stream the raw repositories of the given organization or user.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param owner: Login of the organization or user
+    :type owner: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: Iterator of raw repositories
+    :rtype: :class:`~collections.Iterator`
+    """
+    owner = urllib.parse.quote(owner)
+    try:
+        yield from iter_items(api_access_token, '/orgs/{}/repos'.format(owner), dict(type='all'), base_url)
+    except github.UnknownObjectException:
+        yield from iter_items(api_access_token, '/users/{}/repos'.format(owner), dict(type='owner'), base_url)
+
+
+def iter_branches(api_access_token: str, repo: str, base_url: str = DEFAULT_BASE_URL) -> typing.Iterator[str]:
+    """
+    Stream the names of all branches of the given repository.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param repo: GitHub repository to list the branches of
+    :type repo: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: Iterator of branch names
+    :rtype: :class:`~collections.Iterator`
+    """
+    for branch in iter_items(api_access_token, '/repos/{}/branches'.format(repo), base_url=base_url):
+        yield branch['name']
+
+
+def iter_protected_branches(api_access_token: str, repo: str,
+                            base_url: str = DEFAULT_BASE_URL) -> typing.Iterator[str]:
+    """
+    Stream the names of the protected branches of the given repository.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param repo: GitHub repository to list the protected branches of
+    :type repo: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: Iterator of branch names
+    :rtype: :class:`~collections.Iterator`
+    """
+    parameters = dict(protected='true')
+    for branch in iter_items(api_access_token, '/repos/{}/branches'.format(repo), parameters, base_url):
+        yield branch['name']
+
+
+def iter_open_pull_requests(api_access_token: str, repo: str,
+                            base_url: str = DEFAULT_BASE_URL) -> typing.Iterator[dict]:
+    """
+    Stream the raw open pull requests of the given repository.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param repo: GitHub repository to list the pull requests of
+    :type repo: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: Iterator of raw pull requests
+    :rtype: :class:`~collections.Iterator`
+    """
+    yield from iter_items(api_access_token, '/repos/{}/pulls'.format(repo), dict(state='open'), base_url)
+
+
+def iter_closed_pull_requests(api_access_token: str, repo: str,
+                              base_url: str = DEFAULT_BASE_URL) -> typing.Iterator[dict]:
+    """
+    Stream the raw closed pull requests of the given repository, most recently updated first.
+
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param repo: GitHub repository to list the pull requests of
+    :type repo: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :return: Iterator of raw pull requests
+    :rtype: :class:`~collections.Iterator`
+    """
+    parameters = dict(state='closed', sort='updated', direction='desc')
+    yield from iter_items(api_access_token, '/repos/{}/pulls'.format(repo), parameters, base_url)
+
+
+def create_installation_token(app_jwt: str, installation_id: int, base_url: str = DEFAULT_BASE_URL,
+                              timeout: int = None) -> dict:
+    """
+    Create an access token of an installation of a GitHub App.
+
+    The request is sent through the pooled connections and the rate limit governor like every other
+    request, so it is neither retried nor held back while answering a webhook delivery.
+
+    :param app_jwt: JWT signed with the private key of the GitHub App
+    :type app_jwt: :class:`~str`
+    :param installation_id: ID of the installation of the GitHub App
+    :type installation_id: :class:`~int`
+    :param base_url: Base URL of the GitHub API
+    :type base_url: :class:`~str`
+    :param timeout: Number of seconds to wait for the response; default: PyGithub's default
+    :type timeout: :class:`~int`
+    :return: Raw installation authorization with the ``token`` and its ``expires_at`` timestamp
+    :rtype: :class:`~dict`
+    :raises: :class:`~github.GithubException` when the access token can't be created
+    """
+    kwargs = dict(timeout=timeout) if timeout else {}
+    requester = _requester(github.Github(jwt=app_jwt, base_url=base_url, **kwargs))
+    _, data = requester.requestJsonAndCheck('POST', '/app/installations/{}/access_tokens'.format(installation_id))
+    return data
+
+
+def _requester(api: github.Github) -> github.Requester.Requester:
+    """
+    Retrieve the requester of the API client. PyGithub does not expose it publicly.
+    """
+    return api._Github__requester
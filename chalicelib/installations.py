@@ -0,0 +1,150 @@
+"""
+    lopper/installations
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Contains functionality for authenticating as the installations of a GitHub App.
+"""
+import calendar
+import functools
+import threading
+import time
+import typing
+
+
+#: Default number of seconds before it expires that an installation access token is replaced by a new one.
+DEFAULT_REFRESH_MARGIN = 300
+
+
+#: Number of seconds to wait for GitHub to create an installation access token, well within the 10 seconds
+#: GitHub waits for the answer to a webhook delivery.
+EXCHANGE_TIMEOUT = 5
+
+
+#: Callable that exchanges an installation ID for an access token and its expiry in seconds since the epoch.
+Exchange = typing.Callable[[int], typing.Tuple[str, float]]
+
+
+def exchange(app_id: int, private_key: str, base_url: str, installation_id: int) -> typing.Tuple[str, float]:
+    """
+    Exchange a JWT signed with the private key of the GitHub App for an access token of one of its installations.
+
+    PyGithub and the "cryptography" package needed to sign the JWT are imported on first use. The ID is passed
+    as a string since PyJWT rejects non-string issuers. The token is created with
+    :func:`~lopper.hub.create_installation_token`, so the request shares the pooled connections and rate limit
+    governor of the other API requests and gives up after :data:`~lopper.installations.EXCHANGE_TIMEOUT`.
+
+    :param app_id: ID of the GitHub App
+    :type: :class:`~int`
+    :param private_key: PEM encoded private key of the GitHub App
+    :type: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type: :class:`~str`
+    :param installation_id: ID of the installation of the GitHub App
+    :type: :class:`~int`
+    :return: Tuple of the access token and the time as seconds since the epoch it expires at
+    :rtype: :class:`~tuple`
+    :raises: :class:`~RuntimeError` when the access token can't be created
+    """
+    import jwt
+    import requests
+
+    from chalicelib import hub
+
+    try:
+        app_jwt = hub.github.GithubIntegration(str(app_id), private_key, base_url=base_url).create_jwt()
+        authorization = hub.create_installation_token(app_jwt, installation_id, base_url, EXCHANGE_TIMEOUT)
+        expires_at = calendar.timegm(time.strptime(authorization['expires_at'], '%Y-%m-%dT%H:%M:%SZ'))
+    except (hub.github.GithubException, jwt.PyJWTError, requests.RequestException, KeyError, ValueError) as e:
+        raise RuntimeError('Unable to create access token for installation {}: {}'.format(installation_id, e))
+    return authorization['token'], expires_at
+
+
+class InstallationTokens:
+    """
+    Cache of the access tokens of the installations of a GitHub App.
+
+    Every installation has its own rate limit budget, so a token is created per installation and reused until
+    shortly before it expires. Concurrent requests for the token of the same installation wait for a single
+    exchange.
+    """
+    def __init__(self, exchange: Exchange, refresh_margin: float = DEFAULT_REFRESH_MARGIN):
+        self.exchange = exchange
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def token(self, installation_id: int) -> str:
+        """
+        Retrieve the cached access token of the installation, creating a new one when it is about to expire.
+
+        :param installation_id: ID of the installation of the GitHub App
+        :type: :class:`~int`
+        :return: Access token for GitHub API client
+        :rtype: :class:`~str`
+        :raises: :class:`~RuntimeError` when the access token can't be created
+        """
+        token = self._fresh(installation_id)
+        if token is not None:
+            return token
+
+        with self._lock:
+            lock = self._locks.setdefault(installation_id, threading.Lock())
+        with lock:
+            token = self._fresh(installation_id)
+            if token is None:
+                token, expires_at = self.exchange(installation_id)
+                self._tokens[installation_id] = (token, expires_at)
+            return token
+
+    def invalidate(self, installation_id: int) -> None:
+        """
+        Forget the access token of the installation, e.g. after it was revoked.
+
+        :param installation_id: ID of the installation of the GitHub App
+        :type: :class:`~int`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        self._tokens.pop(installation_id, None)
+
+    def _fresh(self, installation_id: int) -> typing.Optional[str]:
+        """
+        Retrieve the cached access token of the installation unless it is about to expire.
+        """
+        token, expires_at = self._tokens.get(installation_id, (None, 0))
+        return token if expires_at - self.refresh_margin > time.time() else None
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokens(app_id: int, private_key: str, base_url: str) -> InstallationTokens:
+    """
+    Retrieve the cache of installation access tokens of the GitHub App, creating it once per process.
+
+    :param app_id: ID of the GitHub App
+    :type: :class:`~int`
+    :param private_key: PEM encoded private key of the GitHub App
+    :type: :class:`~str`
+    :param base_url: Base URL of the GitHub API
+    :type: :class:`~str`
+    :return: Cache of installation access tokens
+    :rtype: :class:`~lopper.installations.InstallationTokens`
+    """
+    return InstallationTokens(functools.partial(exchange, app_id, private_key, base_url))
+
+
+def from_configuration(configuration) -> typing.Optional[InstallationTokens]:
+    """
+    Retrieve the cache of installation access tokens when the configuration authenticates as a GitHub App.
+
+    :param configuration: Validated configuration snapshot
+    :type: :class:`~lopper.conf.Configuration`
+    :return: Cache of installation access tokens or None when not authenticating as a GitHub App
+    :rtype: :class:`~lopper.installations.InstallationTokens`
+    """
+    if not configuration.app_id:
+        return None
+    return get_tokens(configuration.app_id, configuration.app_private_key, configuration.api_base_url)
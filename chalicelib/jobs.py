@@ -0,0 +1,346 @@
+"""
+    lopper/jobs
+    ~~~~~~~~~~~
+
+    Contains functionality for queueing branch deletions to be processed outside of the webhook request.
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import typing
+import urllib.parse
+
+from chalicelib import payload, policy, response
+
+
+#: Default maximum number of concurrent deletions per access token of a batch.
+DEFAULT_MAX_WORKERS = 4
+
+
+#: Supported modes of deleting the branches of a batch, see :func:`~lopper.hub.delete_branches`.
+DELETION_MODES = ('rest', 'graphql')
+
+
+#: Compact unit of work describing a branch to delete, the key of the policy rule that accepted it and the ID of
+#: the GitHub App installation that sent the event, if any.
+Job = collections.namedtuple('Job', ['repo', 'ref', 'rule', 'installation'], defaults=(None,))
+
+
+def for_event(event: payload.MergeEvent, rule: str) -> Job:
+    """
+    Build the job to delete the head branch of a merged pull request event.
+
+    :param event: Record of an accepted merged pull request event
+    :type: :class:`~lopper.payload.MergeEvent`
+    :param rule: Key of the policy rule that accepted the event, see :meth:`~lopper.policy.Policy.key`
+    :type: :class:`~str`
+    :return: Job to delete the head branch
+    :rtype: :class:`~lopper.jobs.Job`
+    """
+    return Job(event.head_repo, event.head_ref, rule, event.installation)
+
+
+def dumps(job: Job) -> str:
+    """
+    Serialize the job to a compact JSON string.
+
+    :param job: Job to serialize
+    :type: :class:`~lopper.jobs.Job`
+    :return: Serialized job
+    :rtype: :class:`~str`
+    """
+    return json.dumps(list(job), separators=(',', ':'))
+
+
+def loads(data: str) -> Job:
+    """
+    Deserialize a job created by :func:`~lopper.jobs.dumps`.
+
+    :param data: Serialized job
+    :type: :class:`~str`
+    :return: Deserialized job
+    :rtype: :class:`~lopper.jobs.Job`
+    """
+    return Job(*json.loads(data))
+
+
+class MemoryQueue:
+    """
+    In-process queue of jobs, e.g. for local development and tests.
+    """
+    def __init__(self):
+        self._jobs = collections.deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def put(self, job: Job) -> None:
+        """
+        Add the job to the end of the queue.
+
+        :param job: Job to enqueue
+        :type: :class:`~lopper.jobs.Job`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            self._jobs.append(dumps(job))
+
+    def get_batch(self, size: int) -> typing.List[Job]:
+        """
+        Remove and return up to the given number of jobs from the front of the queue.
+
+        :param size: Maximum number of jobs to return
+        :type: :class:`~int`
+        :return: List of jobs
+        :rtype: :class:`~list`
+        """
+        with self._lock:
+            return [loads(self._jobs.popleft()) for _ in range(min(size, len(self._jobs)))]
+
+
+class FileQueue:
+    """
+    Queue of jobs stored as JSON lines in a local file that survives process restarts.
+
+    Access is only synchronized within a single process.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._read())
+
+    def put(self, job: Job) -> None:
+        """
+        Append the job to the end of the queue file.
+
+        :param job: Job to enqueue
+        :type: :class:`~lopper.jobs.Job`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock, open(self.path, 'a') as f:
+            f.write(dumps(job) + '\n')
+
+    def get_batch(self, size: int) -> typing.List[Job]:
+        """
+        Remove and return up to the given number of jobs from the front of the queue file.
+
+        :param size: Maximum number of jobs to return
+        :type: :class:`~int`
+        :return: List of jobs
+        :rtype: :class:`~list`
+        """
+        with self._lock:
+            lines = self._read()
+            batch, rest = lines[:size], lines[size:]
+            if batch:
+                tmp = '{}.tmp'.format(self.path)
+                with open(tmp, 'w') as f:
+                    f.writelines(rest)
+                os.replace(tmp, self.path)
+            return [loads(line) for line in batch]
+
+    def _read(self) -> typing.List[str]:
+        try:
+            with open(self.path) as f:
+                return [line for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+
+#: Response for jobs whose rule was removed from or changed in the policy after they were accepted.
+RULE_NOT_IN_POLICY = response.fixed('rule_not_in_policy', 'Rule that accepted the job is no longer in the policy', 422)
+
+
+#: Maximum number of messages SQS returns for a single receive request.
+SQS_MAX_MESSAGES = 10
+
+
+class SQSQueue:
+    """
+    Queue of jobs backed by Amazon SQS. Jobs are usually consumed by the :func:`~app.worker` Lambda function.
+
+    Requires ``boto3``, which is provided by the AWS Lambda runtime.
+    """
+    def __init__(self, name: str):
+        import boto3
+
+        self.name = name
+        self._client = boto3.client('sqs')
+        self._url = self._client.get_queue_url(QueueName=name)['QueueUrl']
+
+    def put(self, job: Job) -> None:
+        """
+        Send the job as a message to the queue.
+
+        :param job: Job to enqueue
+        :type: :class:`~lopper.jobs.Job`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        self._client.send_message(QueueUrl=self._url, MessageBody=dumps(job))
+
+    def get_batch(self, size: int) -> typing.List[Job]:
+        """
+        Receive and delete up to the given number of jobs from the queue without waiting for new ones.
+
+        :param size: Maximum number of jobs to return
+        :type: :class:`~int`
+        :return: List of jobs
+        :rtype: :class:`~list`
+        """
+        batch = []
+        while len(batch) < size:
+            messages = self._client.receive_message(
+                QueueUrl=self._url, MaxNumberOfMessages=min(size - len(batch), SQS_MAX_MESSAGES),
+                WaitTimeSeconds=0).get('Messages', [])
+            if not messages:
+                break
+            self._client.delete_message_batch(QueueUrl=self._url, Entries=[
+                dict(Id=str(i), ReceiptHandle=message['ReceiptHandle']) for i, message in enumerate(messages)])
+            batch.extend(loads(message['Body']) for message in messages)
+        return batch
+
+
+@functools.lru_cache(maxsize=None)
+def get_queue(url: str):
+    """
+    Retrieve the queue for the given URL, creating it once per process.
+
+    Supported URLs are ``sqs://<queue-name>``, ``file://<path>`` and ``memory://``.
+
+    :param url: URL of the queue
+    :type: :class:`~str`
+    :return: Queue instance
+    :rtype: :class:`~lopper.jobs.MemoryQueue`, :class:`~lopper.jobs.FileQueue` or :class:`~lopper.jobs.SQSQueue`
+    :raises: :class:`~RuntimeError` when the URL scheme is not supported
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'sqs':
+        return SQSQueue(parsed.netloc)
+    if parsed.scheme == 'file':
+        return FileQueue(parsed.netloc + parsed.path)
+    if parsed.scheme == 'memory':
+        return MemoryQueue()
+    raise RuntimeError('Unsupported deletion queue URL: {}'.format(url))
+
+
+def queue_name(url: str) -> typing.Optional[str]:
+    """
+    Retrieve the SQS queue name of the given queue URL.
+
+    :param url: URL of the queue
+    :type: :class:`~str`
+    :return: Name of the SQS queue or None if the URL isn't for SQS
+    :rtype: :class:`~str`
+    """
+    parsed = urllib.parse.urlparse(url or '')
+    return parsed.netloc if parsed.scheme == 'sqs' else None
+
+
+def process(batch: typing.Iterable[Job], rules: policy.Policy, api_access_token: str, api_base_url: str,
+            max_workers: int = DEFAULT_MAX_WORKERS, index=None, mode: str = 'rest',
+            installations=None) -> typing.List[response.Response]:
+    """
+    Delete the branches of a batch of jobs concurrently, grouped by the access token they use.
+
+    The GitHub API module is imported on first use so enqueueing jobs does not pay for importing PyGithub.
+
+    :param batch: Jobs to process
+    :type: :class:`~collections.Iterable`
+    :param rules: Policy the jobs were accepted by
+    :type: :class:`~lopper.policy.Policy`
+    :param api_access_token: Default access token for GitHub API client when the rule of a job has none
+    :type api_access_token: :class:`~str`
+    :param api_base_url: Base URL of the GitHub API
+    :type api_base_url: :class:`~str`
+    :param max_workers: Maximum number of concurrent deletions per access token
+    :type max_workers: :class:`~int`
+    :param index: Index of branches that must not be deleted; default: delete every branch
+    :type index: :class:`~lopper.safety.SafetyIndex`
+    :param mode: Deletion mode, one of :data:`~lopper.jobs.DELETION_MODES`
+    :type mode: :class:`~str`
+    :param installations: Access tokens of GitHub App installations; default: jobs use rule or default tokens
+    :type installations: :class:`~lopper.installations.InstallationTokens`
+    :return: Response object of each job in batch order
+    :rtype: :class:`~list`
+    """
+    from chalicelib import hub
+
+    positions_by_token = collections.defaultdict(list)
+    batch = list(batch)
+    responses = [None] * len(batch)
+    for position, job in enumerate(batch):
+        if job.rule is not None and rules.find(job.rule) is None:
+            responses[position] = RULE_NOT_IN_POLICY
+            continue
+        try:
+            token = token_for(job, rules, api_access_token, installations)
+        except RuntimeError as e:
+            responses[position] = response.server_error(str(e))
+            continue
+        if index is not None:
+            resp = index.check(token, job.repo, job.ref, api_base_url)
+            if not resp:
+                responses[position] = resp
+                continue
+        positions_by_token[token].append(position)
+
+    for token, positions in positions_by_token.items():
+        branches = [(batch[position].repo, batch[position].ref) for position in positions]
+        for position, resp in zip(positions, hub.delete_branches(token, branches, max_workers, api_base_url, mode)):
+            release_token(batch[position], resp, installations)
+            responses[position] = resp
+    return responses
+
+
+def token_for(job: Job, rules: policy.Policy, api_access_token: str, installations=None) -> str:
+    """
+    Retrieve the access token to process the job with.
+
+    The token of the rule that accepted the job is preferred, then the token of the GitHub App installation
+    that sent the event and finally the default token.
+
+    :param job: Job to retrieve the token for
+    :type: :class:`~lopper.jobs.Job`
+    :param rules: Policy the job was accepted by
+    :type: :class:`~lopper.policy.Policy`
+    :param api_access_token: Default access token when neither the rule nor the installation of the job has one
+    :type api_access_token: :class:`~str`
+    :param installations: Access tokens of GitHub App installations, if authenticating as a GitHub App
+    :type installations: :class:`~lopper.installations.InstallationTokens`
+    :return: Access token for GitHub API client
+    :rtype: :class:`~str`
+    :raises: :class:`~RuntimeError` when the access token of the installation can't be created
+    """
+    rule = rules.find(job.rule) if job.rule is not None else None
+    if rule is not None and rule.token:
+        return rule.token
+    if installations is not None and job.installation is not None:
+        return installations.token(job.installation)
+    return api_access_token
+
+
+def release_token(job: Job, resp: response.Response, installations=None) -> None:
+    """
+    Forget the access token of the installation of the job when the GitHub API rejected it, e.g. because the
+    installation was suspended or the token revoked, so the next job of the installation creates a new one.
+
+    :param job: Processed job
+    :type: :class:`~lopper.jobs.Job`
+    :param resp: Response object of processing the job
+    :type: :class:`~lopper.response.Response`
+    :param installations: Access tokens of GitHub App installations, if authenticating as a GitHub App
+    :type installations: :class:`~lopper.installations.InstallationTokens`
+    :return: Nothing
+    :rtype: :class:`~NoneType`
+    """
+    if installations is not None and job.installation is not None and resp.status_code == 401:
+        installations.invalidate(job.installation)
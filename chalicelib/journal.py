@@ -0,0 +1,409 @@
+"""
+    lopper/journal
+    ~~~~~~~~~~~~~~
+
+    Contains functionality for journaling accepted branch deletions and their outcomes to replay failed ones.
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+import typing
+import urllib.parse
+
+from chalicelib import jobs, response
+
+
+#: Supported URL schemes of journals, see :func:`~lopper.journal.get_journal`.
+SCHEMES = ('file', 'sqlite', 'memory')
+
+
+#: Default number of journaled jobs deleted per replayed batch.
+DEFAULT_BATCH_SIZE = 50
+
+
+#: Default number of seconds an unfinished entry must be old before it's replayed, so deletions still in flight
+#: are left alone.
+DEFAULT_MIN_AGE = 300
+
+
+#: Journaled job with its ID and the time as seconds since the epoch it was accepted at.
+Entry = collections.namedtuple('Entry', ['id', 'accepted_at', 'job'])
+
+
+def new_id() -> str:
+    """
+    Create a random, compact ID for a journal entry.
+
+    :return: Entry ID
+    :rtype: :class:`~str`
+    """
+    return os.urandom(8).hex()
+
+
+def is_finished(status_code: typing.Optional[int]) -> bool:
+    """
+    Determine if a job with the given outcome is finished; jobs without outcome or with a server error are not.
+
+    :param status_code: Status code of the response of the deletion, if any
+    :type: :class:`~int`
+    :return: Boolean indicating the job must not be replayed
+    :rtype: :class:`~bool`
+    """
+    return status_code is not None and status_code < 500
+
+
+class MemoryJournal:
+    """
+    In-process journal of jobs, e.g. for local development and tests.
+    """
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def accept(self, job: jobs.Job) -> str:
+        """
+        Record that the job was accepted for deletion.
+
+        :param job: Accepted job
+        :type: :class:`~lopper.jobs.Job`
+        :return: ID of the entry of the job
+        :rtype: :class:`~str`
+        """
+        entry_id = new_id()
+        with self._lock:
+            self._entries[entry_id] = [time.time(), job, None]
+        return entry_id
+
+    def complete(self, entry_id: str, status_code: int) -> None:
+        """
+        Record the outcome of deleting the branch of a journaled job.
+
+        :param entry_id: ID of the entry of the job
+        :type: :class:`~str`
+        :param status_code: Status code of the response of the deletion
+        :type: :class:`~int`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            if entry_id in self._entries:
+                self._entries[entry_id][2] = status_code
+
+    def pending(self, before: float = None) -> typing.Iterator[Entry]:
+        """
+        Iterate the entries of unfinished and failed jobs in the order they were accepted.
+
+        :param before: Only yield entries accepted before this time as seconds since the epoch; default: all
+        :type: :class:`~float`
+        :return: Iterator of entries
+        :rtype: :class:`~collections.Iterator`
+        """
+        with self._lock:
+            entries = [Entry(entry_id, accepted_at, job) for entry_id, (accepted_at, job, status_code)
+                       in self._entries.items() if not is_finished(status_code)]
+        return iter([entry for entry in entries if before is None or entry.accepted_at < before])
+
+    def compact(self) -> None:
+        """
+        Drop the entries of finished jobs.
+
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            for entry_id in [entry_id for entry_id, (_, _, status_code) in self._entries.items()
+                             if is_finished(status_code)]:
+                del self._entries[entry_id]
+
+
+class FileJournal:
+    """
+    Append-only journal of jobs stored as compact JSON lines in a local file that survives process restarts.
+
+    Accepting a job appends an ``["a", id, accepted_at, repo, ref, rule]`` line and completing it an
+    ``["d", id, status_code]`` line, each a single buffered write. Access is only synchronized within a
+    single process.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def accept(self, job: jobs.Job) -> str:
+        """
+        Append a line recording that the job was accepted for deletion.
+
+        :param job: Accepted job
+        :type: :class:`~lopper.jobs.Job`
+        :return: ID of the entry of the job
+        :rtype: :class:`~str`
+        """
+        entry_id = new_id()
+        self._append(['a', entry_id, time.time(), *job])
+        return entry_id
+
+    def complete(self, entry_id: str, status_code: int) -> None:
+        """
+        Append a line recording the outcome of deleting the branch of a journaled job.
+
+        :param entry_id: ID of the entry of the job
+        :type: :class:`~str`
+        :param status_code: Status code of the response of the deletion
+        :type: :class:`~int`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        self._append(['d', entry_id, status_code])
+
+    def pending(self, before: float = None) -> typing.Iterator[Entry]:
+        """
+        Stream through the journal file and iterate the entries of unfinished and failed jobs in the order they
+        were accepted. Only those entries are held in memory.
+
+        :param before: Only yield entries accepted before this time as seconds since the epoch; default: all
+        :type: :class:`~float`
+        :return: Iterator of entries
+        :rtype: :class:`~collections.Iterator`
+        """
+        with self._lock:
+            entries = self._read()
+        return (entry for entry in entries.values() if before is None or entry.accepted_at < before)
+
+    def compact(self) -> None:
+        """
+        Rewrite the journal file with only the entries of unfinished and failed jobs.
+
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            entries = self._read()
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                f.writelines(self._dumps(['a', entry.id, entry.accepted_at, *entry.job]) for entry in entries.values())
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(tmp, self.path)
+
+    def _append(self, record: list) -> None:
+        """
+        Append a record to the journal file, opening it on first use.
+        """
+        line = self._dumps(record)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', buffering=1)
+            self._file.write(line)
+
+    def _read(self) -> typing.Dict[str, Entry]:
+        """
+        Read the entries of unfinished and failed jobs from the journal file, one line at a time.
+        """
+        entries = collections.OrderedDict()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Skip blank lines and the torn last line of a process that died while writing it.
+                        continue
+                    if record[0] == 'a':
+                        entries[record[1]] = Entry(record[1], record[2], jobs.Job(*record[3:]))
+                    elif is_finished(record[2]):
+                        entries.pop(record[1], None)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    @staticmethod
+    def _dumps(record: list) -> str:
+        return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+class SQLiteJournal:
+    """
+    Journal of jobs stored in a local SQLite database shared by all processes on a host.
+    """
+    def __init__(self, path: str):
+        import sqlite3
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                                 '(id TEXT PRIMARY KEY, accepted_at REAL, job TEXT, status_code INTEGER)')
+
+    def accept(self, job: jobs.Job) -> str:
+        """
+        Insert a row recording that the job was accepted for deletion.
+
+        :param job: Accepted job
+        :type: :class:`~lopper.jobs.Job`
+        :return: ID of the entry of the job
+        :rtype: :class:`~str`
+        """
+        entry_id = new_id()
+        with self._lock:
+            self._connection.execute('INSERT INTO entries (id, accepted_at, job) VALUES (?, ?, ?)',
+                                     (entry_id, time.time(), jobs.dumps(job)))
+        return entry_id
+
+    def complete(self, entry_id: str, status_code: int) -> None:
+        """
+        Record the outcome of deleting the branch of a journaled job.
+
+        :param entry_id: ID of the entry of the job
+        :type: :class:`~str`
+        :param status_code: Status code of the response of the deletion
+        :type: :class:`~int`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            self._connection.execute('UPDATE entries SET status_code = ? WHERE id = ?', (status_code, entry_id))
+
+    def pending(self, before: float = None, page_size: int = 500) -> typing.Iterator[Entry]:
+        """
+        Iterate the entries of unfinished and failed jobs in the order they were accepted, reading them one
+        page at a time.
+
+        :param before: Only yield entries accepted before this time as seconds since the epoch; default: all
+        :type: :class:`~float`
+        :param page_size: Number of entries read from the database at once
+        :type: :class:`~int`
+        :return: Iterator of entries
+        :rtype: :class:`~collections.Iterator`
+        """
+        before = time.time() + 1 if before is None else before
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT rowid, id, accepted_at, job FROM entries WHERE rowid > ? AND accepted_at < ? '
+                    'AND (status_code IS NULL OR status_code >= 500) ORDER BY rowid LIMIT ?',
+                    (last, before, page_size)).fetchall()
+            for last, entry_id, accepted_at, job in rows:
+                yield Entry(entry_id, accepted_at, jobs.loads(job))
+            if len(rows) < page_size:
+                return
+
+    def compact(self) -> None:
+        """
+        Delete the rows of finished jobs.
+
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            self._connection.execute('DELETE FROM entries WHERE status_code < 500')
+
+
+@functools.lru_cache(maxsize=None)
+def get_journal(url: str):
+    """
+    Retrieve the journal for the given URL, creating it once per process.
+
+    Supported URLs are ``file://<path>``, ``sqlite://<path>`` and ``memory://``.
+
+    :param url: URL of the journal
+    :type: :class:`~str`
+    :return: Journal instance
+    :rtype: :class:`~lopper.journal.FileJournal`, :class:`~lopper.journal.SQLiteJournal` or
+        :class:`~lopper.journal.MemoryJournal`
+    :raises: :class:`~RuntimeError` when the URL scheme is not supported
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'file':
+        return FileJournal(parsed.netloc + parsed.path)
+    if parsed.scheme == 'sqlite':
+        return SQLiteJournal(parsed.netloc + parsed.path)
+    if parsed.scheme == 'memory':
+        return MemoryJournal()
+    raise RuntimeError('Unsupported journal URL: {}'.format(url))
+
+
+def replay(journal, process: typing.Callable[[typing.List[jobs.Job]], typing.List[response.Response]],
+           batch_size: int = DEFAULT_BATCH_SIZE, min_age: float = DEFAULT_MIN_AGE) -> collections.Counter:
+    """
+    Process the unfinished and failed jobs of the journal again in batches and record their new outcomes.
+
+    :param journal: Journal to replay
+    :type: :class:`~lopper.journal.FileJournal`, :class:`~lopper.journal.SQLiteJournal` or
+        :class:`~lopper.journal.MemoryJournal`
+    :param process: Callable that deletes the branches of a batch of jobs, see :func:`~lopper.jobs.process`
+    :type: :class:`~collections.Callable`
+    :param batch_size: Maximum number of jobs processed at once
+    :type: :class:`~int`
+    :param min_age: Number of seconds an entry must be old to be replayed
+    :type: :class:`~float`
+    :return: Counter of replayed, deleted, rejected and failed jobs
+    :rtype: :class:`~collections.Counter`
+    """
+    counts = collections.Counter()
+    batch = []
+
+    def flush():
+        for entry, resp in zip(batch, process([entry.job for entry in batch])):
+            journal.complete(entry.id, resp.status_code)
+            counts['replayed'] += 1
+            counts['deleted' if resp else 'failed' if resp.status_code >= 500 else 'rejected'] += 1
+        batch.clear()
+
+    for entry in journal.pending(time.time() - min_age):
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return counts
+
+
+def main(argv: typing.List[str] = None) -> int:
+    """
+    Command line entry point to replay the unfinished and failed jobs of the configured or given journal.
+
+    :param argv: Command line arguments; default: :data:`~sys.argv`
+    :type: :class:`~list`
+    :return: Process exit code
+    :rtype: :class:`~int`
+    """
+    import argparse
+
+    from chalicelib import conf, hub, installations, safety
+
+    parser = argparse.ArgumentParser(description='Replay branch deletions that failed or never finished.')
+    parser.add_argument('--journal', default=conf.JOURNAL, help='URL of the journal')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Number of jobs deleted at once')
+    parser.add_argument('--min-age', type=float, default=DEFAULT_MIN_AGE,
+                        help='Number of seconds an unfinished job must be old to be replayed')
+    parser.add_argument('--compact', action='store_true', help='Drop finished jobs from the journal afterwards')
+    args = parser.parse_args(argv)
+    if not args.journal:
+        parser.error('Must supply a journal URL')
+
+    configuration = conf.get()
+    hub.governor.configure(configuration.api_requests_per_second, configuration.api_request_burst,
+                           configuration.api_max_retries, configuration.api_max_rate_limit_wait)
+    index = safety.get_index(configuration.safety_ttl) if configuration.safety_ttl else None
+    journal = get_journal(args.journal)
+    counts = replay(journal, functools.partial(
+        jobs.process, rules=configuration.policy, api_access_token=configuration.api_access_token,
+        api_base_url=configuration.api_base_url, max_workers=configuration.deletion_max_workers, index=index,
+        mode=configuration.deletion_mode, installations=installations.from_configuration(configuration)),
+        args.batch_size, args.min_age)
+    if args.compact:
+        journal.compact()
+    print(json.dumps(counts, sort_keys=True))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,281 @@
+"""
+    lopper/metrics
+    ~~~~~~~~~~~~~~
+
+    Contains functionality for recording per-stage timings and GitHub API calls of webhook requests.
+"""
+import collections
+import contextvars
+import json
+import sys
+import threading
+import time
+import typing
+
+
+#: Default CloudWatch namespace of emitted metrics.
+DEFAULT_NAMESPACE = 'Lopper'
+
+
+#: Collector of the request being handled, used by modules that don't have it passed in, e.g. :mod:`~lopper.hub`.
+_active = contextvars.ContextVar('lopper.metrics.active')
+
+
+class EMFSink:
+    """
+    Sink that writes every document as a CloudWatch embedded metric format (EMF) log line to a stream.
+
+    AWS Lambda forwards standard output to CloudWatch Logs, which extracts the metrics.
+    """
+    def __init__(self, stream: typing.TextIO = None):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, document: dict) -> None:
+        line = json.dumps(document, separators=(',', ':')) + '\n'
+        with self._lock:
+            (self.stream or sys.stdout).write(line)
+
+
+class MemorySink:
+    """
+    Sink that keeps every document in memory, e.g. for local development and tests.
+    """
+    def __init__(self):
+        self.documents = []
+
+    def __call__(self, document: dict) -> None:
+        self.documents.append(document)
+
+
+class _NullTimer:
+    """
+    Context manager that does nothing, shared by all stages of the disabled collector.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Timer:
+    """
+    Context manager that adds the elapsed time of its block to a stage of a collector.
+    """
+    __slots__ = ('timings', 'stage', 'started')
+
+    def __init__(self, timings: dict, stage: str):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = (time.perf_counter() - self.started) * 1000
+        self.timings[self.stage] = self.timings.get(self.stage, 0.0) + elapsed
+        return False
+
+
+class NullCollector:
+    """
+    Collector that records nothing, used when metrics are disabled so hooks cost close to nothing.
+    """
+    _timer = _NullTimer()
+
+    def time(self, stage: str) -> _NullTimer:
+        return self._timer
+
+    def api_call(self, seconds: float, status_code: int) -> None:
+        return
+
+    def count(self, name: str, value: int = 1) -> None:
+        return
+
+    def annotate(self, **properties) -> None:
+        return
+
+    def finish(self, status_code: int) -> None:
+        return
+
+
+class Collector:
+    """
+    Collector of the stage timings, outcome and GitHub API calls of a single request.
+
+    While the request is handled the collector is the active one of its context, so API calls made by
+    :mod:`~lopper.hub` are recorded without passing it around.
+    """
+    def __init__(self, sink: typing.Callable[[dict], None], namespace: str = DEFAULT_NAMESPACE,
+                 dimensions: typing.Dict[str, str] = None):
+        self.sink = sink
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+        self.timings = collections.OrderedDict()
+        self.api_calls = 0
+        self.api_errors = 0
+        self.api_latency = 0.0
+        self.counts = collections.OrderedDict()
+        self.properties = {}
+        self._lock = threading.Lock()
+        self._token = _active.set(self)
+
+    def time(self, stage: str) -> _Timer:
+        """
+        Create a context manager that records the duration of the stage in milliseconds.
+
+        :param stage: Name of the stage
+        :type: :class:`~str`
+        :return: Timer context manager
+        :rtype: :class:`~object`
+        """
+        return _Timer(self.timings, stage)
+
+    def api_call(self, seconds: float, status_code: int) -> None:
+        """
+        Record a GitHub API call, including its retries.
+
+        :param seconds: Duration of the call
+        :type: :class:`~float`
+        :param status_code: HTTP status code of the final response
+        :type: :class:`~int`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            self.api_calls += 1
+            self.api_errors += status_code >= 400
+            self.api_latency += seconds * 1000
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Add to a count metric of the request, e.g. the number of intended deletions of a dry run.
+
+        :param name: Name of the metric
+        :type: :class:`~str`
+        :param value: Amount to add
+        :type: :class:`~int`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def annotate(self, **properties) -> None:
+        """
+        Add properties to the document of the request that are logged, but not emitted as metrics or dimensions.
+
+        :param properties: Property names and JSON serializable values
+        :type: :class:`~dict`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        with self._lock:
+            self.properties.update(properties)
+
+    def finish(self, status_code: int) -> None:
+        """
+        Record the outcome of the request, emit all metrics to the sink and deactivate the collector.
+
+        :param status_code: HTTP status code of the response
+        :type: :class:`~int`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        _active.reset(self._token)
+        self.sink(self.document(status_code))
+
+    def document(self, status_code: int) -> dict:
+        """
+        Build the CloudWatch embedded metric format document of the request.
+
+        :param status_code: HTTP status code of the response
+        :type: :class:`~int`
+        :return: EMF document
+        :rtype: :class:`~dict`
+        """
+        values = collections.OrderedDict(('{}Time'.format(stage), round(ms, 3)) for stage, ms in self.timings.items())
+        values['ApiCalls'] = self.api_calls
+        values['ApiErrors'] = self.api_errors
+        values['ApiLatency'] = round(self.api_latency, 3)
+        values.update(self.counts)
+
+        units = dict(dict.fromkeys(self.counts, 'Count'), ApiCalls='Count', ApiErrors='Count')
+        document = dict(self.properties, **self.dimensions)
+        document.update(values, StatusCode=status_code)
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [sorted(self.dimensions)],
+                'Metrics': [dict(Name=name, Unit=units.get(name, 'Milliseconds')) for name in values]
+            }]
+        }
+        return document
+
+
+#: Collector shared by all requests while metrics are disabled.
+NULL_COLLECTOR = NullCollector()
+
+
+#: Sinks by the name they are configured with.
+SINKS = {
+    'emf': EMFSink,
+    'memory': MemorySink
+}
+
+
+#: Sink instances of the process by name, created by :func:`~lopper.metrics.get_sink` on first use.
+_sinks = {}
+
+
+def start(sink: typing.Optional[str], namespace: str = DEFAULT_NAMESPACE,
+          dimensions: typing.Dict[str, str] = None) -> typing.Union[Collector, NullCollector]:
+    """
+    Start collecting the metrics of a request.
+
+    :param sink: Name of the sink, one of :data:`~lopper.metrics.SINKS`, or None to disable metrics
+    :type: :class:`~str`
+    :param namespace: CloudWatch namespace of the metrics
+    :type: :class:`~str`
+    :param dimensions: CloudWatch dimensions of the metrics, e.g. the function name
+    :type: :class:`~dict`
+    :return: Collector of the request
+    :rtype: :class:`~lopper.metrics.Collector` or :class:`~lopper.metrics.NullCollector`
+    :raises: :class:`~RuntimeError` when the sink is not supported
+    """
+    if not sink:
+        return NULL_COLLECTOR
+    return Collector(get_sink(sink), namespace, dimensions)
+
+
+def get_sink(name: str) -> typing.Callable[[dict], None]:
+    """
+    Retrieve the sink for the given name, creating it once per process.
+
+    :param name: Name of the sink, one of :data:`~lopper.metrics.SINKS`
+    :type: :class:`~str`
+    :return: Sink instance
+    :rtype: :class:`~lopper.metrics.EMFSink` or :class:`~lopper.metrics.MemorySink`
+    :raises: :class:`~RuntimeError` when the sink is not supported
+    """
+    sink = _sinks.get(name)
+    if sink is None:
+        if name not in SINKS:
+            raise RuntimeError('Unsupported metrics sink: {}'.format(name))
+        sink = _sinks.setdefault(name, SINKS[name]())
+    return sink
+
+
+def active() -> typing.Union[Collector, NullCollector]:
+    """
+    Retrieve the collector of the request being handled in the current context.
+
+    :return: Active collector or the disabled collector if there is none
+    :rtype: :class:`~lopper.metrics.Collector` or :class:`~lopper.metrics.NullCollector`
+    """
+    return _active.get(NULL_COLLECTOR)
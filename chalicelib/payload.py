@@ -4,192 +4,381 @@
 
     Contains functionality for examining HTTP request payloads.
 """
+import collections
+import json
 import re
 import typing
 
-from chalicelib import response
+from chalicelib import policy, response
 
 
-def get_target_branch_metadata(payload: dict) -> typing.Dict[str, str]:
+#: GitHub event type of webhooks sent for pull request activity.
+PULL_REQUEST_EVENT = 'pull_request'
+
+
+#: Regular expression to find the first (top-level) "action" value of a raw payload without decoding it.
+ACTION_PATTERN = re.compile(rb'"action"\s*:\s*"([^"]*)"')
+
+
+#: Regular expression to find the owner in the "full_name" of the "repository" of a raw payload without decoding it.
+REPOSITORY_OWNER_PATTERN = re.compile(rb'"repository"\s*:\s*\{[^{}]*"full_name"\s*:\s*"([^"/]+)/')
+
+
+#: Compact record of the fields of a pull request event that are needed to examine and process it; every field
+#: of a missing section or value is None.
+MergeEvent = collections.namedtuple('MergeEvent', ['action', 'number', 'owner', 'name', 'repo', 'head_repo',
+                                                   'head_ref', 'base_ref', 'merged_at', 'merge_commit_sha',
+                                                   'installation'])
+
+
+#: Response for requests without an event header.
+MISSING_EVENT = response.fixed('event_missing', 'Missing "X-GitHub-Event" header', 422)
+
+
+#: Response for requests whose body can't be decoded.
+INVALID_BODY = response.fixed('body_invalid', 'Request body is not JSON or empty', 422)
+
+
+#: Response for events that could be a closed pull request.
+EVENT_ACCEPTABLE = response.fixed('event_acceptable', 'Pull request event is acceptable to examine')
+
+
+#: Response for payloads that match a rule and should be processed.
+PAYLOAD_ACCEPTABLE = response.fixed('payload_acceptable', 'Pull request payload is acceptable to process')
+
+
+#: Response for events of a type other than "pull_request".
+NOT_PULL_REQUEST = response.fixed('event_not_pull_request', 'Received event that is not a pull request event', 422)
+
+
+#: Response for payloads of pull request activity other than closing it.
+NOT_CLOSED = response.fixed('pull_request_not_closed', 'Received payload for pull request that was not closed', 422)
+
+
+#: Response for payloads without "repository" data.
+MISSING_REPOSITORY = response.fixed('repository_missing', 'Received payload that is missing "repository" data', 422)
+
+
+#: Response for payloads without "pull_request" data.
+MISSING_PULL_REQUEST = response.fixed('pull_request_missing',
+                                      'Received payload that is missing "pull_request" data', 422)
+
+
+#: Response for payloads of pull requests that were closed without being merged.
+NOT_MERGED = response.fixed('pull_request_not_merged', 'Received payload for pull request that was not merged', 422)
+
+
+#: Response for payloads of merged pull requests whose head repository no longer exists, e.g. a deleted fork.
+MISSING_HEAD_REPOSITORY = response.fixed('head_repository_missing',
+                                         'Received payload for pull request whose head repository is missing', 422)
+
+
+#: Response for payloads of repositories that no rule of the policy applies to.
+NO_MATCHING_RULE = response.fixed('rule_not_matched',
+                                  'Received payload for repository that does not match any rule', 422)
+
+
+#: Response for payloads of pull requests whose head branch is excluded by the matched rule.
+HEAD_BRANCH_EXCLUDED = response.fixed('head_branch_excluded',
+                                      'Received payload for pull request that matches an excluded head branch name',
+                                      422)
+
+
+def parse(raw_payload: bytes) -> typing.Optional[dict]:
     """
-    Retrieve metadata of the head branch that was merged in the pull request.
+    Decode the raw request payload.
 
-    :param payload: Request payload to examine
-    :type: :class:`~dict`
-    :return: Metadata of the merged head branch that should be deleted
+    :param raw_payload: Raw request payload to decode
+    :type: :class:`~bytes`
+    :return: Decoded payload or None if it is empty or not a JSON object
     :rtype: :class:`~dict`
     """
-    head = payload['pull_request']['head']
-    return dict(repo=head['repo']['full_name'], ref=head['ref'])
+    if not raw_payload:
+        return None
+    try:
+        payload = json.loads(raw_payload)
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def scan_action(raw_payload: bytes) -> typing.Optional[str]:
+    """
+    Find the action of the raw request payload without decoding it.
+
+    GitHub serializes the ``action`` key first, so the first match is the top-level action.
+
+    :param raw_payload: Raw request payload to scan
+    :type: :class:`~bytes`
+    :return: Action of the payload or None if it does not contain one
+    :rtype: :class:`~str`
+    """
+    match = ACTION_PATTERN.search(raw_payload)
+    return match.group(1).decode('utf-8', 'replace') if match else None
+
+
+def scan_repository_owner(raw_payload: bytes) -> typing.Optional[str]:
+    """
+    Find the login of the repository owner of the raw request payload without decoding it.
+
+    GitHub serializes the ``full_name`` of a repository before its nested ``owner`` object.
+
+    :param raw_payload: Raw request payload to scan
+    :type: :class:`~bytes`
+    :return: Login of the repository owner or None if the payload does not contain a repository
+    :rtype: :class:`~str`
+    """
+    match = REPOSITORY_OWNER_PATTERN.search(raw_payload)
+    return match.group(1).decode('utf-8', 'replace') if match else None
+
+
+def is_acceptable_event(event: str, raw_payload: bytes) -> response.Response:
+    """
+    Cheaply determine if the event could be a closed pull request before decoding its payload.
 
+    :param event: GitHub event type from the "X-GitHub-Event" header
+    :type: :class:`~str`
+    :param raw_payload: Raw request payload to scan
+    :type: :class:`~bytes`
+    :return: Response object indicating if the payload should be decoded and examined further.
+    :rtype: :class:`~lopper.response.Response`
+    """
+    if event != PULL_REQUEST_EVENT:
+        return NOT_PULL_REQUEST
+
+    action = scan_action(raw_payload)
+    if not action or action.lower() != 'closed':
+        return NOT_CLOSED
 
-def is_acceptable_payload(payload: dict, head_branch: str, base_branch: str, repository_owner: str,
-                          repository_name: str, head_branch_exclusion: typing.List[str]) -> response.Response:
+    return EVENT_ACCEPTABLE
+
+
+def extract(payload: dict) -> MergeEvent:
+    """
+    Pull the fields needed to examine and process a pull request event out of the payload in a single pass.
+
+    :param payload: Request payload to examine
+    :type: :class:`~dict`
+    :return: Record of the event; fields of missing sections or values are None
+    :rtype: :class:`~lopper.payload.MergeEvent`
+    """
+    repository = payload.get('repository') or {}
+    pull_request = payload.get('pull_request') or {}
+    head = pull_request.get('head') or {}
+    return MergeEvent(
+        action=payload.get('action'),
+        number=pull_request.get('number'),
+        owner=(repository.get('owner') or {}).get('login'),
+        name=repository.get('name'),
+        repo=repository.get('full_name'),
+        head_repo=(head.get('repo') or {}).get('full_name'),
+        head_ref=head.get('ref'),
+        base_ref=(pull_request.get('base') or {}).get('ref'),
+        merged_at=pull_request.get('merged_at'),
+        merge_commit_sha=pull_request.get('merge_commit_sha'),
+        installation=(payload.get('installation') or {}).get('id')
+    )
+
+
+def is_acceptable_payload(payload: dict, rules: policy.Policy) -> response.Response:
     """
     Determine if the payload meets the necessary requirements for being a target for processing.
 
     :param payload: Request payload to examine
     :type: :class:`~dict`
-    :param head_branch: Regular expression to match head branches to accept
-    :type: :class:`~str`
-    :param base_branch: Regular expression to match base branches to accept
-    :type: :class:`~str`
-    :param repository_owner: Regular expression to match repository owners to accept
-    :type: :class:`~str`
-    :param repository_name: Regular expression to match repository names to accept
-    :type: :class:`~str`
-    :param head_branch_exclusion: List of branch names to not accept
-    :type: :class: `~list`
+    :param rules: Policy of compiled rules to match the payload against
+    :type: :class:`~lopper.policy.Policy`
     :return: Response object indicating if the payload should be processed further.
     :rtype: :class:`~lopper.response.Response`
     """
-    if not _is_pull_request_closed(payload):
-        return response.unprocessable_entity('Received payload for pull request that was not closed')
+    _, resp = match_rule(extract(payload), rules)
+    return resp
 
-    repository = payload.get('repository')
-    if not repository:
-        return response.unprocessable_entity('Received payload that is missing "repository" data')
 
-    if not _is_repository_owner_match(repository, repository_owner):
-        msg = 'Received payload for repository that does not match owner pattern: {}'.format(repository_owner)
-        return response.unprocessable_entity(msg)
+def get_matching_rule(payload: dict, rules: policy.Policy) -> typing.Optional[policy.FilterSet]:
+    """
+    Retrieve the first rule of the policy that accepts the payload.
 
-    if not _is_repository_name_match(repository, repository_name):
-        msg = 'Received payload for repository that does not match name pattern: {}'.format(repository_name)
-        return response.unprocessable_entity(msg)
+    :param payload: Request payload to examine
+    :type: :class:`~dict`
+    :param rules: Policy of compiled rules to match the payload against
+    :type: :class:`~lopper.policy.Policy`
+    :return: Rule accepting the payload or None if the payload is not acceptable
+    :rtype: :class:`~lopper.policy.FilterSet`
+    """
+    rule, _ = match_rule(extract(payload), rules)
+    return rule
+
+
+def match_rule(event: MergeEvent, rules: policy.Policy) -> typing.Tuple[typing.Optional[policy.FilterSet],
+                                                                         response.Response]:
+    """
+    Match the event against the candidate rules of its repository in definition order.
+
+    :param event: Record of the event to examine, see :func:`~lopper.payload.extract`
+    :type: :class:`~lopper.payload.MergeEvent`
+    :param rules: Policy of compiled rules to match the event against
+    :type: :class:`~lopper.policy.Policy`
+    :return: Tuple of the accepting rule (or None) and the response of the last evaluated rule
+    :rtype: :class:`~tuple`
+    """
+    if not _is_pull_request_closed(event):
+        return None, NOT_CLOSED
 
-    pull_request = payload.get('pull_request')
-    if not pull_request:
-        return response.unprocessable_entity('Received payload that is missing "pull_request" data')
+    if not event.repo:
+        return None, MISSING_REPOSITORY
 
-    if not _is_pull_request_merged(pull_request):
-        return response.unprocessable_entity('Received payload for pull request that was not merged')
+    if event.number is None:
+        return None, MISSING_PULL_REQUEST
 
-    if not _is_pull_request_head_branch_match(pull_request, head_branch):
-        msg = 'Received payload for pull request that does not match head branch pattern: {}'.format(head_branch)
+    if not _is_pull_request_merged(event):
+        return None, NOT_MERGED
+
+    if not event.head_repo:
+        return None, MISSING_HEAD_REPOSITORY
+
+    resp = NO_MATCHING_RULE
+    for rule in rules.candidates(event.owner, event.name):
+        resp = _is_acceptable_for_rule(event, rule)
+        if resp:
+            return rule, resp
+
+    return None, resp
+
+
+def _is_acceptable_for_rule(event: MergeEvent, filters: policy.FilterSet) -> response.Response:
+    """
+    Determine if the record of a merged pull request event matches a single rule.
+
+    :param event: Record of the event to examine
+    :type: :class:`~lopper.payload.MergeEvent`
+    :param filters: Compiled patterns and exclusions of the rule
+    :type: :class:`~lopper.policy.FilterSet`
+    :return: Response object indicating if the event matches the rule.
+    :rtype: :class:`~lopper.response.Response`
+    """
+    if not _is_repository_owner_match(event, filters.repository_owner):
+        msg = 'Received payload for repository that does not match owner pattern: {}'.format(
+            filters.repository_owner.pattern)
         return response.unprocessable_entity(msg)
 
-    if not _is_pull_request_head_branch_included(pull_request, head_branch_exclusion):
-        msg = 'Received payload for pull request that matches an excluded head branch name'
+    if not _is_repository_name_match(event, filters.repository_name):
+        msg = 'Received payload for repository that does not match name pattern: {}'.format(
+            filters.repository_name.pattern)
         return response.unprocessable_entity(msg)
 
-    if not _is_pull_request_base_branch_match(pull_request, base_branch):
-        msg = 'Received payload for pull request that does not match base branch patter: {}'.format(base_branch)
+    if not _is_pull_request_head_branch_match(event, filters.head_branch):
+        msg = 'Received payload for pull request that does not match head branch pattern: {}'.format(
+            filters.head_branch.pattern)
+        return response.unprocessable_entity(msg)
+
+    if not _is_pull_request_head_branch_included(event, filters.head_branch_exclusion):
+        return HEAD_BRANCH_EXCLUDED
+
+    if not _is_pull_request_base_branch_match(event, filters.base_branch):
+        msg = 'Received payload for pull request that does not match base branch patter: {}'.format(
+            filters.base_branch.pattern)
         return response.unprocessable_entity(msg)
 
-    return response.success('Pull request payload is acceptable to process')
+    return PAYLOAD_ACCEPTABLE
 
 
-def _is_pull_request_closed(payload: dict) -> bool:
+def _is_pull_request_closed(event: MergeEvent) -> bool:
     """
-    Determine if the payload represents a notification of a pull request being closed.
+    Determine if the event represents a notification of a pull request being closed.
 
-    :param payload: Request payload to examine
-    :type: :class:`~dict`
+    :param event: Record of the event to examine
+    :type: :class:`~lopper.payload.MergeEvent`
     :return: Boolean indicating payload state
     :rtype: :class:`~bool`
     """
-    action = payload.get('action')
+    action = event.action
     return action and action.lower() == 'closed'
 
 
-def _is_pull_request_merged(pull_request: dict) -> bool:
+def _is_pull_request_merged(event: MergeEvent) -> bool:
     """
-    Determine if the pull request contains meta-data indicating it was merged.
+    Determine if the event contains meta-data indicating the pull request was merged.
 
-    :param pull_request: Pull request section of payload to examine
-    :type: :class:`~dict`
+    :param event: Record of the event to examine
+    :type: :class:`~lopper.payload.MergeEvent`
     :return: Boolean indicating pull request state
     :rtype: :class:`~bool`
     """
-    merged_at = pull_request.get('merged_at')
-    merge_commit_sha = pull_request.get('merge_commit_sha')
-    return all((merged_at, merge_commit_sha))
+    return all((event.merged_at, event.merge_commit_sha))
 
 
-def _is_pull_request_head_branch_match(pull_request: dict, head_branch: str) -> bool:
+def _is_pull_request_head_branch_match(event: MergeEvent, head_branch: typing.Pattern) -> bool:
     """
-    Determine if the pull request represents a notification for a head branch we should consider.
+    Determine if the event represents a notification for a head branch we should consider.
 
-    :param pull_request: Pull request section of payload to examine
-    :type: :class:`~dict`
-    :param head_branch: Regular expression to match head branches to accept
-    :type: :class:`~str`
+    :param event: Record of the event to examine
+    :type: :class:`~lopper.payload.MergeEvent`
+    :param head_branch: Compiled regular expression to match head branches to accept
+    :type: :class:`~typing.Pattern`
     :return: Boolean indicating pull request state
     :rtype: :class:`~bool`
     """
-    head = pull_request.get('head')
-    if not head:
-        return False
-    ref = head.get('ref')
-    return ref and re.match(head_branch, ref) is not None
+    ref = event.head_ref
+    return ref and head_branch.match(ref) is not None
 
 
-def _is_pull_request_head_branch_included(pull_request: dict, head_branch_exclusion: typing.List[str]) -> bool:
+def _is_pull_request_head_branch_included(event: MergeEvent, head_branch_exclusion: typing.FrozenSet[str]) -> bool:
     """
-    Determine if the pull request represents a notification for a head branch we should consider
+    Determine if the event represents a notification for a head branch we should consider
     based on the fact that it is not in the exclusion list.
 
-    :param pull_request: Pull request section of payload to examine
-    :type: :class:`~dict`
-    :param head_branch_exclusion: List of branches to exclude
-    :type: :class:`~list`
+    :param event: Record of the event to examine
+    :type: :class:`~lopper.payload.MergeEvent`
+    :param head_branch_exclusion: Set of branches to exclude
+    :type: :class:`~frozenset`
     :return: Boolean indicating pull request state
     :rtype: :class:`~bool`
     """
-    head = pull_request.get('head')
-    if not head:
-        return False
-    ref = head.get('ref')
+    ref = event.head_ref
     return ref and ref not in head_branch_exclusion
 
 
-def _is_pull_request_base_branch_match(pull_request: dict, base_branch: str) -> bool:
+def _is_pull_request_base_branch_match(event: MergeEvent, base_branch: typing.Pattern) -> bool:
     """
-    Determine if the pull request represents a notification for a base branch we should consider.
+    Determine if the event represents a notification for a base branch we should consider.
 
-    :param pull_request: Pull request section of payload to examine
-    :type: :class:`~dict`
-    :param base_branch: Regular expression to match base branches to accept
-    :type: :class:`~str`
+    :param event: Record of the event to examine
+    :type: :class:`~lopper.payload.MergeEvent`
+    :param base_branch: Compiled regular expression to match base branches to accept
+    :type: :class:`~typing.Pattern`
     :return: Boolean indicating pull request state
     :rtype: :class:`~bool`
     """
-    base = pull_request.get('base')
-    if not base:
-        return False
-    ref = base.get('ref')
-    return ref and re.match(base_branch, ref) is not None
+    ref = event.base_ref
+    return ref and base_branch.match(ref) is not None
 
 
-def _is_repository_owner_match(repository: dict, repository_owner: str) -> bool:
+def _is_repository_owner_match(event: MergeEvent, repository_owner: typing.Pattern) -> bool:
     """
-    Determine if the payload represents a notification for a repository we should consider.
+    Determine if the event represents a notification for a repository we should consider.
 
-    :param repository: Repository section of payload to examine
-    :type: :class:`~dict`
-    :param repository_owner: Regular expression to match repository owners to accept
-    :type: :class:`~str`
+    :param event: Record of the event to examine
+    :type: :class:`~lopper.payload.MergeEvent`
+    :param repository_owner: Compiled regular expression to match repository owners to accept
+    :type: :class:`~typing.Pattern`
     :return: Boolean indicating pull request state
     :rtype: :class:`~bool`
     """
-    owner = repository.get('owner')
-    if not owner:
-        return False
-    login = owner.get('login')
-    return login and re.match(repository_owner, login) is not None
+    login = event.owner
+    return login and repository_owner.match(login) is not None
 
 
-def _is_repository_name_match(repository: dict, repository_name: str) -> bool:
+def _is_repository_name_match(event: MergeEvent, repository_name: typing.Pattern) -> bool:
     """
-    Determine if the payload represents a notification for a repository we should consider.
+    Determine if the event represents a notification for a repository we should consider.
 
-    :param repository: Repository section of payload to examine
-    :type: :class:`~dict`
-    :param repository_name: Regular expression to match repository name to accept
-    :type: :class:`~str`
+    :param event: Record of the event to examine
+    :type: :class:`~lopper.payload.MergeEvent`
+    :param repository_name: Compiled regular expression to match repository name to accept
+    :type: :class:`~typing.Pattern`
     :return: Boolean indicating pull request state
     :rtype: :class:`~bool`
     """
-    name = repository.get('name')
-    return name and re.match(repository_name, name) is not None
+    name = event.name
+    return name and repository_name.match(name) is not None
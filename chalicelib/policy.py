@@ -0,0 +1,307 @@
+"""
+    lopper/policy
+    ~~~~~~~~~~~~~
+
+    Contains the rules that decide which pull request payloads are accepted.
+"""
+import collections
+import functools
+import hashlib
+import heapq
+import json
+import re
+import typing
+
+
+#: Compiled regular expressions, exclusions and access token of a single rule used to filter incoming payloads.
+FilterSet = collections.namedtuple('FilterSet', ['head_branch', 'base_branch', 'repository_owner',
+                                                 'repository_name', 'head_branch_exclusion', 'token'])
+
+
+@functools.lru_cache(maxsize=1)
+def compile_filters(head_branch: str, base_branch: str, repository_owner: str, repository_name: str,
+                    head_branch_exclusion: typing.Tuple[str, ...], token: str = None) -> FilterSet:
+    """
+    Compile the given patterns and exclusions into a :class:`~lopper.policy.FilterSet`.
+
+    :param head_branch: Regular expression to match head branches to accept
+    :type: :class:`~str`
+    :param base_branch: Regular expression to match base branches to accept
+    :type: :class:`~str`
+    :param repository_owner: Regular expression to match repository owners to accept
+    :type: :class:`~str`
+    :param repository_name: Regular expression to match repository names to accept
+    :type: :class:`~str`
+    :param head_branch_exclusion: Branch names to not accept
+    :type: :class:`~tuple`
+    :param token: Access token for GitHub API client used for accepted payloads; default: configured token
+    :type: :class:`~str`
+    :return: Compiled filters
+    :rtype: :class:`~lopper.policy.FilterSet`
+    :raises: :class:`~RuntimeError` when any pattern is not a valid regular expression
+    """
+    return _compile(head_branch, base_branch, repository_owner, repository_name, head_branch_exclusion, token)
+
+
+def _compile(head_branch: str, base_branch: str, repository_owner: str, repository_name: str,
+             head_branch_exclusion: typing.Iterable[str], token: str) -> FilterSet:
+    """
+    Compile the given patterns and exclusions into a :class:`~lopper.policy.FilterSet` without caching.
+    """
+    patterns = dict(head_branch=head_branch, base_branch=base_branch,
+                    repository_owner=repository_owner, repository_name=repository_name)
+    compiled = {}
+    for name, pattern in patterns.items():
+        try:
+            compiled[name] = re.compile(pattern)
+        except (re.error, TypeError) as e:
+            raise RuntimeError('Invalid regex pattern for {}: {}'.format(name, e))
+    return FilterSet(head_branch_exclusion=frozenset(head_branch_exclusion), token=token, **compiled)
+
+
+class Policy:
+    """
+    Ordered collection of :class:`~lopper.policy.FilterSet` rules indexed for fast lookup.
+
+    Rules with an exact repository owner (and name) are indexed by it so only rules that can apply to a
+    repository are evaluated. Rules with an owner pattern are kept in a fallback list. Candidates are
+    always yielded in the order the rules were defined in.
+    """
+    def __init__(self, rules: typing.Iterable[typing.Tuple[FilterSet, str, str]]):
+        self.rules = []
+        self._indexes = {}
+        self._keys = {}
+        self._by_key = {}
+        self._by_repository = collections.defaultdict(list)
+        self._by_owner = collections.defaultdict(list)
+        self._fallback = []
+
+        for index, (rule, owner, name) in enumerate(rules):
+            self.rules.append(rule)
+            self._indexes.setdefault(id(rule), index)
+            self._keys[id(rule)] = key = rule_key(rule)
+            self._by_key.setdefault(key, rule)
+            if owner is not None and name is not None:
+                self._by_repository[(owner, name)].append((index, rule))
+            elif owner is not None:
+                self._by_owner[owner].append((index, rule))
+            else:
+                self._fallback.append((index, rule))
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def from_filters(cls, filters: FilterSet) -> 'Policy':
+        """
+        Create a policy containing a single rule.
+
+        :param filters: Rule to match all payloads against
+        :type: :class:`~lopper.policy.FilterSet`
+        :return: Policy with one fallback rule
+        :rtype: :class:`~lopper.policy.Policy`
+        """
+        return cls([(filters, None, None)])
+
+    def index(self, rule: FilterSet) -> int:
+        """
+        Retrieve the position of the given rule in the policy.
+
+        :param rule: Rule of this policy
+        :type: :class:`~lopper.policy.FilterSet`
+        :return: Index of the rule
+        :rtype: :class:`~int`
+        """
+        return self._indexes[id(rule)]
+
+    def key(self, rule: FilterSet) -> str:
+        """
+        Retrieve the stable key of the given rule, see :func:`~lopper.policy.rule_key`.
+
+        :param rule: Rule of this policy
+        :type: :class:`~lopper.policy.FilterSet`
+        :return: Key of the rule
+        :rtype: :class:`~str`
+        """
+        return self._keys[id(rule)]
+
+    def find(self, key: str) -> typing.Optional[FilterSet]:
+        """
+        Retrieve the rule with the given stable key.
+
+        :param key: Key of the rule, see :meth:`~lopper.policy.Policy.key`
+        :type: :class:`~str`
+        :return: Rule with the key or None when the policy no longer contains it
+        :rtype: :class:`~lopper.policy.FilterSet`
+        """
+        return self._by_key.get(key)
+
+    @property
+    def owners(self) -> typing.Set[str]:
+        """
+        Retrieve the exact repository owners that rules are defined for.
+
+        :return: Set of owner logins
+        :rtype: :class:`~set`
+        """
+        return set(self._by_owner) | {owner for owner, _ in self._by_repository}
+
+    def matches_repository(self, owner: str, name: str) -> bool:
+        """
+        Determine if any rule of the policy accepts payloads for the given repository.
+
+        :param owner: Login of the repository owner
+        :type: :class:`~str`
+        :param name: Name of the repository
+        :type: :class:`~str`
+        :return: Boolean indicating if a rule matches the repository
+        :rtype: :class:`~bool`
+        """
+        return any(rule.repository_owner.match(owner) and rule.repository_name.match(name)
+                   for rule in self.candidates(owner, name))
+
+    @property
+    def requires_default_token(self) -> bool:
+        """
+        Determine if any rule relies on the configured default access token.
+
+        :return: Boolean indicating if a rule does not define its own token
+        :rtype: :class:`~bool`
+        """
+        return any(rule.token is None for rule in self.rules)
+
+    def candidates(self, owner: str, name: str) -> typing.Iterator[FilterSet]:
+        """
+        Retrieve the rules that could apply to the given repository in definition order.
+
+        :param owner: Login of the repository owner
+        :type: :class:`~str`
+        :param name: Name of the repository
+        :type: :class:`~str`
+        :return: Iterator of candidate rules
+        :rtype: :class:`~collections.Iterator`
+        """
+        indexed = (self._by_repository.get((owner, name), ()), self._by_owner.get(owner, ()), self._fallback)
+        groups = [group for group in indexed if group]
+        if len(groups) == 1:
+            return (rule for _, rule in groups[0])
+        return (rule for _, rule in heapq.merge(*groups, key=lambda item: item[0]))
+
+
+def rule_key(rule: FilterSet) -> str:
+    """
+    Create a key identifying the rule by what it matches, so it's the same across processes and policy reloads
+    as long as the rule isn't changed. The access token is not part of the key so it can be rotated.
+
+    :param rule: Rule to create the key of
+    :type: :class:`~lopper.policy.FilterSet`
+    :return: Hexadecimal key
+    :rtype: :class:`~str`
+    """
+    patterns = [rule.head_branch.pattern, rule.base_branch.pattern, rule.repository_owner.pattern,
+                rule.repository_name.pattern, sorted(rule.head_branch_exclusion)]
+    return hashlib.sha1(json.dumps(patterns).encode()).hexdigest()[:16]
+
+
+def load(path: str, defaults: FilterSet) -> Policy:
+    """
+    Load a :class:`~lopper.policy.Policy` from a JSON or YAML (requires PyYAML) document.
+
+    The document contains a list of ``rules``. Each rule selects repositories by an exact ``owner``
+    or an ``owner_pattern`` and optionally an exact ``name`` or a ``name_pattern``. It may override
+    ``head_branch_pattern``, ``base_branch_pattern``, ``head_branch_exclusion`` and ``token``; any
+    value not set is taken from the given defaults.
+
+    :param path: Path to the policy document
+    :type: :class:`~str`
+    :param defaults: Rule containing the values used for settings a rule does not define
+    :type: :class:`~lopper.policy.FilterSet`
+    :return: Policy containing all rules of the document
+    :rtype: :class:`~lopper.policy.Policy`
+    :raises: :class:`~RuntimeError` when the document cannot be read or contains an invalid rule
+    """
+    return from_document(load_document(path), defaults, path)
+
+
+def from_document(document: typing.Any, defaults: FilterSet, path: str = None) -> Policy:
+    """
+    Build a :class:`~lopper.policy.Policy` from an already parsed policy document, see :func:`~lopper.policy.load`.
+
+    :param document: Parsed policy document
+    :type: :class:`~dict`
+    :param defaults: Rule containing the values used for settings a rule does not define
+    :type: :class:`~lopper.policy.FilterSet`
+    :param path: Path the document was read from, used in error messages
+    :type: :class:`~str`
+    :return: Policy containing all rules of the document
+    :rtype: :class:`~lopper.policy.Policy`
+    :raises: :class:`~RuntimeError` when the document contains an invalid rule
+    """
+    specs = document.get('rules') if isinstance(document, dict) else None
+    if not isinstance(specs, list) or not specs:
+        raise RuntimeError('Policy file "{}" must contain a non-empty list of rules'.format(path))
+    return Policy(_rule(spec, defaults) for spec in specs)
+
+
+def load_document(path: str) -> typing.Any:
+    """
+    Read the JSON or YAML (based on file extension) document at the given path.
+
+    :param path: Path to the document
+    :type: :class:`~str`
+    :return: Parsed document
+    :rtype: :class:`~object`
+    :raises: :class:`~RuntimeError` when the document cannot be read or parsed
+    """
+    try:
+        with open(path) as f:
+            if path.endswith(('.yml', '.yaml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise RuntimeError('Loading YAML file "{}" requires PyYAML to be installed'.format(path))
+                try:
+                    return yaml.safe_load(f)
+                except yaml.YAMLError as e:
+                    raise ValueError(e)
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise RuntimeError('Unable to load file "{}": {}'.format(path, e))
+
+
+def _rule(spec: dict, defaults: FilterSet) -> typing.Tuple[FilterSet, str, str]:
+    """
+    Compile a single rule definition of a policy document.
+
+    :param spec: Rule definition
+    :type: :class:`~dict`
+    :param defaults: Rule containing the values used for settings the definition does not define
+    :type: :class:`~lopper.policy.FilterSet`
+    :return: Tuple of compiled rule, exact owner (or None) and exact name (or None)
+    :rtype: :class:`~tuple`
+    """
+    if not isinstance(spec, dict):
+        raise RuntimeError('Policy rule must be a mapping: {}'.format(spec))
+
+    owner, name = spec.get('owner'), spec.get('name')
+    if owner is None and name is not None:
+        raise RuntimeError('Policy rule with an exact "name" must define an exact "owner": {}'.format(spec))
+
+    owner_pattern = _exact(owner) if owner is not None else spec.get('owner_pattern',
+                                                                      defaults.repository_owner.pattern)
+    name_pattern = _exact(name) if name is not None else spec.get('name_pattern', defaults.repository_name.pattern)
+    exclusion = spec.get('head_branch_exclusion', defaults.head_branch_exclusion)
+    if not isinstance(exclusion, (list, tuple, frozenset)) or not all(isinstance(ref, str) for ref in exclusion):
+        raise RuntimeError('Policy rule "head_branch_exclusion" must be a list of branch names: {}'.format(spec))
+
+    rule = _compile(spec.get('head_branch_pattern', defaults.head_branch.pattern),
+                    spec.get('base_branch_pattern', defaults.base_branch.pattern),
+                    owner_pattern, name_pattern, exclusion, spec.get('token', defaults.token))
+    return rule, owner, name
+
+
+def _exact(value: str) -> str:
+    """
+    Create a regular expression that only matches the given value.
+    """
+    return '{}$'.format(re.escape(value))
@@ -5,6 +5,8 @@
     Contains functionality for creating API responses.
 """
 import functools
+import json
+import types
 
 import chalice
 
@@ -13,10 +15,10 @@ import chalice
 DEFAULT_STATUS_CODE = 200
 
 
-#: Default response HTTP headers to return if not explicitly defined.
-DEFAULT_HEADERS = {
+#: Default response HTTP headers to return if not explicitly defined; read-only as it's shared by all responses.
+DEFAULT_HEADERS = types.MappingProxyType({
     'Content-Type': 'application/json'
-}
+})
 
 
 class Response(chalice.Response):
@@ -28,7 +30,54 @@ class Response(chalice.Response):
                                                                   self.body, self.headers)
 
     def __bool__(self):
-        return self.status_code == 200
+        return 200 <= self.status_code < 300
+
+
+class FixedResponse(Response):
+    """
+    Immutable response of a fixed outcome identified by a stable reason code.
+
+    Instances are created once at import time and shared by every request with that outcome. The body
+    is serialized up front and the headers are the read-only :data:`~lopper.response.DEFAULT_HEADERS`,
+    so returning one allocates nothing. Use :meth:`~lopper.response.FixedResponse.with_headers` to get
+    a regular response with a copy of the headers to change.
+    """
+    def __init__(self, reason: str, message: str, status_code: int = DEFAULT_STATUS_CODE):
+        body = json.dumps(dict(message=message, status_code=status_code, reason=reason), separators=(',', ':'))
+        for name, value in (('reason', reason), ('message', message), ('body', body),
+                            ('headers', DEFAULT_HEADERS), ('status_code', status_code)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable and shared, use with_headers() to copy it'.format(
+            self.__class__.__name__))
+
+    def with_headers(self, headers: dict) -> Response:
+        """
+        Create a regular response with the same body and a copy of the headers updated with the given ones.
+
+        :param headers: HTTP headers to add or replace
+        :type headers: :class:`~dict`
+        :return: Mutable response object
+        :rtype: :class:`~lopper.response.Response`
+        """
+        return Response(self.body, dict(self.headers, **headers), self.status_code)
+
+
+def fixed(reason: str, message: str, status_code: int = DEFAULT_STATUS_CODE) -> FixedResponse:
+    """
+    Create the shared :class:`~lopper.response.FixedResponse` of a fixed outcome.
+
+    :param reason: Stable reason code of the outcome, e.g. "pull_request_not_merged"
+    :type reason: :class:`~str`
+    :param message: Human readable response message indicating what happened
+    :type message: :class:`~str`
+    :param status_code: HTTP status code of the response; default: 200
+    :type status_code: :class:`~int`
+    :return: Immutable response object
+    :rtype: :class:`~lopper.response.FixedResponse`
+    """
+    return FixedResponse(reason, message, status_code)
 
 
 def response(message, status_code: int = DEFAULT_STATUS_CODE, headers: dict = DEFAULT_HEADERS):
@@ -44,7 +93,7 @@ def response(message, status_code: int = DEFAULT_STATUS_CODE, headers: dict = DE
     :return: Response object containing HTTP metadata.
     :rtype: :class:`~looper.response.Response`
     """
-    headers['Content-Type'] = 'application/json'
+    headers = dict(headers, **DEFAULT_HEADERS)
     return Response(dict(message=message, status_code=status_code), headers, status_code)
 
 
@@ -52,10 +101,22 @@ def response(message, status_code: int = DEFAULT_STATUS_CODE, headers: dict = DE
 success = functools.partial(response, status_code=200)
 
 
+#: Function partial for creating '202 Accepted' HTTP responses.
+accepted = functools.partial(response, status_code=202)
+
+
 #: Function partial for creating '401 Unauthorized' HTTP responses.
 unauthorized = functools.partial(response, status_code=401)
 
 
+#: Function partial for creating '404 Not Found' HTTP responses.
+not_found = functools.partial(response, status_code=404)
+
+
+#: Function partial for creating '413 Payload Too Large' HTTP responses.
+payload_too_large = functools.partial(response, status_code=413)
+
+
 #: Function partial for creating '422 Unprocessable Entity' HTTP responses.
 unprocessable_entity = functools.partial(response, status_code=422)
 
@@ -64,12 +125,20 @@ unprocessable_entity = functools.partial(response, status_code=422)
 server_error = functools.partial(response, status_code=500)
 
 
+#: Function partial for creating '503 Service Unavailable' HTTP responses.
+service_unavailable = functools.partial(response, status_code=503)
+
+
 #: Mapping for converting a numeric HTTP static code to the appropriate response partial function.
 PARTIAL_BY_STATUS = {
     200: success,
+    202: accepted,
     401: unauthorized,
+    404: not_found,
+    413: payload_too_large,
     422: unprocessable_entity,
-    500: server_error
+    500: server_error,
+    503: service_unavailable
 }
 
 
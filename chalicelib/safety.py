@@ -0,0 +1,226 @@
+"""
+    lopper/safety
+    ~~~~~~~~~~~~~
+
+    Contains functionality for deciding if a merged head branch is safe to delete.
+"""
+import collections
+import functools
+import threading
+import time
+import typing
+
+from chalicelib import response
+
+
+#: Default number of seconds the protected branches and open pull requests of a repository are trusted.
+DEFAULT_TTL = 300
+
+
+#: Actions of "pull_request" events that open a pull request or change its branches.
+OPENING_ACTIONS = frozenset(('opened', 'reopened', 'edited'))
+
+
+#: Actions of "pull_request" events that keep the index current.
+OBSERVED_ACTIONS = OPENING_ACTIONS | {'closed'}
+
+
+#: Response for branches that are safe to delete.
+SAFE = response.fixed('branch_safe', 'Branch is safe to delete')
+
+
+#: Response for branches that are protected.
+PROTECTED = response.fixed('branch_protected', 'Received payload for pull request whose head branch is protected',
+                           422)
+
+
+#: Response for branches that are the head or base branch of another open pull request.
+OPEN_PULL_REQUEST = response.fixed('branch_in_use',
+                                   'Received payload for pull request whose head branch backs an open pull request',
+                                   422)
+
+
+class RepositoryState:
+    """
+    Protected branches and branches of open pull requests of a single repository.
+
+    Branches are reference counted by the open pull requests using them, so whether a branch is in use
+    is a single lookup. Head branches of pull requests from forks live in another repository and are
+    not counted.
+    """
+    def __init__(self, repo: str, protected: typing.Iterable[str], pulls: typing.Iterable[dict], expires_at: float):
+        self.repo = repo
+        self.protected = frozenset(protected)
+        self.expires_at = expires_at
+        self.pulls = {}
+        self.refs = collections.Counter()
+        for pull_request in pulls:
+            self.open(pull_request)
+
+    def check(self, ref: str) -> response.Response:
+        """
+        Determine if the branch is safe to delete: neither protected nor used by an open pull request.
+
+        :param ref: Branch name
+        :type: :class:`~str`
+        :return: Response object indicating if the branch is safe to delete
+        :rtype: :class:`~lopper.response.Response`
+        """
+        if ref in self.protected:
+            return PROTECTED
+        if self.refs[ref] > 0:
+            return OPEN_PULL_REQUEST
+        return SAFE
+
+    def open(self, pull_request: dict) -> None:
+        """
+        Record the branches of an opened, reopened or edited pull request.
+
+        :param pull_request: Raw pull request
+        :type: :class:`~dict`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        number = pull_request.get('number')
+        self.close(number)
+
+        head, base = pull_request.get('head') or {}, pull_request.get('base') or {}
+        refs = [base.get('ref')]
+        if (head.get('repo') or {}).get('full_name') == self.repo:
+            refs.append(head.get('ref'))
+        refs = tuple(ref for ref in refs if ref)
+        self.pulls[number] = refs
+        self.refs.update(refs)
+
+    def close(self, number: int) -> None:
+        """
+        Forget the branches of a closed pull request.
+
+        :param number: Number of the pull request
+        :type: :class:`~int`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        for ref in self.pulls.pop(number, ()):
+            self.refs[ref] -= 1
+            if self.refs[ref] <= 0:
+                del self.refs[ref]
+
+
+class SafetyIndex:
+    """
+    In-process index of the protected branches and open pull request branches of every repository
+    branches were deleted in.
+
+    A repository is loaded in bulk with paginated listings the first time one of its branches is checked,
+    kept current by the "pull_request" events the webhook receives, and loaded again once its TTL
+    expired, so checking a branch usually costs a dictionary lookup instead of API calls.
+    """
+    def __init__(self, ttl: float = DEFAULT_TTL):
+        self.ttl = ttl
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def check(self, api_access_token: str, repo: str, ref: str, base_url: str = None) -> response.Response:
+        """
+        Determine if the branch is safe to delete, loading the repository when it isn't indexed or expired.
+
+        :param api_access_token: Access token for GitHub API client used to load the repository
+        :type api_access_token: :class:`~str`
+        :param repo: GitHub repository that owns the ref
+        :type repo: :class:`~str`
+        :param ref: GitHub branch ref to delete
+        :type ref: :class:`~str`
+        :param base_url: Base URL of the GitHub API; default: :data:`~lopper.hub.DEFAULT_BASE_URL`
+        :type base_url: :class:`~str`
+        :return: Response object indicating if the branch is safe to delete
+        :rtype: :class:`~lopper.response.Response`
+        """
+        from chalicelib import hub
+
+        base_url = base_url or hub.DEFAULT_BASE_URL
+        with self._lock:
+            state = self._current(repo, time.monotonic())
+            if state is not None:
+                return state.check(ref)
+
+        try:
+            state = self.load(api_access_token, repo, base_url)
+        except hub.github.GithubException as e:
+            return response.partial_for_status(e.status)('Unable to load branches of "{}": {}'.format(repo, e))
+        except hub.CONNECTION_ERRORS as e:
+            return hub.unreachable(e)
+        return state.check(ref)
+
+    def load(self, api_access_token: str, repo: str, base_url: str) -> RepositoryState:
+        """
+        Load the protected branches and open pull requests of the repository and index them.
+
+        :param api_access_token: Access token for GitHub API client
+        :type api_access_token: :class:`~str`
+        :param repo: GitHub repository to load
+        :type repo: :class:`~str`
+        :param base_url: Base URL of the GitHub API
+        :type base_url: :class:`~str`
+        :return: Indexed state of the repository
+        :rtype: :class:`~lopper.safety.RepositoryState`
+        :raises: :class:`~github.GithubException` when a listing can't be fetched
+        """
+        from chalicelib import hub
+
+        expires_at = time.monotonic() + self.ttl
+        state = RepositoryState(repo, hub.iter_protected_branches(api_access_token, repo, base_url),
+                                hub.iter_open_pull_requests(api_access_token, repo, base_url), expires_at)
+        with self._lock:
+            self._states[repo] = state
+        return state
+
+    def observe(self, body: dict) -> None:
+        """
+        Apply a "pull_request" event to the index of its repository, if that is indexed.
+
+        :param body: Decoded request body of a "pull_request" event
+        :type: :class:`~dict`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        action = body.get('action')
+        pull_request = body.get('pull_request')
+        repo = (body.get('repository') or {}).get('full_name')
+        if action not in OBSERVED_ACTIONS or not pull_request or not repo:
+            return
+
+        with self._lock:
+            state = self._current(repo, time.monotonic())
+            if state is None:
+                return
+            if action in OPENING_ACTIONS:
+                state.open(pull_request)
+            else:
+                state.close(pull_request.get('number'))
+
+    def _current(self, repo: str, now: float) -> typing.Optional[RepositoryState]:
+        """
+        Retrieve the indexed state of the repository, dropping it when it expired.
+        """
+        state = self._states.get(repo)
+        if state is not None and state.expires_at <= now:
+            del self._states[repo]
+            return None
+        return state
+
+
+@functools.lru_cache(maxsize=None)
+def get_index(ttl: float = DEFAULT_TTL) -> SafetyIndex:
+    """
+    Retrieve the safety index for the given TTL, creating it once per process.
+
+    :param ttl: Number of seconds the state of a repository is trusted
+    :type: :class:`~float`
+    :return: Safety index instance
+    :rtype: :class:`~lopper.safety.SafetyIndex`
+    """
+    return SafetyIndex(ttl)
@@ -0,0 +1,450 @@
+"""
+    lopper/server
+    ~~~~~~~~~~~~~
+
+    Contains an ASGI application for running lopper as a long-lived server, e.g. next to GitHub Enterprise.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import typing
+
+from chalicelib import auth, batch, conf, dedup, installations, jobs, journal, metrics, payload, response, safety, \
+    shadow
+
+
+#: Path that webhooks are delivered to, the same as the route of the Lambda function.
+WEBHOOK_PATH = '/lopper'
+
+
+#: Default number of seconds to wait for queued deletions to finish when the server stops.
+DEFAULT_SHUTDOWN_TIMEOUT = 30.0
+
+
+#: Response for requests to any other path or method than webhook deliveries.
+NOT_FOUND = response.fixed('route_not_found', 'Only POST requests to "{}" are handled'.format(WEBHOOK_PATH), 404)
+
+
+#: Response for accepted deliveries while the deletion queue is full; GitHub redelivers them later.
+QUEUE_FULL = response.fixed('queue_full', 'Deletion queue is full', 503)
+
+
+#: Response for deliveries received while the server is stopping.
+STOPPING = response.fixed('server_stopping', 'Server is shutting down', 503)
+
+
+#: Logger of the server; the Lambda function logs through the Chalice application instead.
+log = logging.getLogger(__name__)
+
+
+class Server:
+    """
+    ASGI application that handles webhook deliveries on an event loop and deletes branches in the background.
+
+    Deliveries run through the same authentication, acceptance and deduplication as the Lambda function and
+    are answered with "202 Accepted" as soon as their deletion is queued. The queue is bounded, so a burst
+    of deliveries costs bounded memory and is answered with "503 Service Unavailable" once it is full.
+    A dispatcher task hands queued deletions to a :class:`~lopper.batch.Coalescer` that groups them by
+    repository and sends the batches on a thread pool sharing the pooled, rate limited GitHub API clients
+    of :mod:`~lopper.hub`. Writes to the journal and the deduplication database run on a separate storage
+    thread, so disk I/O neither blocks the event loop nor waits behind deletions. Stopping the server waits
+    for queued deletions to finish.
+    """
+    def __init__(self, configuration: conf.Configuration = None,
+                 shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        self.configuration = configuration
+        self.shutdown_timeout = shutdown_timeout
+        self.queue = None
+        self.accepting = False
+        self.stopped = False
+        self._executor = None
+        self._storage = None
+        self._reserved = 0
+        self._coalescer = None
+        self._tokens = None
+        self._in_flight = None
+        self._dispatcher = None
+
+    async def __call__(self, scope: dict, receive: typing.Callable, send: typing.Callable) -> None:
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        if self.queue is None and not self.stopped:
+            await self.start()
+        resp = await self.receive(scope, receive)
+        await _send_response(send, resp)
+
+    async def start(self) -> None:
+        """
+        Validate the configuration and start the worker tasks and their thread pool, unless they already run.
+
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        :raises: :class:`~RuntimeError` when any configuration values are invalid
+        """
+        from chalicelib import hub
+
+        if self.queue is not None:
+            return
+        configuration = self.configuration = self.configuration or conf.get()
+        hub.governor.configure(configuration.api_requests_per_second, configuration.api_request_burst,
+                               configuration.api_max_retries, configuration.api_max_rate_limit_wait)
+
+        self.queue = asyncio.Queue(configuration.server_queue_size)
+        self._executor = concurrent.futures.ThreadPoolExecutor(configuration.deletion_max_workers,
+                                                               thread_name_prefix='lopper')
+        self._storage = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='lopper-storage')
+        self._coalescer = batch.Coalescer(self._delete, configuration.coalesce_window,
+                                          configuration.coalesce_max_size, self._executor)
+        self._tokens = installations.from_configuration(configuration)
+        self._in_flight = asyncio.Semaphore(configuration.server_queue_size)
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+        self.accepting = True
+
+    async def stop(self) -> None:
+        """
+        Stop accepting deliveries, wait up to the shutdown timeout for queued deletions and stop the workers.
+
+        The dispatcher is cancelled and awaited before the thread pool shuts down, and the pool is shut down
+        off the event loop so the completions of its last deletions still run on the loop before it closes.
+
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        self.accepting = False
+        self.stopped = True
+        if self.queue is None:
+            return
+
+        # Send open and further batches right away instead of waiting for their window.
+        self._coalescer.window = 0
+        self._coalescer.flush()
+        try:
+            await asyncio.wait_for(self.queue.join(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            log.warning('Stopped with %d deletions still queued', self.queue.qsize())
+
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, return_exceptions=True)
+        self._coalescer.flush()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+        # Let the completions the pool threads scheduled on the loop run before the queue is dropped.
+        await asyncio.sleep(0)
+        await loop.run_in_executor(None, self._storage.shutdown)
+        self.queue, self._dispatcher = None, None
+
+    async def receive(self, scope: dict, receive: typing.Callable) -> response.Response:
+        """
+        Read a single HTTP request and handle it if it's a webhook delivery.
+
+        :param scope: ASGI connection scope
+        :type: :class:`~dict`
+        :param receive: ASGI callable to receive the request body with
+        :type: :class:`~collections.Callable`
+        :return: Response object of the request
+        :rtype: :class:`~lopper.response.Response`
+        """
+        if scope['method'] != 'POST' or scope['path'] != WEBHOOK_PATH:
+            return NOT_FOUND
+        if not self.accepting:
+            return STOPPING
+
+        max_payload_size = self.configuration.webhook_max_payload_size
+        body = await _read_body(receive, max_payload_size)
+        if body is None:
+            return response.payload_too_large('Request payload exceeds {} bytes'.format(max_payload_size))
+
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        return await self.handle(headers, body)
+
+    async def handle(self, headers: typing.Dict[str, str], body: bytes) -> response.Response:
+        """
+        Run a webhook delivery through every stage of the webhook pipeline and queue its deletion.
+
+        :param headers: HTTP headers of the delivery with lowercase names
+        :type: :class:`~dict`
+        :param body: Raw request body
+        :type: :class:`~bytes`
+        :return: Response object of the first stage that rejected the delivery or of queueing its deletion
+        :rtype: :class:`~lopper.response.Response`
+        """
+        configuration = self.configuration
+        collector = metrics.start(configuration.metrics_sink, configuration.metrics_namespace,
+                                  dict(Function=configuration.application_name))
+        resp = await self._handle(headers, body, configuration, collector)
+        collector.finish(resp.status_code)
+        return resp
+
+    async def _handle(self, headers: typing.Dict[str, str], body: bytes, configuration: conf.Configuration,
+                      collector) -> response.Response:
+        """
+        Run a webhook delivery through the stages of the pipeline, timing each stage with the given collector.
+        """
+        with collector.time('Authentication'):
+            signature = headers.get('x-hub-signature-256') or headers.get('x-hub-signature')
+            if not signature:
+                return auth.MISSING_SIGNATURE
+            route = configuration.secrets.route_for(headers.get('x-github-hook-id'), body)
+            resp = auth.is_authentic(signature, body, route.secrets, configuration.webhook_max_payload_size)
+        if not resp:
+            return resp
+
+        with collector.time('Event'):
+            event = headers.get('x-github-event')
+            resp = payload.is_acceptable_event(event, body) if event else payload.MISSING_EVENT
+        if not resp:
+            if resp is payload.NOT_CLOSED and configuration.safety_ttl:
+                with collector.time('Safety'):
+                    self._observe(body, route)
+            return resp
+
+        with collector.time('Parse'):
+            content_type = headers.get('content-type', '')
+            data = payload.parse(body) if content_type.startswith('application/json') else None
+        if not data:
+            return payload.INVALID_BODY
+        event = payload.extract(data)
+        if not configuration.secrets.authorizes(route, event):
+            return auth.OWNER_MISMATCH
+        if configuration.safety_ttl:
+            safety.get_index(configuration.safety_ttl).observe(data)
+
+        with collector.time('Acceptance'):
+            rule, resp = payload.match_rule(event, configuration.policy)
+        if not resp:
+            return resp
+
+        with collector.time('Deduplication'):
+            keys = dedup.keys_for(headers.get('x-github-delivery'), event)
+            if configuration.dedup_cache_size:
+                claim = self._deduplicator().claim
+                if not (await self._store(claim, keys) if configuration.dedup_database else claim(keys)):
+                    return dedup.ALREADY_PROCESSED
+
+        with collector.time('Processing'):
+            job = jobs.for_event(event, configuration.policy.key(rule))
+            if configuration.dry_run:
+                return shadow.record(job)
+            # Deliveries whose journal entry is still being written hold a place in the queue.
+            if self.queue.qsize() + self._reserved >= self.queue.maxsize:
+                self._forget(keys)
+                return QUEUE_FULL
+            entries = self._journal()
+            self._reserved += 1
+            try:
+                entry_id = await self._store(entries.accept, job) if entries else None
+            finally:
+                self._reserved -= 1
+            self.queue.put_nowait((job, keys, entry_id))
+        return response.accepted('Queued deletion of "{}" from repository "{}"'.format(job.ref, job.repo))
+
+    async def _dispatch(self) -> None:
+        """
+        Hand queued jobs to the coalescer until cancelled, keeping at most a queue size of them in flight.
+        """
+        configuration, tokens = self.configuration, self._tokens
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._in_flight.acquire()
+            job, keys, entry_id = await self.queue.get()
+            try:
+                if tokens is None or job.installation is None:
+                    api_access_token = jobs.token_for(job, configuration.policy, configuration.api_access_token)
+                else:
+                    # Creating the access token of an installation calls the GitHub API, so keep it off the loop.
+                    api_access_token = await loop.run_in_executor(self._executor, jobs.token_for, job,
+                                                                  configuration.policy, configuration.api_access_token,
+                                                                  tokens)
+            except RuntimeError as e:
+                future = loop.create_future()
+                future.set_exception(e)
+            else:
+                future = asyncio.wrap_future(self._coalescer.submit(api_access_token, job.repo, job.ref))
+            future.add_done_callback(functools.partial(self._complete, job, keys, entry_id))
+
+    def _complete(self, job: jobs.Job, keys: typing.List[str], entry_id: typing.Optional[str],
+                  future: asyncio.Future) -> None:
+        """
+        Mark a queued job as done, record its outcome in the journal and forget its delivery if the deletion failed.
+        """
+        self._in_flight.release()
+        self.queue.task_done()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            log.error('Unable to delete "%s" from repository "%s"', job.ref, job.repo, exc_info=error)
+            self._forget(keys)
+            return
+        resp = future.result()
+        jobs.release_token(job, resp, self._tokens)
+        if entry_id:
+            self._defer(self._journal().complete, entry_id, resp.status_code)
+        if resp.status_code >= 500:
+            self._forget(keys)
+
+    def _delete(self, api_access_token: str, branches: typing.List[typing.Tuple[str, str]]) -> typing.List[
+            response.Response]:
+        """
+        Delete a batch of branches of one repository, skipping those the safety index knows are still in use.
+        """
+        from chalicelib import hub
+
+        configuration = self.configuration
+        index = safety.get_index(configuration.safety_ttl) if configuration.safety_ttl else None
+        responses = [None] * len(branches)
+        positions = []
+        for position, (repo, ref) in enumerate(branches):
+            resp = index.check(api_access_token, repo, ref, configuration.api_base_url) if index else None
+            if resp is None or resp:
+                positions.append(position)
+            else:
+                responses[position] = resp
+
+        deleted = hub.delete_branches(api_access_token, [branches[position] for position in positions],
+                                      configuration.deletion_max_workers, configuration.api_base_url,
+                                      configuration.deletion_mode)
+        for position, resp in zip(positions, deleted):
+            responses[position] = resp
+        return responses
+
+    async def _store(self, function: typing.Callable, *args) -> typing.Any:
+        """
+        Call a function that reads or writes the journal or deduplication database on the storage thread.
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._storage, function, *args)
+
+    def _defer(self, function: typing.Callable, *args) -> None:
+        """
+        Call a function that writes the journal or deduplication database on the storage thread without waiting.
+        """
+        self._storage.submit(function, *args).add_done_callback(_log_storage_error)
+
+    def _observe(self, body: bytes, route: auth.Route) -> None:
+        """
+        Apply a delivery that opened or changed a pull request to the index of branches in use, if the
+        secrets of the route that verified it may sign for its owners.
+        """
+        if payload.scan_action(body) in safety.OPENING_ACTIONS:
+            data = payload.parse(body)
+            if data and self.configuration.secrets.authorizes(route, payload.extract(data)):
+                safety.get_index(self.configuration.safety_ttl).observe(data)
+
+    def _journal(self):
+        """
+        Retrieve the journal of the configuration, if any.
+        """
+        return journal.get_journal(self.configuration.journal) if self.configuration.journal else None
+
+    def _deduplicator(self) -> dedup.Deduplicator:
+        """
+        Retrieve the deduplicator of the configuration.
+        """
+        configuration = self.configuration
+        return dedup.get_deduplicator(configuration.dedup_cache_size, configuration.dedup_ttl,
+                                      configuration.dedup_database)
+
+    def _forget(self, keys: typing.List[str]) -> None:
+        """
+        Forget the keys of a delivery that wasn't processed so its redelivery is.
+        """
+        configuration = self.configuration
+        if configuration.dedup_cache_size and configuration.dedup_database:
+            self._defer(self._deduplicator().release, keys)
+        elif configuration.dedup_cache_size:
+            self._deduplicator().release(keys)
+
+    async def _lifespan(self, receive: typing.Callable, send: typing.Callable) -> None:
+        """
+        Start and stop the server with the ASGI lifespan protocol.
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.start()
+                except RuntimeError as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def _read_body(receive: typing.Callable, max_size: int) -> typing.Optional[bytes]:
+    """
+    Read the request body, giving up as soon as it exceeds the maximum size.
+
+    :return: Request body or None if it's too large
+    """
+    chunks, size, more = [], 0, True
+    while more:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > max_size:
+            return None
+        chunks.append(chunk)
+        more = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+def _log_storage_error(future: concurrent.futures.Future) -> None:
+    """
+    Log the error of a deferred write to the journal or deduplication database, if any.
+    """
+    error = future.exception()
+    if error is not None:
+        log.error('Unable to write to the journal or deduplication database', exc_info=error)
+
+
+async def _send_response(send: typing.Callable, resp: response.Response) -> None:
+    """
+    Send the response with the ASGI protocol, serializing its body unless it's pre-serialized.
+    """
+    body = resp.body if isinstance(resp.body, str) else json.dumps(resp.body, separators=(',', ':'))
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in resp.headers.items()]
+    await send({'type': 'http.response.start', 'status': resp.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body.encode()})
+
+
+#: ASGI application to serve with any ASGI server, e.g. "uvicorn chalicelib.server:application".
+application = Server()
+
+
+def main(argv: typing.List[str] = None) -> int:
+    """
+    Command line entry point to serve the application with uvicorn.
+
+    :param argv: Command line arguments; default: :data:`~sys.argv`
+    :type: :class:`~list`
+    :return: Process exit code
+    :rtype: :class:`~int`
+    :raises: :class:`~RuntimeError` when uvicorn is not installed
+    """
+    parser = argparse.ArgumentParser(description='Serve the lopper webhook as a long-lived process.')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    args = parser.parse_args(argv)
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError('Running the server requires uvicorn to be installed')
+
+    uvicorn.run(application, host=args.host, port=args.port, lifespan='on', log_level='info')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,192 @@
+"""
+    lopper/shadow
+    ~~~~~~~~~~~~~
+
+    Contains functionality for evaluating the policy without deleting branches, either live in dry run mode or
+    offline against captured webhook payloads.
+"""
+import collections
+import json
+import logging
+import os
+import typing
+
+from chalicelib import jobs, metrics, payload, policy, response
+
+
+#: File name extensions of captured payloads; ".json" files hold a single payload and ".jsonl" files one per line.
+EXTENSIONS = ('.json', '.jsonl')
+
+
+#: Default number of repositories with the most intended deletions that are reported.
+DEFAULT_TOP = 10
+
+
+#: Policy of the processes evaluating captured payloads, set by :func:`~lopper.shadow._initialize`.
+_rules = None
+
+
+log = logging.getLogger(__name__)
+
+
+def record(job: jobs.Job) -> response.Response:
+    """
+    Record the intended deletion of a job accepted in dry run mode instead of deleting its branch.
+
+    The deletion is logged and, when metrics are enabled, counted as "IntendedDeletions" with the job added
+    as properties of the metric document of the request.
+
+    :param job: Accepted job
+    :type: :class:`~lopper.jobs.Job`
+    :return: Response object describing the intended deletion
+    :rtype: :class:`~lopper.response.Response`
+    """
+    collector = metrics.active()
+    collector.count('IntendedDeletions')
+    collector.annotate(IntendedRepository=job.repo, IntendedRef=job.ref, IntendedRule=job.rule)
+    log.info('Dry run: would delete "%s" from repository "%s" (rule %s)', job.ref, job.repo, job.rule)
+    return response.success('Dry run: would delete "{}" from repository "{}"'.format(job.ref, job.repo))
+
+
+def reason_for(resp: response.Response) -> str:
+    """
+    Retrieve the decision of a policy evaluation as a short, stable label.
+
+    :param resp: Response object of evaluating a payload
+    :type: :class:`~lopper.response.Response`
+    :return: Reason code of fixed responses or the message of rejections by the patterns of a rule
+    :rtype: :class:`~str`
+    """
+    return getattr(resp, 'reason', None) or resp.body['message']
+
+
+def iter_files(path: str) -> typing.Iterator[str]:
+    """
+    Find the files of captured payloads in a directory tree, in a stable order.
+
+    :param path: Directory to search or a single file of captured payloads
+    :type: :class:`~str`
+    :return: Iterator of file paths
+    :rtype: :class:`~collections.Iterator`
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+def evaluate_file(path: str, rules: policy.Policy) -> typing.Tuple[collections.Counter, collections.Counter]:
+    """
+    Evaluate every captured payload of a file against the policy.
+
+    :param path: Path of a ".json" file with a single payload or a ".jsonl" file with one payload per line
+    :type: :class:`~str`
+    :param rules: Policy of compiled rules to evaluate the payloads with
+    :type: :class:`~lopper.policy.Policy`
+    :return: Tuple of counters of decisions and of intended deletions per repository
+    :rtype: :class:`~tuple`
+    """
+    decisions = collections.Counter()
+    deletions = collections.Counter()
+    with open(path, 'rb') as f:
+        for raw_payload in (f if path.endswith('.jsonl') else [f.read()]):
+            if not raw_payload.strip():
+                continue
+            body = payload.parse(raw_payload)
+            if not body:
+                decisions[payload.INVALID_BODY.reason] += 1
+                continue
+            event = payload.extract(body)
+            rule, resp = payload.match_rule(event, rules)
+            decisions[reason_for(resp)] += 1
+            if rule is not None:
+                deletions[event.head_repo] += 1
+    return decisions, deletions
+
+
+def evaluate(paths: typing.Iterable[str], rules: policy.Policy,
+             processes: int = None) -> typing.Tuple[collections.Counter, collections.Counter]:
+    """
+    Evaluate the captured payloads of many files against the policy, one file at a time per CPU core.
+
+    :param paths: Paths of files of captured payloads, see :func:`~lopper.shadow.iter_files`
+    :type: :class:`~collections.Iterable`
+    :param rules: Policy of compiled rules to evaluate the payloads with
+    :type: :class:`~lopper.policy.Policy`
+    :param processes: Number of worker processes; default: number of CPU cores, 1 evaluates in this process
+    :type: :class:`~int`
+    :return: Tuple of counters of decisions and of intended deletions per repository
+    :rtype: :class:`~tuple`
+    """
+    if processes == 1:
+        return _total(evaluate_file(path, rules) for path in paths)
+
+    import multiprocessing
+
+    with multiprocessing.Pool(processes, _initialize, (rules,)) as pool:
+        return _total(pool.imap_unordered(_evaluate_file, paths))
+
+
+def _total(results: typing.Iterable[typing.Tuple[collections.Counter, collections.Counter]]):
+    """
+    Add up the counters of decisions and intended deletions of evaluated files.
+    """
+    decisions = collections.Counter()
+    deletions = collections.Counter()
+    for file_decisions, file_deletions in results:
+        decisions.update(file_decisions)
+        deletions.update(file_deletions)
+    return decisions, deletions
+
+
+def _initialize(rules: policy.Policy) -> None:
+    """
+    Keep the policy in a worker process so it's not sent along with every file.
+    """
+    global _rules
+
+    _rules = rules
+
+
+def _evaluate_file(path: str) -> typing.Tuple[collections.Counter, collections.Counter]:
+    """
+    Evaluate a file of captured payloads against the policy of the worker process.
+    """
+    return evaluate_file(path, _rules)
+
+
+def main(argv: typing.List[str] = None) -> int:
+    """
+    Command line entry point to evaluate captured webhook payloads against the configured policy and print
+    decision statistics.
+
+    :param argv: Command line arguments; default: :data:`~sys.argv`
+    :type: :class:`~list`
+    :return: Process exit code
+    :rtype: :class:`~int`
+    """
+    import argparse
+
+    from chalicelib import conf
+
+    parser = argparse.ArgumentParser(description='Evaluate captured webhook payloads without deleting branches.')
+    parser.add_argument('path', help='Directory (or file) of captured payloads as .json or .jsonl files')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+                        help='Number of repositories with the most intended deletions to report')
+    args = parser.parse_args(argv)
+
+    configuration = conf.get()
+    decisions, deletions = evaluate(iter_files(args.path), configuration.policy, args.processes)
+    print(json.dumps(dict(events=sum(decisions.values()), intended_deletions=sum(deletions.values()),
+                          decisions=dict(decisions.most_common()), repositories=dict(deletions.most_common(args.top))),
+                     indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
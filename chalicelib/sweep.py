@@ -0,0 +1,285 @@
+"""
+    lopper/sweep
+    ~~~~~~~~~~~~
+
+    Contains functionality for deleting the head branches of pull requests merged in the past.
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import typing
+
+from chalicelib import hub, payload, policy, safety
+
+
+#: Number of branch deletions collected before they are sent to the API.
+DELETION_CHUNK_SIZE = 100
+
+
+class Checkpoint:
+    """
+    Progress of previous sweeps, stored as a JSON file, used to only examine pull requests updated since.
+
+    For every completely swept repository the ``updated_at`` timestamp of its most recently updated
+    closed pull request is recorded.
+    """
+    def __init__(self, path: str = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._since = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._since = json.load(f)
+
+    def since(self, repo: str) -> typing.Optional[str]:
+        """
+        Retrieve the timestamp up to which the repository was swept.
+
+        :param repo: GitHub repository full name
+        :type: :class:`~str`
+        :return: ISO 8601 timestamp or None if the repository was never swept completely
+        :rtype: :class:`~str`
+        """
+        return self._since.get(repo)
+
+    def complete(self, repo: str, updated_at: typing.Optional[str]) -> None:
+        """
+        Record that the repository was swept up to the given timestamp and persist the checkpoint.
+
+        :param repo: GitHub repository full name
+        :type: :class:`~str`
+        :param updated_at: ISO 8601 timestamp of the most recently updated pull request that was examined
+        :type: :class:`~str`
+        :return: Nothing
+        :rtype: :class:`~NoneType`
+        """
+        if not updated_at:
+            return
+        with self._lock:
+            self._since[repo] = updated_at
+            if self.path:
+                tmp = '{}.tmp'.format(self.path)
+                with open(tmp, 'w') as f:
+                    json.dump(self._since, f)
+                os.replace(tmp, self.path)
+
+
+def sweep(owners: typing.Iterable[str], rules: policy.Policy, api_access_token: str,
+          api_base_url: str = hub.DEFAULT_BASE_URL, checkpoint: Checkpoint = None, max_workers: int = 4,
+          deletion_workers: int = hub.DEFAULT_MAX_WORKERS, deadline: float = None,
+          deletion_mode: str = hub.REST, index: safety.SafetyIndex = None) -> collections.Counter:
+    """
+    Delete the head branches of previously merged pull requests that the policy accepts.
+
+    Repositories of the given owners are swept concurrently; the repository listing is streamed and only
+    advanced as fast as repositories are swept. Pull requests are streamed page by page and only head
+    branches that still exist are deleted.
+
+    :param owners: Logins of the organizations or users to sweep the repositories of
+    :type: :class:`~collections.Iterable`
+    :param rules: Policy to match merged pull requests against
+    :type: :class:`~lopper.policy.Policy`
+    :param api_access_token: Access token for GitHub API client used for listings and rules without a token
+    :type api_access_token: :class:`~str`
+    :param api_base_url: Base URL of the GitHub API
+    :type api_base_url: :class:`~str`
+    :param checkpoint: Progress of previous sweeps to resume from
+    :type: :class:`~lopper.sweep.Checkpoint`
+    :param max_workers: Maximum number of repositories swept concurrently
+    :type: :class:`~int`
+    :param deletion_workers: Maximum number of concurrent deletions per repository
+    :type: :class:`~int`
+    :param deadline: Value of :func:`~time.monotonic` after which no further repository is started
+    :type: :class:`~float`
+    :param deletion_mode: Deletion mode, :data:`~lopper.hub.REST` or :data:`~lopper.hub.GRAPHQL`
+    :type: :class:`~str`
+    :param index: Safety index the repositories are loaded into; default: a new one for this sweep
+    :type: :class:`~lopper.safety.SafetyIndex`
+    :return: Counter of repositories, pull requests and deleted, unsafe or failed branches
+    :rtype: :class:`~collections.Counter`
+    """
+    checkpoint = checkpoint or Checkpoint()
+    index = safety.SafetyIndex() if index is None else index
+    repositories = iter_repositories(owners, rules, api_access_token, api_base_url)
+
+    def sweep_one(repository):
+        if deadline is not None and time.monotonic() > deadline:
+            return collections.Counter(skipped=1)
+        return sweep_repository(repository, rules, api_access_token, api_base_url, checkpoint, deletion_workers,
+                                deletion_mode, index)
+
+    counts = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Only list further repositories once a worker is free, instead of the whole listing up front.
+        futures = set()
+        for repository in repositories:
+            if len(futures) >= max_workers:
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    counts.update(future.result())
+            futures.add(executor.submit(sweep_one, repository))
+        for future in concurrent.futures.as_completed(futures):
+            counts.update(future.result())
+    return counts
+
+
+def iter_repositories(owners: typing.Iterable[str], rules: policy.Policy, api_access_token: str,
+                      api_base_url: str = hub.DEFAULT_BASE_URL) -> typing.Iterator[dict]:
+    """
+    Stream the raw repositories of the given owners that any rule of the policy matches.
+
+    Archived repositories are skipped since their branches can't be deleted.
+
+    :param owners: Logins of the organizations or users to list the repositories of
+    :type: :class:`~collections.Iterable`
+    :param rules: Policy to match repositories against
+    :type: :class:`~lopper.policy.Policy`
+    :param api_access_token: Access token for GitHub API client
+    :type api_access_token: :class:`~str`
+    :param api_base_url: Base URL of the GitHub API
+    :type api_base_url: :class:`~str`
+    :return: Iterator of raw repositories
+    :rtype: :class:`~collections.Iterator`
+    """
+    for owner in owners:
+        for repository in hub.iter_repositories(api_access_token, owner, api_base_url):
+            login = (repository.get('owner') or {}).get('login')
+            if not repository.get('archived') and rules.matches_repository(login, repository.get('name')):
+                yield repository
+
+
+def sweep_repository(repository: dict, rules: policy.Policy, api_access_token: str,
+                     api_base_url: str = hub.DEFAULT_BASE_URL, checkpoint: Checkpoint = None,
+                     deletion_workers: int = hub.DEFAULT_MAX_WORKERS,
+                     deletion_mode: str = hub.REST, index: safety.SafetyIndex = None) -> collections.Counter:
+    """
+    Delete the existing head branches of merged pull requests of a single repository that the policy accepts.
+
+    Each closed pull request updated since the checkpoint is examined with the same predicates as webhook
+    payloads first; the branches of the repository are only listed when any of them is accepted. Like the
+    webhook, branches that are protected or back an open pull request are kept; the protected branches and
+    open pull requests of the repository are loaded once its first existing candidate branch is found, since
+    the state indexed for webhooks may be older than the sweep. The checkpoint is only advanced when every
+    deletion succeeded so failures are retried by the next sweep.
+
+    :param repository: Raw repository to sweep
+    :type: :class:`~dict`
+    :param rules: Policy to match merged pull requests against
+    :type: :class:`~lopper.policy.Policy`
+    :param api_access_token: Access token for GitHub API client used for listings and rules without a token
+    :type api_access_token: :class:`~str`
+    :param api_base_url: Base URL of the GitHub API
+    :type api_base_url: :class:`~str`
+    :param checkpoint: Progress of previous sweeps to resume from
+    :type: :class:`~lopper.sweep.Checkpoint`
+    :param deletion_workers: Maximum number of concurrent deletions
+    :type: :class:`~int`
+    :param deletion_mode: Deletion mode, :data:`~lopper.hub.REST` or :data:`~lopper.hub.GRAPHQL`
+    :type: :class:`~str`
+    :param index: Safety index the repository is loaded into; default: a new one
+    :type: :class:`~lopper.safety.SafetyIndex`
+    :return: Counter of pull requests and deleted, unsafe or failed branches
+    :rtype: :class:`~collections.Counter`
+    """
+    checkpoint = checkpoint or Checkpoint()
+    index = safety.SafetyIndex() if index is None else index
+    repo = repository['full_name']
+    since = checkpoint.since(repo)
+    counts = collections.Counter(repositories=1)
+
+    candidates = {}
+    newest = None
+    for pull_request in hub.iter_closed_pull_requests(api_access_token, repo, api_base_url):
+        updated_at = pull_request.get('updated_at')
+        newest = newest or updated_at
+        if since and updated_at and updated_at <= since:
+            break
+        counts['pull_requests'] += 1
+
+        event = payload.extract(dict(action='closed', repository=repository, pull_request=pull_request))
+        ref = event.head_ref
+        # Several pull requests can share a head branch; only delete it once.
+        if ref in candidates or event.head_repo != repo:
+            continue
+
+        rule, _ = payload.match_rule(event, rules)
+        if rule is not None:
+            candidates[ref] = rule
+
+    if not candidates:
+        checkpoint.complete(repo, newest)
+        return counts
+
+    branches = set(hub.iter_branches(api_access_token, repo, api_base_url))
+    pending = collections.defaultdict(list)
+    state = None
+
+    def flush(token):
+        refs = pending.pop(token)
+        responses = hub.delete_branches(token, [(repo, ref) for ref in refs], deletion_workers, api_base_url,
+                                        deletion_mode)
+        for resp in responses:
+            counts['deleted' if resp else 'failed'] += 1
+
+    for ref, rule in candidates.items():
+        if ref not in branches:
+            continue
+        if state is None:
+            try:
+                state = index.load(api_access_token, repo, api_base_url)
+            except hub.github.GithubException:
+                counts['failed'] += 1
+                return counts
+        if not state.check(ref):
+            counts['unsafe'] += 1
+            continue
+        token = rule.token or api_access_token
+        pending[token].append(ref)
+        if len(pending[token]) >= DELETION_CHUNK_SIZE:
+            flush(token)
+
+    for token in list(pending):
+        flush(token)
+
+    if not counts['failed']:
+        checkpoint.complete(repo, newest)
+    return counts
+
+
+def main(argv: typing.List[str] = None) -> int:
+    """
+    Command line entry point to sweep the repositories of the configured or given owners.
+
+    :param argv: Command line arguments; default: :data:`~sys.argv`
+    :type: :class:`~list`
+    :return: Process exit code
+    :rtype: :class:`~int`
+    """
+    from chalicelib import conf
+
+    parser = argparse.ArgumentParser(description='Delete head branches of previously merged pull requests.')
+    parser.add_argument('--owner', action='append', default=[], help='Organization or user to sweep')
+    parser.add_argument('--checkpoint', default=conf.BACKFILL_CHECKPOINT_FILE, help='Path of the checkpoint file')
+    parser.add_argument('--workers', type=int, default=conf.BACKFILL_MAX_WORKERS,
+                        help='Number of repositories swept concurrently')
+    args = parser.parse_args(argv)
+
+    configuration = conf.get()
+    if not configuration.api_access_token:
+        parser.error('a Github API access token is required to sweep repositories')
+    hub.governor.configure(configuration.api_requests_per_second, configuration.api_request_burst,
+                           configuration.api_max_retries, configuration.api_max_rate_limit_wait)
+    owners = args.owner or sorted(set(configuration.backfill_owners) | configuration.policy.owners)
+    counts = sweep(owners, configuration.policy, configuration.api_access_token, configuration.api_base_url,
+                   Checkpoint(args.checkpoint), args.workers, configuration.deletion_max_workers,
+                   deletion_mode=configuration.deletion_mode)
+    print(json.dumps(counts, sort_keys=True))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
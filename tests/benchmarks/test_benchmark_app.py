@@ -0,0 +1,175 @@
+"""
+    test/benchmarks/benchmark_app
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Load benchmarks of the webhook handler of the :mod:`~app` module.
+"""
+import collections
+import copy
+import hashlib
+import hmac
+import itertools
+import json
+import random
+import uuid
+
+import pytest
+from chalice.test import Client
+
+import app
+from chalicelib import conf, metrics
+
+from tests.conftest import MERGED_PULL_REQUEST_PAYLOAD
+
+
+#: Secret token the generated deliveries are signed with.
+SECRET = b'benchmark-secret'
+
+
+#: Relative share of every kind of delivery in each event mix.
+EVENT_MIXES = {
+    'rejections': dict(opened=5, synchronize=3, labeled=1, issues=1),
+    'merges': dict(merged=1),
+    'mixed': dict(opened=3, synchronize=2, closed=1, merged=3, forged=1)
+}
+
+
+#: Number of distinct deliveries generated per benchmark; they are sent round robin.
+DELIVERY_COUNT = 200
+
+
+#: Percentiles reported for every stage.
+PERCENTILES = (0.5, 0.99)
+
+
+def generate_deliveries(mix: str, count: int, size: int, secret: bytes = SECRET, seed: int = 0):
+    """
+    Generate signed webhook deliveries, as (headers, body) pairs, of the kinds and shares of the given mix.
+
+    The description of every pull request is padded so each body is about ``size`` bytes large. Merged
+    pull requests all have their own head branch and merge commit.
+    """
+    rng = random.Random(seed)
+    kinds = [kind for kind, share in sorted(EVENT_MIXES[mix].items()) for _ in range(share)]
+    deliveries = []
+    for index in range(count):
+        kind = rng.choice(kinds)
+        payload = copy.deepcopy(MERGED_PULL_REQUEST_PAYLOAD)
+        pull_request = payload['pull_request']
+        pull_request['number'] = payload['number'] = index
+        pull_request['head']['ref'] = 'feature-{}'.format(index)
+        pull_request['merge_commit_sha'] = hashlib.sha1(str(index).encode()).hexdigest()
+        if kind in ('opened', 'synchronize', 'labeled'):
+            payload['action'] = kind
+            pull_request.update(state='open', merged_at=None, merge_commit_sha=None)
+        elif kind == 'closed':
+            pull_request['merged_at'] = None
+        pull_request['body'] = ''
+        pull_request['body'] = 'x' * max(0, size - len(json.dumps(payload)))
+
+        body = json.dumps(payload).encode()
+        key = b'forged' if kind == 'forged' else secret
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': 'issues' if kind == 'issues' else 'pull_request',
+            'X-GitHub-Delivery': str(uuid.UUID(int=rng.getrandbits(128))),
+            'X-Hub-Signature-256': 'sha256=' + hmac.new(key, body, hashlib.sha256).hexdigest()
+        }
+        deliveries.append((headers, body))
+    return deliveries
+
+
+def percentile(values, fraction: float) -> float:
+    """
+    Retrieve the nearest-rank percentile of the given values.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def stage_report(documents) -> dict:
+    """
+    Aggregate the metric documents of the handled requests into percentiles per stage and status counts.
+    """
+    timings = collections.defaultdict(list)
+    statuses = collections.Counter()
+    for document in documents:
+        statuses[str(document['StatusCode'])] += 1
+        for name, value in document.items():
+            if name.endswith('Time') or (name == 'ApiLatency' and document['ApiCalls']):
+                timings[name].append(value)
+
+    stages = {}
+    for name, values in timings.items():
+        stages[name] = dict(count=len(values), **{'p{}'.format(int(p * 100)): percentile(values, p)
+                                                  for p in PERCENTILES})
+    return dict(stages=stages, statuses=dict(statuses))
+
+
+@pytest.fixture(scope='function')
+def webhook_client(fake_github, monkeypatch):
+    """
+    Fixture that yields a Chalice test client of the app, configured against the fake API with metrics
+    collected to memory.
+    """
+    monkeypatch.setattr(conf, 'API_ACCESS_TOKEN', 'token')
+    monkeypatch.setattr(conf, 'API_BASE_URL', fake_github.base_url)
+    monkeypatch.setattr(conf, 'API_REQUESTS_PER_SECOND', 0)
+    monkeypatch.setattr(conf, 'WEBHOOK_SECRET_TOKEN', SECRET)
+    monkeypatch.setattr(conf, 'WEBHOOK_PREVIOUS_SECRET_TOKEN', b'')
+    monkeypatch.setattr(conf, 'DELETION_QUEUE', None)
+    monkeypatch.setattr(conf, 'DEDUP_CACHE_SIZE', 0)
+    monkeypatch.setattr(conf, 'METRICS_SINK', 'memory')
+    monkeypatch.setattr(conf, '_snapshot', None)
+    fake_github.refs.update(('octo/repo', 'feature-{}'.format(i)) for i in range(DELIVERY_COUNT))
+
+    sink = metrics.get_sink('memory')
+    sink.documents.clear()
+    with Client(app.app) as client:
+        yield client
+    sink.documents.clear()
+
+
+def run_load(benchmark, client, deliveries):
+    """
+    Benchmark sending the deliveries round robin to the handler and report throughput and stage percentiles
+    in the extra info of the benchmark.
+    """
+    deliveries = itertools.cycle(deliveries)
+
+    def request():
+        headers, body = next(deliveries)
+        return client.http.post('/lopper', headers=headers, body=body)
+
+    benchmark(request)
+
+    report = stage_report(metrics.get_sink('memory').documents)
+    if benchmark.stats:
+        report['requests_per_second'] = 1 / benchmark.stats.stats.mean
+    benchmark.extra_info.update(report)
+    return report
+
+
+@pytest.mark.parametrize('size', [2 * 1024, 64 * 1024])
+@pytest.mark.parametrize('mix', sorted(EVENT_MIXES))
+def test_handler(benchmark, webhook_client, mix, size):
+    """
+    Benchmark the handler with deliveries of the given event mix and size against a fast API.
+    """
+    deliveries = generate_deliveries(mix, DELIVERY_COUNT, size)
+    report = run_load(benchmark, webhook_client, deliveries)
+    assert 'AuthenticationTime' in report['stages']
+    assert '500' not in report['statuses']
+
+
+def test_handler_slow_unreliable_api(benchmark, webhook_client, fake_github):
+    """
+    Benchmark the handler with mixed deliveries against an API with latency that fails some deletions.
+    """
+    fake_github.latency = 0.002
+    fake_github.error_rate = 0.1
+    deliveries = generate_deliveries('mixed', DELIVERY_COUNT, 8 * 1024)
+    report = run_load(benchmark, webhook_client, deliveries)
+    # A single delivery, e.g. with benchmarks disabled, may be a rejection that never calls the API.
+    if benchmark.stats:
+        assert report['stages']['ApiLatency']['p50'] >= 2
@@ -0,0 +1,52 @@
+"""
+    test/benchmarks/benchmark_auth
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks for the :mod:`~lopper/auth` module.
+"""
+import os
+
+import pytest
+
+from chalicelib import auth
+
+
+#: Shared secret token used to sign benchmark payloads.
+SECRET_TOKEN = b'super-secret-token-string'
+
+
+#: Payload sizes in bytes from a small pull request event up to the largest payloads GitHub sends.
+PAYLOAD_SIZES = [1024, 32 * 1024, 1024 * 1024, 25 * 1024 * 1024]
+
+
+@pytest.mark.parametrize('algorithm', ['sha256', 'sha1'])
+@pytest.mark.parametrize('size', PAYLOAD_SIZES)
+def test_is_authentic(benchmark, size, algorithm):
+    """
+    Benchmark :func:`~lopper.auth.is_authentic` verifying valid signatures of payloads of the given size.
+    """
+    payload = os.urandom(size)
+    signature = auth._signature(payload, SECRET_TOKEN, algorithm)
+
+    assert benchmark(auth.is_authentic, signature, payload, SECRET_TOKEN)
+
+
+@pytest.mark.parametrize('size', PAYLOAD_SIZES)
+def test_is_authentic_forged_signature(benchmark, size):
+    """
+    Benchmark :func:`~lopper.auth.is_authentic` rejecting forged signatures of payloads of the given size.
+    """
+    payload = os.urandom(size)
+    signature = 'sha256={}'.format('0' * 64)
+
+    assert not benchmark(auth.is_authentic, signature, payload, SECRET_TOKEN)
+
+
+def test_is_authentic_oversized_payload(benchmark):
+    """
+    Benchmark :func:`~lopper.auth.is_authentic` rejecting a payload over the maximum size without hashing it.
+    """
+    payload = os.urandom(PAYLOAD_SIZES[-1] + 1)
+    signature = auth._signature(payload, SECRET_TOKEN, 'sha256')
+
+    assert not benchmark(auth.is_authentic, signature, payload, SECRET_TOKEN, PAYLOAD_SIZES[-1])
@@ -0,0 +1,47 @@
+"""
+    test/benchmarks/benchmark_hub
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks for the :mod:`~lopper/hub` module.
+"""
+import pytest
+
+from chalicelib import hub
+
+
+@pytest.fixture(scope='function', autouse=True)
+def unpaced(monkeypatch):
+    """
+    Fixture that disables pacing of the rate limit governor so benchmarks measure the requests themselves.
+    """
+    monkeypatch.setattr(hub.governor, 'rate', 0)
+
+
+def test_delete_branch_pooled_client(benchmark, fake_github):
+    """
+    Benchmark :func:`~lopper.hub.delete_branch` reusing the pooled client across invocations.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+
+    def delete():
+        resp = hub.delete_branch('token', 'octo/repo', 'feature', base_url=fake_github.base_url)
+        assert resp
+
+    benchmark(delete)
+    assert fake_github.connections == 1
+
+
+def test_delete_branch_fresh_client(benchmark, fake_github):
+    """
+    Benchmark the baseline of building a new client (and connection) for every deletion.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+
+    def delete():
+        hub.reset_clients()
+        resp = hub.delete_branch('token', 'octo/repo', 'feature', base_url=fake_github.base_url)
+        assert resp
+
+    benchmark(delete)
+    if benchmark.stats:
+        assert fake_github.connections > 1
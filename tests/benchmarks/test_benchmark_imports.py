@@ -0,0 +1,64 @@
+"""
+    test/benchmarks/benchmark_imports
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks for the cold start import cost of the :mod:`~app` module.
+"""
+import os
+import subprocess
+import sys
+
+
+#: Modules that must not be imported when the function starts since only deletions or command line tools need them.
+DEFERRED_MODULES = ('github', 'requests', 'urllib3', 'jwt', 'sqlite3', 'argparse', 'multiprocessing',
+                    'chalicelib.hub', 'chalicelib.sweep')
+
+
+#: Maximum cumulative import time, in microseconds, of the app module excluding the Chalice framework.
+IMPORT_TIME_BUDGET = 50000
+
+
+#: Number of interpreters started; the fastest one is measured to reduce noise.
+ROUNDS = 3
+
+
+def import_times(module: str) -> dict:
+    """
+    Import the module in a fresh interpreter and return the cumulative import time of every imported module.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            cwd=root, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_app_import_defers_github():
+    """
+    Assert that importing the app does not import PyGithub or other modules only needed for deletions.
+    """
+    times = import_times('app')
+    assert 'app' in times
+    assert [name for name in DEFERRED_MODULES if name in times] == []
+
+
+def test_app_import_time(benchmark):
+    """
+    Assert that the cold start import cost of the app, excluding Chalice itself, stays within budget.
+    """
+    costs = []
+
+    def start():
+        times = import_times('app')
+        costs.append(times['app'] - times.get('chalice', 0))
+
+    benchmark.pedantic(start, rounds=ROUNDS, iterations=1)
+    benchmark.extra_info['app_import_time_us'] = min(costs)
+    assert min(costs) < IMPORT_TIME_BUDGET
@@ -0,0 +1,42 @@
+"""
+    test/benchmarks/benchmark_metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks for the :mod:`~lopper/metrics` module.
+"""
+from chalicelib import metrics
+
+
+def test_disabled_hooks(benchmark):
+    """
+    Benchmark the instrumentation hooks of a request while metrics are disabled.
+    """
+    def request():
+        collector = metrics.start(None)
+        for stage in ('Configuration', 'Authentication', 'Event', 'Parse', 'Acceptance'):
+            with collector.time(stage):
+                pass
+        metrics.active().api_call(0.1, 204)
+        collector.finish(200)
+
+    benchmark(request)
+    if benchmark.stats:
+        assert benchmark.stats.stats.median < 0.00001
+
+
+def test_enabled_hooks(benchmark):
+    """
+    Benchmark the instrumentation hooks of a request while metrics are collected to memory.
+    """
+    sink = metrics.MemorySink()
+
+    def request():
+        collector = metrics.Collector(sink)
+        for stage in ('Configuration', 'Authentication', 'Event', 'Parse', 'Acceptance'):
+            with collector.time(stage):
+                pass
+        metrics.active().api_call(0.1, 204)
+        collector.finish(200)
+        sink.documents.clear()
+
+    benchmark(request)
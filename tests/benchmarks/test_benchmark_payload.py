@@ -0,0 +1,58 @@
+"""
+    test/benchmarks/benchmark_payload
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks for the :mod:`~lopper/payload` module.
+"""
+import json
+
+from chalicelib import payload, policy
+
+
+def test_is_acceptable_payload(benchmark, merged_payload):
+    """
+    Benchmark the per-payload filtering cost of :func:`~lopper.payload.is_acceptable_payload`.
+    """
+    filters = policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',))
+    rules = policy.Policy.from_filters(filters)
+    assert benchmark(payload.is_acceptable_payload, merged_payload, rules)
+
+
+def test_extract(benchmark, merged_payload):
+    """
+    Benchmark pulling the record of a merged pull request event out of its payload with :func:`~lopper.payload.extract`.
+    """
+    assert benchmark(payload.extract, merged_payload).head_ref == 'feature'
+
+
+def test_match_rule(benchmark, merged_payload):
+    """
+    Benchmark matching the record of a merged pull request event with :func:`~lopper.payload.match_rule`.
+    """
+    rules = policy.Policy.from_filters(policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',)))
+    event = payload.extract(merged_payload)
+    rule, resp = benchmark(payload.match_rule, event, rules)
+    assert resp
+
+
+def test_is_acceptable_payload_many_rules(benchmark, merged_payload):
+    """
+    Benchmark :func:`~lopper.payload.is_acceptable_payload` against a policy with thousands of repository rules.
+    """
+    defaults = policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',))
+    rules = [(defaults, 'org-{}'.format(i // 100), 'repo-{}'.format(i)) for i in range(5000)]
+    rules.append((defaults, 'octo', 'repo'))
+    rules = policy.Policy(rules)
+    assert benchmark(payload.is_acceptable_payload, merged_payload, rules)
+    if benchmark.stats:
+        assert benchmark.stats.stats.median < 0.001
+
+
+def test_is_acceptable_event_large_irrelevant_payload(benchmark, merged_payload):
+    """
+    Benchmark rejecting a large pull request event that was not closed without decoding it.
+    """
+    merged_payload['action'] = 'synchronize'
+    merged_payload['pull_request']['body'] = 'x' * 512 * 1024
+    raw_payload = json.dumps(merged_payload).encode()
+    assert not benchmark(payload.is_acceptable_event, 'pull_request', raw_payload)
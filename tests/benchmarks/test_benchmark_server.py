@@ -0,0 +1,44 @@
+"""
+    test/benchmarks/benchmark_server
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks for the :mod:`~lopper/server` module.
+"""
+import asyncio
+
+from chalicelib import server
+
+from tests.test_server import configuration, delivery, request  # noqa: F401
+
+
+def test_server_rejection(benchmark, configuration, merged_payload):  # noqa: F811
+    """
+    Benchmark an ASGI request for a delivery of a pull request that was opened, the bulk of webhook traffic.
+    """
+    app = server.Server(configuration)
+    headers, body = delivery(dict(merged_payload, action='opened'))
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(app.start())
+
+    status, _ = benchmark(lambda: loop.run_until_complete(request(app, headers, body)))
+    assert status == 422
+    if benchmark.stats:
+        assert benchmark.stats.stats.median < 0.001
+
+    loop.run_until_complete(app.stop())
+    loop.close()
+
+
+def test_server_accepted(benchmark, configuration, merged_payload):  # noqa: F811
+    """
+    Benchmark an ASGI request for a delivery of a merged pull request whose deletion is queued.
+    """
+    app = server.Server(configuration._replace(server_queue_size=1000000))
+    headers, body = delivery(merged_payload)
+    loop = asyncio.new_event_loop()
+    app.queue = asyncio.Queue(1000000)
+    app.accepting = True
+
+    status, _ = benchmark(lambda: loop.run_until_complete(request(app, headers, body)))
+    assert status == 202
+    loop.close()
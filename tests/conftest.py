@@ -0,0 +1,266 @@
+"""
+    test/conftest
+    ~~~~~~~~~~~~~
+
+    Shared fixtures for the test and benchmark suites.
+"""
+import copy
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+from chalicelib import hub
+
+
+#: Minimal payload of a GitHub "pull_request" webhook event for a merged pull request.
+MERGED_PULL_REQUEST_PAYLOAD = {
+    'action': 'closed',
+    'number': 1,
+    'pull_request': {
+        'number': 1,
+        'state': 'closed',
+        'merged_at': '2017-01-01T00:00:00Z',
+        'merge_commit_sha': 'e5bd3914e2e596debea16f433f57875b5b90bcd6',
+        'head': {
+            'ref': 'feature',
+            'repo': {'name': 'repo', 'full_name': 'octo/repo', 'owner': {'login': 'octo'}}
+        },
+        'base': {
+            'ref': 'master',
+            'repo': {'name': 'repo', 'full_name': 'octo/repo', 'owner': {'login': 'octo'}}
+        }
+    },
+    'repository': {'name': 'repo', 'full_name': 'octo/repo', 'owner': {'login': 'octo'}}
+}
+
+
+@pytest.fixture(scope='function')
+def merged_payload():
+    """
+    Fixture that yields a fresh copy of a payload for a merged pull request.
+    """
+    return copy.deepcopy(MERGED_PULL_REQUEST_PAYLOAD)
+
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Request handler that mimics the subset of the GitHub REST API used by lopper.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.fake.connections += 1
+
+    def log_message(self, format, *args):
+        return
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, verb):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        with fake.lock:
+            fake.requests.append((verb, self.path))
+            fake.authorizations.append(self.headers.get('Authorization'))
+            failure = fake.failures.pop(0) if fake.failures else None
+            if not failure and fake.error_rate and fake.random.random() < fake.error_rate:
+                failure = fake.error
+        if fake.latency:
+            time.sleep(fake.latency)
+        if failure:
+            status, message, *headers = failure
+            return self._send(status, dict(message=message), *headers)
+
+        path, _, query = self.path.partition('?')
+        query = urllib.parse.parse_qs(query)
+        owner_repos = re.match(r'^/(orgs|users)/(?P<owner>[^/]+)/repos$', path)
+        branches = re.match(r'^/repos/(?P<repo>[^/]+/[^/]+)/branches$', path)
+        pulls = re.match(r'^/repos/(?P<repo>[^/]+/[^/]+)/pulls$', path)
+        repo = re.match(r'^/repos/(?P<repo>[^/]+/[^/]+)$', self.path)
+        ref = re.match(r'^/repos/(?P<repo>[^/]+/[^/]+)/git/refs/heads/(?P<ref>.+)$', self.path)
+        access_tokens = re.match(r'^/app/installations/(?P<id>\d+)/access_tokens$', path)
+
+        if verb == 'POST' and path == '/graphql':
+            return self._send(200, fake.graphql(json.loads(body)))
+        if verb == 'POST' and access_tokens:
+            return self._send(201, fake.access_token(int(access_tokens.group('id'))))
+        if verb == 'GET' and owner_repos and owner_repos.group('owner') in fake.repositories:
+            return self._send_page(path, query, fake.repositories[owner_repos.group('owner')])
+        if verb == 'GET' and branches:
+            refs = fake.protected if query.get('protected') == ['true'] else fake.refs
+            names = sorted(name for repo_name, name in refs if repo_name == branches.group('repo'))
+            return self._send_page(path, query, [dict(name=name) for name in names])
+        if verb == 'GET' and pulls:
+            state = query.get('state', ['open'])[0]
+            items = [pull for pull in fake.pulls.get(pulls.group('repo'), [])
+                     if state == 'all' or pull.get('state', 'closed') == state]
+            return self._send_page(path, query, items)
+
+        if verb == 'GET' and repo:
+            url = '{}/repos/{}'.format(fake.base_url, repo.group('repo'))
+            return self._send(200, dict(full_name=repo.group('repo'), url=url))
+        if ref and (ref.group('repo'), ref.group('ref')) in fake.refs:
+            if verb == 'GET':
+                url = '{}{}'.format(fake.base_url, self.path)
+                return self._send(200, dict(ref='refs/heads/{}'.format(ref.group('ref')), url=url))
+            if verb == 'DELETE':
+                fake.deleted.append((ref.group('repo'), ref.group('ref')))
+                return self._send(204, None)
+        if ref and verb == 'DELETE':
+            return self._send(422, dict(message='Reference does not exist'))
+        return self._send(404, dict(message='Not Found'))
+
+    def _send_page(self, path, query, items):
+        per_page = int(query.get('per_page', ['30'])[0])
+        page = int(query.get('page', ['1'])[0])
+        headers = {}
+        if page * per_page < len(items):
+            query = dict(query, per_page=[per_page], page=[page + 1])
+            headers['Link'] = '<{}{}?{}>; rel="next"'.format(
+                self.server.fake.base_url, path, urllib.parse.urlencode(query, doseq=True))
+        return self._send(200, items[(page - 1) * per_page:page * per_page], headers)
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeGitHub:
+    """
+    Local HTTP stand-in for the GitHub REST API.
+
+    Pull requests without a ``state`` are listed as closed; ``protected`` holds the (repo, branch) pairs
+    listed as protected branches.
+
+    Queued ``failures`` of (status, message) or (status, message, headers) are returned for the next
+    requests instead of their regular response. Every response is delayed by ``latency`` seconds and a
+    ``error_rate`` fraction of them is answered with the ``error`` failure.
+
+    The "Authorization" header of every request is recorded in ``authorizations`` and installation access
+    tokens are created as "installation-<id>-<n>", valid for ``token_lifetime`` seconds.
+    """
+    def __init__(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeGitHubHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.refs = set()
+        self.protected = set()
+        self.repositories = {}
+        self.pulls = {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.connections = 0
+        self.requests = []
+        self.authorizations = []
+        self.tokens_issued = 0
+        self.token_lifetime = 3600
+        self.deleted = []
+        self.failures = []
+        self.latency = 0
+        self.error_rate = 0
+        self.error = (422, 'Reference update failed')
+        self.random = random.Random(0)
+
+    def access_token(self, installation_id):
+        """
+        Create an access token of an installation as answered by "POST /app/installations/:id/access_tokens".
+        """
+        with self.lock:
+            self.tokens_issued += 1
+            token = 'installation-{}-{}'.format(installation_id, self.tokens_issued)
+        expires_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + self.token_lifetime))
+        return dict(token=token, expires_at=expires_at)
+
+    def graphql(self, request):
+        """
+        Answer the aliased ref lookup queries and ``deleteRef`` mutations sent by :mod:`~lopper.hub`.
+
+        Operations are told apart by their variables: lookups use "o<n>", "n<n>" and "q<n>" and return
+        "r<n>", mutations use "i<n>" and return "d<n>".
+        """
+        variables = request.get('variables') or {}
+        data, errors = {}, []
+        repositories = {repo for repo, _ in self.refs}
+        with self.lock:
+            for name, value in sorted(variables.items()):
+                index = name[1:]
+                if name.startswith('o'):
+                    alias = 'r{}'.format(index)
+                    repo = '{}/{}'.format(value, variables['n{}'.format(index)])
+                    ref = variables['q{}'.format(index)][len('refs/heads/'):]
+                    if repo not in repositories:
+                        data[alias] = None
+                        errors.append(dict(type='NOT_FOUND', path=[alias], message='Could not resolve to a Repository'))
+                    elif (repo, ref) in self.refs:
+                        data[alias] = dict(ref=dict(id='ref:{}:{}'.format(repo, ref)))
+                    else:
+                        data[alias] = dict(ref=None)
+                elif name.startswith('i'):
+                    alias = 'd{}'.format(index)
+                    repo, _, ref = value[len('ref:'):].partition(':')
+                    if (repo, ref) in self.protected:
+                        data[alias] = None
+                        errors.append(dict(type='UNPROCESSABLE', path=[alias],
+                                           message='Cannot delete protected branch'))
+                    else:
+                        self.deleted.append((repo, ref))
+                        data[alias] = dict(clientMutationId=None)
+        return dict(data=data, errors=errors) if errors else dict(data=data)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(scope='session')
+def fake_github_server():
+    """
+    Fixture that yields a running :class:`~FakeGitHub` server for the whole session.
+    """
+    fake = FakeGitHub()
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture(scope='function')
+def fake_github(fake_github_server):
+    """
+    Fixture that yields the running :class:`~FakeGitHub` server with clean state and an empty client registry.
+    """
+    fake_github_server.reset()
+    fake_github_server.refs.clear()
+    fake_github_server.protected.clear()
+    fake_github_server.repositories.clear()
+    fake_github_server.pulls.clear()
+    hub.reset_clients()
+    yield fake_github_server
+    hub.reset_clients()
@@ -0,0 +1,265 @@
+"""
+    test/test_app
+    ~~~~~~~~~~~~~
+
+    Tests for the :mod:`~app` module.
+"""
+import hashlib
+import hmac
+import json
+import types
+
+import pytest
+from chalice.app import SQSRecord
+
+import app
+from chalicelib import auth, conf, dedup, hub, jobs, journal, metrics, payload, response, safety
+
+
+@pytest.fixture(scope='function')
+def configuration(fake_github, monkeypatch):
+    """
+    Fixture that yields a valid configuration against the fake API that deletes branches while answering and
+    remembers processed events in a fresh deduplicator.
+    """
+    monkeypatch.setattr(conf, 'API_ACCESS_TOKEN', 'token')
+    monkeypatch.setattr(conf, 'WEBHOOK_SECRET_TOKEN', b'secret')
+    monkeypatch.setattr(conf, 'WEBHOOK_PREVIOUS_SECRET_TOKEN', b'')
+    # The app applies the rate limit settings of the configuration to the shared governor; restore them after.
+    for name in ('rate', 'burst', 'retries', 'max_wait'):
+        monkeypatch.setattr(hub.governor, name, getattr(hub.governor, name))
+    dedup.get_deduplicator.cache_clear()
+    yield conf.validate()._replace(api_base_url=fake_github.base_url, api_requests_per_second=0,
+                                   deletion_queue=None, dedup_cache_size=16, dedup_database=None, safety_ttl=0,
+                                   journal=None, dry_run=False)
+    dedup.get_deduplicator.cache_clear()
+
+
+def signed_request(body, secret=b'secret', event='pull_request', delivery='delivery-1'):
+    """
+    Build a request object of a signed webhook delivery of the given payload.
+    """
+    raw_body = body if isinstance(body, bytes) else json.dumps(body).encode()
+    signature = 'sha256=' + hmac.new(secret, raw_body, hashlib.sha256).hexdigest()
+    return types.SimpleNamespace(raw_body=raw_body, headers={
+        'Content-Type': 'application/json', 'X-GitHub-Event': event, 'X-GitHub-Delivery': delivery,
+        'X-Hub-Signature-256': signature})
+
+
+def handle(request, configuration):
+    """
+    Run the request through the webhook pipeline without collecting metrics.
+    """
+    return app.handle_request(request, configuration, metrics.NULL_COLLECTOR)
+
+
+def test_batch_item_failures_names_failed_jobs():
+    """
+    Assert that only the messages of jobs that failed with a server error are reported for redelivery.
+    """
+    records = [SQSRecord(dict(messageId='m{}'.format(i), receiptHandle='r{}'.format(i),
+                              body=jobs.dumps(jobs.Job('octo/repo', 'feature-{}'.format(i), None))), None)
+               for i in range(4)]
+    responses = [response.success('Deleted'), response.server_error('Boom'), response.not_found('Not Found'),
+                 response.service_unavailable('Rate limited')]
+
+    assert app.batch_item_failures(records, responses) == dict(
+        batchItemFailures=[dict(itemIdentifier='m1'), dict(itemIdentifier='m3')])
+    assert app.batch_item_failures(records[:1], responses[:1]) == dict(batchItemFailures=[])
+
+
+def test_handle_request_rejects_owner_outside_secret_route(fake_github, merged_payload, monkeypatch):
+    """
+    Assert that a request signed with the secret of one owner can't name the repository of another owner
+    in a duplicate "repository" key that is only seen once the payload is decoded.
+    """
+    monkeypatch.setattr(conf, 'API_ACCESS_TOKEN', 'token')
+    monkeypatch.setattr(conf, 'WEBHOOK_SECRET_TOKEN', b'secret')
+    secrets = auth.SecretRouter.from_document(dict(owners=dict(octo='octo-secret', mallory='mallory-secret')))
+    configuration = conf.validate()._replace(api_base_url=fake_github.base_url, secrets=secrets)
+    fake_github.refs.add(('octo/repo', 'feature'))
+
+    body = b'{"repository": {"full_name": "mallory/repo"}, ' + json.dumps(merged_payload).encode()[1:]
+    signature = 'sha256=' + hmac.new(b'mallory-secret', body, hashlib.sha256).hexdigest()
+    request = types.SimpleNamespace(raw_body=body, headers={
+        'Content-Type': 'application/json', 'X-GitHub-Event': 'pull_request', 'X-Hub-Signature-256': signature})
+
+    assert app.handle_request(request, configuration, metrics.NULL_COLLECTOR) is auth.OWNER_MISMATCH
+    assert fake_github.requests == []
+
+
+def test_handle_request_deletes_branch(configuration, fake_github, merged_payload):
+    """
+    Assert that a merged pull request is deleted once and its redelivery is answered as a duplicate.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+
+    assert handle(signed_request(merged_payload), configuration).status_code == 200
+    assert handle(signed_request(merged_payload), configuration) is dedup.ALREADY_PROCESSED
+    assert fake_github.deleted == [('octo/repo', 'feature')]
+
+
+def test_handle_request_forgets_failed_event(configuration, fake_github, merged_payload):
+    """
+    Assert that the redelivery of an event whose deletion failed with a server error is processed again.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.failures.append((502, 'Bad Gateway'))
+
+    assert handle(signed_request(merged_payload), configuration).status_code >= 500
+    assert handle(signed_request(merged_payload), configuration).status_code == 200
+    assert fake_github.deleted == [('octo/repo', 'feature')]
+
+
+def test_handle_request_forgets_event_when_processing_raises(configuration, fake_github, merged_payload,
+                                                             monkeypatch):
+    """
+    Assert that the redelivery of an event whose processing raised, e.g. when the deletion queue can't be
+    reached, is processed again instead of being answered as a duplicate.
+    """
+    class UnreachableQueue:
+        attempts = 0
+
+        def put(self, job):
+            self.attempts += 1
+            raise ConnectionError('Could not connect to the endpoint URL')
+
+    queue = UnreachableQueue()
+    monkeypatch.setattr(jobs, 'get_queue', lambda url: queue)
+    queued = configuration._replace(deletion_queue='sqs://lopper-deletions')
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            handle(signed_request(merged_payload), queued)
+    assert queue.attempts == 2
+
+
+class SQSClient:
+    """
+    Stub of the SQS client that records the bodies of sent messages.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody):
+        self.messages.append(MessageBody)
+        return dict(MessageId='m{}'.format(len(self.messages)))
+
+
+@pytest.fixture(scope='function')
+def sqs_queue(monkeypatch):
+    """
+    Fixture that yields the SQS deletion queue of the app, backed by a stubbed client.
+    """
+    queue = jobs.SQSQueue.__new__(jobs.SQSQueue)
+    queue.name, queue._url, queue._client = 'lopper-deletions', 'https://sqs.example.com/lopper-deletions', SQSClient()
+    monkeypatch.setattr(jobs, 'get_queue', lambda url: queue)
+    return queue
+
+
+def test_handle_request_enqueues_job(configuration, fake_github, merged_payload, sqs_queue):
+    """
+    Assert that a merged pull request is answered with '202 Accepted' in queue mode and its job is sent to the
+    deletion queue without calling the GitHub API.
+    """
+    queued = configuration._replace(deletion_queue='sqs://lopper-deletions')
+    resp = handle(signed_request(merged_payload), queued)
+
+    assert resp.status_code == 202
+    assert fake_github.requests == []
+    job = jobs.loads(sqs_queue._client.messages[0])
+    assert (job.repo, job.ref) == ('octo/repo', 'feature')
+    assert queued.policy.find(job.rule) is not None
+
+
+def test_worker_deletes_queued_jobs(configuration, fake_github, merged_payload, sqs_queue):
+    """
+    Assert that jobs enqueued by the handler are deleted by the queue worker and only failed ones are reported.
+    """
+    queued = configuration._replace(deletion_queue='sqs://lopper-deletions', api_max_retries=0, deletion_max_workers=1)
+    handle(signed_request(merged_payload), queued)
+    merged_payload['pull_request']['head']['ref'] = 'feature-2'
+    handle(signed_request(merged_payload, delivery='delivery-2'), queued)
+    fake_github.refs.update([('octo/repo', 'feature'), ('octo/repo', 'feature-2')])
+    fake_github.failures.append((500, 'Internal Server Error'))
+
+    records = [SQSRecord(dict(messageId='m{}'.format(i), receiptHandle='r{}'.format(i), body=body), None)
+               for i, body in enumerate(sqs_queue._client.messages)]
+    assert app.process_records(records, queued) == dict(batchItemFailures=[dict(itemIdentifier='m0')])
+    assert fake_github.deleted == [('octo/repo', 'feature-2')]
+
+
+def test_handle_request_rejects_event_before_parsing(configuration, monkeypatch):
+    """
+    Assert that deliveries of other events and of pull requests that weren't closed are rejected from the
+    headers and a scan of the raw payload without decoding it.
+    """
+    def parse(raw_payload):
+        raise AssertionError('Payload was decoded')
+
+    monkeypatch.setattr(app.payload, 'parse', parse)
+    body = b'{"action": "opened", "number": 1, ' + b'"padding": "' + b'x' * 4096 + b'"'
+
+    assert handle(signed_request(body, event='push'), configuration) is payload.NOT_PULL_REQUEST
+    assert handle(signed_request(body), configuration) is payload.NOT_CLOSED
+    assert handle(signed_request(body, event=''), configuration) is payload.MISSING_EVENT
+
+
+def test_handle_request_keeps_branch_in_use(configuration, fake_github, merged_payload):
+    """
+    Assert that the handler checks the safety index before deleting and keeps protected head branches and
+    head branches that back another open pull request.
+    """
+    safety.get_index.cache_clear()
+    fake_github.refs.update([('octo/repo', 'feature'), ('octo/repo', 'hotfix')])
+    fake_github.protected.add(('octo/repo', 'feature'))
+    fake_github.pulls['octo/repo'] = [dict(number=2, state='open', head=dict(ref='next', repo=None),
+                                           base=dict(ref='hotfix'))]
+    checked = configuration._replace(safety_ttl=300)
+
+    try:
+        assert handle(signed_request(merged_payload), checked) is safety.PROTECTED
+        merged_payload['pull_request']['head']['ref'] = 'hotfix'
+        assert handle(signed_request(merged_payload, delivery='delivery-2'), checked) is safety.OPEN_PULL_REQUEST
+    finally:
+        safety.get_index.cache_clear()
+    assert fake_github.deleted == []
+
+
+def test_handle_request_journals_deletion(configuration, fake_github, merged_payload, tmpdir):
+    """
+    Assert that the handler journals every accepted deletion and completes its entry with the outcome, so only
+    failed deletions are left to replay.
+    """
+    url = 'sqlite://{}'.format(tmpdir.join('journal.db'))
+    journaled = configuration._replace(journal=url)
+    fake_github.refs.update([('octo/repo', 'feature'), ('octo/repo', 'feature-2')])
+
+    try:
+        assert handle(signed_request(merged_payload), journaled).status_code == 200
+        fake_github.failures.append((502, 'Bad Gateway'))
+        merged_payload['pull_request']['head']['ref'] = 'feature-2'
+        assert handle(signed_request(merged_payload, delivery='delivery-2'), journaled).status_code >= 500
+
+        pending = list(journal.get_journal(url).pending())
+    finally:
+        journal.get_journal.cache_clear()
+    assert [(entry.job.repo, entry.job.ref) for entry in pending] == [('octo/repo', 'feature-2')]
+
+
+def test_handle_request_dry_run(configuration, fake_github, merged_payload):
+    """
+    Assert that the handler only records the intended deletion of an accepted delivery in dry run mode, without
+    calling the GitHub API.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    sink = metrics.MemorySink()
+    collector = metrics.Collector(sink)
+    resp = app.handle_request(signed_request(merged_payload), configuration._replace(dry_run=True), collector)
+    collector.finish(resp.status_code)
+
+    assert resp.status_code == 200
+    assert resp.body['message'] == 'Dry run: would delete "feature" from repository "octo/repo"'
+    assert fake_github.requests == []
+    assert sink.documents[0]['IntendedDeletions'] == 1
+    assert (sink.documents[0]['IntendedRepository'], sink.documents[0]['IntendedRef']) == ('octo/repo', 'feature')
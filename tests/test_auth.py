@@ -4,11 +4,14 @@
 
     Tests for the :mod:`~lopper/auth` module.
 """
+import hashlib
+import hmac
 import random
 import string
 import pytest
 
 from chalicelib import auth
+from chalicelib import payload as payloads
 
 
 @pytest.fixture(scope='session')
@@ -64,3 +67,100 @@ def test_not_is_authenticate_with_different_secret_token(secret_token, random_se
 
     signature = auth._signature(random_payload_bytes, random_secret_token)
     assert not auth.is_authentic(signature, random_payload_bytes, secret_token)
+
+
+def test_is_authentic_with_sha256_signature(secret_token, random_payload_bytes):
+    """
+    Assert that :func:`~lopper.auth.is_authentic` verifies "X-Hub-Signature-256" SHA-256 signatures.
+    """
+    signature = auth._signature(random_payload_bytes, secret_token, 'sha256')
+    assert signature.startswith('sha256=')
+    assert auth.is_authentic(signature, random_payload_bytes, secret_token)
+
+
+def test_signature_of_chunked_payload(secret_token):
+    """
+    Assert that signatures of payloads spanning many chunks match a signature computed in one call.
+    """
+    payload = bytes(range(256)) * (auth.CHUNK_SIZE // 64 + 3)
+    expected = hmac.new(secret_token, payload, hashlib.sha256).hexdigest()
+    assert auth._signature(payload, secret_token, 'sha256') == 'sha256={}'.format(expected)
+
+
+@pytest.mark.parametrize('signature', ['md5=abcdef', 'sha256=not-hex', 'sha1', ''])
+def test_not_is_authentic_with_invalid_signature(signature, secret_token, random_payload_bytes):
+    """
+    Assert that :func:`~lopper.auth.is_authentic` rejects unsupported and malformed signatures.
+    """
+    resp = auth.is_authentic(signature, random_payload_bytes, secret_token)
+    assert not resp
+    assert resp.status_code == 401
+
+
+def test_not_is_authentic_with_oversized_payload(secret_token, random_payload_bytes):
+    """
+    Assert that :func:`~lopper.auth.is_authentic` rejects payloads over the maximum size.
+    """
+    signature = auth._signature(random_payload_bytes, secret_token, 'sha256')
+    resp = auth.is_authentic(signature, random_payload_bytes, secret_token, len(random_payload_bytes) - 1)
+    assert not resp
+    assert resp.status_code == 413
+
+
+def test_is_authentic_with_any_active_secret(secret_token, random_secret_token, random_payload_bytes):
+    """
+    Assert that :func:`~lopper.auth.is_authentic` accepts signatures created with any of the given secrets.
+    """
+    signature = auth._signature(random_payload_bytes, secret_token, 'sha256')
+    assert auth.is_authentic(signature, random_payload_bytes, (random_secret_token, secret_token))
+    assert not auth.is_authentic(signature, random_payload_bytes, (random_secret_token,))
+    assert not auth.is_authentic(signature, random_payload_bytes, ())
+
+
+def test_secret_router_routes_by_hook_and_owner():
+    """
+    Assert that :meth:`~lopper.auth.SecretRouter.route_for` prefers the webhook ID, then the repository owner.
+    """
+    router = auth.SecretRouter.from_document(dict(hooks={42: 'hook'}, owners=dict(octo=['new', 'old'])), (b'default',))
+    payload = b'{"action":"closed","repository":{"name":"repo","full_name":"octo/repo","owner":{"login":"octo"}}}'
+
+    assert router.route_for('42', payload) == ((b'hook',), None)
+    assert router.route_for('7', payload) == ((b'new', b'old'), frozenset(['octo']))
+    assert router.route_for(None, payload.replace(b'octo/', b'other/')) == ((b'default',), None)
+
+
+def test_secret_router_authorizes_owners_of_route():
+    """
+    Assert that :meth:`~lopper.auth.SecretRouter.authorizes` only lets the secrets of a route sign events of its
+    owners and those of the default or an unrestricted webhook route sign events of owners without secrets.
+    """
+    router = auth.SecretRouter.from_document(dict(hooks={42: 'hook', 7: dict(secrets='org', owners=['octo'])},
+                                                  owners=dict(octo='octo', victim='victim')), (b'default',))
+    event = payloads.MergeEvent(*([None] * len(payloads.MergeEvent._fields)))
+
+    def authorizes(route, owner, repo=None, head_repo=None):
+        return router.authorizes(route, event._replace(owner=owner, repo=repo or owner + '/repo',
+                                                       head_repo=head_repo or owner + '/repo'))
+
+    octo, default = router.owners['octo'], router.default
+    assert authorizes(octo, 'octo')
+    assert authorizes(octo, 'octo', head_repo='octo/fork')
+    assert not authorizes(octo, 'victim')
+    assert not authorizes(octo, 'octo', repo='victim/repo')
+    assert not authorizes(octo, 'octo', head_repo='victim/repo')
+    assert authorizes(router.hooks['7'], 'octo')
+    assert not authorizes(router.hooks['7'], 'other')
+    assert authorizes(router.hooks['42'], 'other')
+    assert not authorizes(router.hooks['42'], 'victim')
+    assert authorizes(default, 'other')
+    assert not authorizes(default, 'other', repo='victim/repo')
+
+
+@pytest.mark.parametrize('document', [['secret'], dict(hooks=['secret']), dict(owners=dict(octo='')),
+                                      dict(hooks={'7': dict(secrets='secret', owners='octo')})])
+def test_secret_router_rejects_malformed_document(document):
+    """
+    Assert that :meth:`~lopper.auth.SecretRouter.from_document` rejects malformed secrets sections.
+    """
+    with pytest.raises(RuntimeError):
+        auth.SecretRouter.from_document(document)
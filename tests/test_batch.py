@@ -0,0 +1,97 @@
+"""
+    test/test_batch
+    ~~~~~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/batch` module.
+"""
+import threading
+
+import pytest
+
+from chalicelib import batch, response
+
+
+class RecordingDeleter:
+    """
+    Deleter that records the batches it was called with and answers every branch with a success response.
+    """
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+        self.called = threading.Event()
+
+    def __call__(self, api_access_token, branches):
+        self.calls.append((api_access_token, branches))
+        self.called.set()
+        if self.error is not None:
+            raise self.error
+        return [response.success('Deleted {}'.format(ref)) for _, ref in branches]
+
+
+def test_coalescer_groups_deletions_within_window():
+    """
+    Assert that deletions of the same repository within the window are sent as one batch.
+    """
+    deleter = RecordingDeleter()
+    coalescer = batch.Coalescer(deleter, window=0.05)
+    futures = [coalescer.submit('token', 'octo/repo', ref) for ref in ('a', 'b', 'c')]
+    other = coalescer.submit('token', 'octo/other', 'd')
+    assert len(coalescer) == 4
+
+    messages = [future.result(timeout=5).body['message'] for future in futures]
+    assert messages == ['Deleted a', 'Deleted b', 'Deleted c']
+    assert other.result(timeout=5).body['message'] == 'Deleted d'
+    assert sorted(deleter.calls) == [('token', [('octo/other', 'd')]),
+                                     ('token', [('octo/repo', 'a'), ('octo/repo', 'b'), ('octo/repo', 'c')])]
+    assert len(coalescer) == 0
+
+
+def test_coalescer_sends_full_batch():
+    """
+    Assert that a batch is sent as soon as it reached the maximum size, without waiting for its window.
+    """
+    deleter = RecordingDeleter()
+    coalescer = batch.Coalescer(deleter, window=60, max_size=2)
+    futures = [coalescer.submit('token', 'octo/repo', ref) for ref in ('a', 'b', 'c')]
+
+    assert futures[0].done() and futures[1].done()
+    assert not futures[2].done()
+    coalescer.flush()
+    assert futures[2].result().body['message'] == 'Deleted c'
+    assert deleter.calls == [('token', [('octo/repo', 'a'), ('octo/repo', 'b')]), ('token', [('octo/repo', 'c')])]
+
+
+def test_coalescer_without_window_sends_immediately():
+    """
+    Assert that every deletion is sent on its own when the window is zero.
+    """
+    deleter = RecordingDeleter()
+    coalescer = batch.Coalescer(deleter, window=0)
+    assert coalescer.submit('token', 'octo/repo', 'a').done()
+    assert coalescer.submit('token', 'octo/repo', 'b').done()
+    assert deleter.calls == [('token', [('octo/repo', 'a')]), ('token', [('octo/repo', 'b')])]
+
+
+def test_coalescer_groups_by_token():
+    """
+    Assert that deletions of the same repository with different access tokens are not sent together.
+    """
+    deleter = RecordingDeleter()
+    coalescer = batch.Coalescer(deleter, window=60)
+    coalescer.submit('first', 'octo/repo', 'a')
+    coalescer.submit('second', 'octo/repo', 'b')
+    coalescer.flush()
+    assert sorted(deleter.calls) == [('first', [('octo/repo', 'a')]), ('second', [('octo/repo', 'b')])]
+
+
+def test_coalescer_propagates_errors():
+    """
+    Assert that an error while deleting a batch is raised by the future of every deletion in it.
+    """
+    deleter = RecordingDeleter(error=RuntimeError('boom'))
+    coalescer = batch.Coalescer(deleter, window=60)
+    futures = [coalescer.submit('token', 'octo/repo', ref) for ref in ('a', 'b')]
+    coalescer.flush()
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result()
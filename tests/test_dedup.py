@@ -0,0 +1,77 @@
+"""
+    test/dedup
+    ~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/dedup` module.
+"""
+import time
+
+from chalicelib import dedup, payload
+
+
+def test_keys_for(merged_payload):
+    """
+    Assert that :func:`~lopper.dedup.keys_for` identifies the merge and, if given, the delivery.
+    """
+    merge = 'merge:octo/repo:feature:e5bd3914e2e596debea16f433f57875b5b90bcd6'
+    event = payload.extract(merged_payload)
+    assert dedup.keys_for('delivery-1', event) == [merge, 'delivery:delivery-1']
+    assert dedup.keys_for(None, event) == [merge]
+
+
+def test_claim_rejects_repeated_keys():
+    """
+    Assert that :meth:`~lopper.dedup.Deduplicator.claim` only accepts an event whose keys were never seen.
+    """
+    deduplicator = dedup.Deduplicator()
+    assert deduplicator.claim(['merge:a', 'delivery:1'])
+    assert not deduplicator.claim(['merge:a', 'delivery:1'])
+    assert not deduplicator.claim(['merge:a', 'delivery:2'])
+    assert deduplicator.claim(['merge:b', 'delivery:3'])
+
+
+def test_claim_forgets_expired_keys(monkeypatch):
+    """
+    Assert that :class:`~lopper.dedup.Deduplicator` forgets keys once their TTL passed.
+    """
+    deduplicator = dedup.Deduplicator(ttl=60)
+    assert deduplicator.claim(['merge:a'])
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert deduplicator.claim(['merge:a'])
+
+
+def test_claim_evicts_least_recently_used():
+    """
+    Assert that :class:`~lopper.dedup.Deduplicator` bounds its cache and drops the oldest keys first.
+    """
+    deduplicator = dedup.Deduplicator(size=2)
+    for key in ('a', 'b', 'c'):
+        assert deduplicator.claim([key])
+    assert len(deduplicator) == 2
+    assert deduplicator.claim(['a'])
+    assert not deduplicator.claim(['c'])
+
+
+def test_release_allows_redelivery():
+    """
+    Assert that :meth:`~lopper.dedup.Deduplicator.release` lets a failed event be processed again.
+    """
+    deduplicator = dedup.Deduplicator()
+    assert deduplicator.claim(['merge:a'])
+    deduplicator.release(['merge:a'])
+    assert deduplicator.claim(['merge:a'])
+
+
+def test_sqlite_backend_survives_restart(tmpdir):
+    """
+    Assert that keys stored in the SQLite backend are recognized by a fresh deduplicator.
+    """
+    path = str(tmpdir.join('dedup.sqlite'))
+    assert dedup.Deduplicator(backend=dedup.SQLiteBackend(path)).claim(['merge:a'])
+
+    deduplicator = dedup.Deduplicator(backend=dedup.SQLiteBackend(path))
+    assert not deduplicator.claim(['merge:a'])
+    deduplicator.release(['merge:a'])
+    assert dedup.Deduplicator(backend=dedup.SQLiteBackend(path)).claim(['merge:a'])
@@ -0,0 +1,274 @@
+"""
+    test/hub
+    ~~~~~~~~
+
+    Tests for the :mod:`~lopper/hub` module.
+"""
+import time
+
+import pytest
+
+from chalicelib import hub, safety
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clean_registry():
+    """
+    Fixture that empties the client registry around each test.
+    """
+    hub.reset_clients()
+    yield
+    hub.reset_clients()
+
+
+def test_get_client_reuses_client_for_same_token():
+    """
+    Assert that :func:`~lopper.hub.get_client` returns the same client for repeated calls with one token.
+    """
+    assert hub.get_client('token-a') is hub.get_client('token-a')
+    assert hub.get_client('token-a') is not hub.get_client('token-b')
+
+
+def test_get_client_evicts_least_recently_used():
+    """
+    Assert that :func:`~lopper.hub.get_client` bounds the registry and drops the oldest token first.
+    """
+    first = hub.get_client('token-0')
+    for i in range(1, hub.CLIENT_REGISTRY_SIZE + 1):
+        hub.get_client('token-{}'.format(i))
+    assert hub.get_client('token-0') is not first
+
+
+def test_invalidate_client_drops_client():
+    """
+    Assert that :func:`~lopper.hub.invalidate_client` forces a new client on the next lookup.
+    """
+    client = hub.get_client('token-a')
+    hub.invalidate_client('token-a')
+    assert hub.get_client('token-a') is not client
+
+
+def test_delete_branch_reuses_connection(fake_github):
+    """
+    Assert that :func:`~lopper.hub.delete_branch` keeps connections alive across invocations.
+    """
+    fake_github.refs.update({('octo/repo', 'feature-1'), ('octo/repo', 'feature-2')})
+
+    assert hub.delete_branch('token', 'octo/repo', 'feature-1', base_url=fake_github.base_url)
+    assert hub.delete_branch('token', 'octo/repo', 'feature-2', base_url=fake_github.base_url)
+    assert fake_github.deleted == [('octo/repo', 'feature-1'), ('octo/repo', 'feature-2')]
+    assert fake_github.connections == 1
+
+
+def test_delete_branch_single_request(fake_github):
+    """
+    Assert that :func:`~lopper.hub.delete_branch` deletes the ref with a single API request.
+    """
+    fake_github.refs.add(('octo/repo', 'feature/nested'))
+
+    assert hub.delete_branch('token', 'octo/repo', 'feature/nested', base_url=fake_github.base_url)
+    assert fake_github.requests == [('DELETE', '/repos/octo/repo/git/refs/heads/feature/nested')]
+
+
+def test_delete_branch_missing_ref(fake_github):
+    """
+    Assert that :func:`~lopper.hub.delete_branch` maps a missing ref to an unprocessable entity response.
+    """
+    resp = hub.delete_branch('token', 'octo/repo', 'missing', base_url=fake_github.base_url)
+    assert not resp
+    assert resp.status_code == 422
+
+
+def test_delete_branch_missing_repository(fake_github):
+    """
+    Assert that :func:`~lopper.hub.delete_branch` maps a missing repository to a not found response instead of a
+    server error, so the deletion is not retried.
+    """
+    fake_github.failures.append((404, 'Not Found'))
+    resp = hub.delete_branch('token', 'octo/gone', 'feature', base_url=fake_github.base_url)
+    assert resp.status_code == 404
+
+
+def test_delete_branches_returns_response_per_branch(fake_github):
+    """
+    Assert that :func:`~lopper.hub.delete_branches` deletes concurrently and returns responses in order.
+    """
+    branches = [('octo/repo', 'feature-{}'.format(i)) for i in range(10)]
+    fake_github.refs.update(branches[:-1])
+
+    responses = hub.delete_branches('token', branches, max_workers=4, base_url=fake_github.base_url)
+    assert [resp.status_code for resp in responses] == [200] * 9 + [422]
+    assert sorted(fake_github.deleted) == sorted(branches[:-1])
+
+
+def test_delete_branches_retries_secondary_rate_limit(fake_github, monkeypatch):
+    """
+    Assert that :func:`~lopper.hub.delete_branches` pauses and retries when the secondary rate limit is hit.
+    """
+    monkeypatch.setattr(hub, 'SECONDARY_RATE_LIMIT_BACKOFF', 0.01)
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.failures.append((403, 'You have exceeded a secondary rate limit. '
+                                      'Please wait a few minutes before you try again.'))
+
+    responses = hub.delete_branches('token', [('octo/repo', 'feature')], base_url=fake_github.base_url)
+    assert [resp.status_code for resp in responses] == [200]
+    assert len(fake_github.requests) == 2
+
+
+def test_delete_branch_retries_server_error(fake_github, monkeypatch):
+    """
+    Assert that :func:`~lopper.hub.delete_branch` retries requests that failed with a transient server error.
+    """
+    monkeypatch.setattr(hub, 'RETRY_BACKOFF', 0.01)
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.failures.extend([(502, 'Bad Gateway'), (503, 'Service Unavailable')])
+
+    assert hub.delete_branch('token', 'octo/repo', 'feature', base_url=fake_github.base_url)
+    assert len(fake_github.requests) == 3
+
+
+def test_delete_branch_gives_up_after_retries(fake_github, monkeypatch):
+    """
+    Assert that :func:`~lopper.hub.delete_branch` returns a server error once all retries failed.
+    """
+    monkeypatch.setattr(hub, 'RETRY_BACKOFF', 0.01)
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.failures.extend([(500, 'Server Error')] * (hub.governor.retries + 1))
+
+    resp = hub.delete_branch('token', 'octo/repo', 'feature', base_url=fake_github.base_url)
+    assert resp.status_code == 500
+    assert len(fake_github.requests) == hub.governor.retries + 1
+
+
+def test_delete_branch_honors_retry_after(fake_github):
+    """
+    Assert that :func:`~lopper.hub.delete_branch` waits for the "Retry-After" header before retrying.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.failures.append((429, 'Too Many Requests', {'Retry-After': '0.1'}))
+
+    started = time.monotonic()
+    assert hub.delete_branch('token', 'octo/repo', 'feature', base_url=fake_github.base_url)
+    assert time.monotonic() - started >= 0.1
+    assert len(fake_github.requests) == 2
+
+
+def test_delete_branch_defers_exhausted_rate_limit(fake_github):
+    """
+    Assert that :func:`~lopper.hub.delete_branch` defers requests of a token whose rate limit resets too late.
+    """
+    fake_github.refs.update({('octo/repo', 'feature-1'), ('octo/repo', 'feature-2')})
+    reset = str(int(time.time() + hub.governor.max_wait + 60))
+    fake_github.failures.append((403, 'API rate limit exceeded', {'X-RateLimit-Remaining': '0',
+                                                                  'X-RateLimit-Reset': reset}))
+
+    resp = hub.delete_branch('token', 'octo/repo', 'feature-1', base_url=fake_github.base_url)
+    assert resp.status_code == 503
+    resp = hub.delete_branch('token', 'octo/repo', 'feature-2', base_url=fake_github.base_url)
+    assert resp.status_code == 503
+    assert len(fake_github.requests) == 1
+
+    assert hub.delete_branch('other-token', 'octo/repo', 'feature-2', base_url=fake_github.base_url)
+
+
+def test_delete_branch_without_waiting(fake_github):
+    """
+    Assert that requests answering a webhook delivery are neither retried nor held back by a rate limit.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.failures.extend([(502, 'Bad Gateway'), (429, 'Too Many Requests', {'Retry-After': '5'})])
+
+    started = time.monotonic()
+    with hub.without_waiting():
+        assert hub.delete_branch('token', 'octo/repo', 'feature', base_url=fake_github.base_url).status_code == 500
+        assert hub.delete_branch('token', 'octo/repo', 'feature', base_url=fake_github.base_url).status_code == 503
+        assert hub.delete_branch('token', 'octo/repo', 'feature', base_url=fake_github.base_url).status_code == 503
+    assert time.monotonic() - started < 1
+    assert len(fake_github.requests) == 2
+    assert not fake_github.deleted
+
+
+def test_delete_branch_unreachable_api():
+    """
+    Assert that connection errors that outlasted the retries are answered with a '503 Service Unavailable'
+    response instead of being raised.
+    """
+    base_url = 'http://127.0.0.1:9'
+    with hub.without_waiting():
+        resp = hub.delete_branch('token', 'octo/repo', 'feature', base_url=base_url)
+        assert not resp
+        assert resp.status_code == 503
+        responses = hub.delete_branches('token', [('octo/repo', 'feature')] * 2, base_url=base_url, mode=hub.GRAPHQL)
+        assert [resp.status_code for resp in responses] == [503, 503]
+        assert safety.SafetyIndex().check('token', 'octo/repo', 'feature', base_url).status_code == 503
+    hub.reset_clients()
+
+
+def test_governor_paces_requests():
+    """
+    Assert that :class:`~lopper.hub.RateLimitGovernor` paces requests of a key once its burst is used up.
+    """
+    governor = hub.RateLimitGovernor(rate=50, burst=2)
+
+    started = time.monotonic()
+    for _ in range(5):
+        governor.acquire('token')
+    assert time.monotonic() - started >= 0.05
+
+    started = time.monotonic()
+    governor.acquire('other-token')
+    assert time.monotonic() - started < 0.01
+
+
+@pytest.mark.parametrize('base_url,expected', [
+    ('https://api.github.com', 'https://api.github.com/graphql'),
+    ('https://github.example.com/api/v3', 'https://github.example.com/api/graphql'),
+    ('https://github.example.com/api/v3/', 'https://github.example.com/api/graphql'),
+])
+def test_graphql_url(base_url, expected):
+    """
+    Assert that the GraphQL endpoint is derived from the REST base URL of GitHub and GitHub Enterprise.
+    """
+    assert hub.graphql_url(base_url) == expected
+
+
+def test_delete_branches_graphql_batches_requests(fake_github, monkeypatch):
+    """
+    Assert that GraphQL deletion sends one lookup and one mutation per batch and a response per branch.
+    """
+    monkeypatch.setattr(hub, 'GRAPHQL_BATCH_SIZE', 4)
+    fake_github.refs.update(('octo/repo', 'feature-{}'.format(i)) for i in range(6))
+    fake_github.protected.add(('octo/repo', 'feature-5'))
+    branches = [('octo/repo', 'feature-{}'.format(i)) for i in range(6)]
+    branches += [('octo/repo', 'missing'), ('octo/other', 'feature')]
+
+    responses = hub.delete_branches('token', branches, base_url=fake_github.base_url, mode=hub.GRAPHQL)
+    assert [resp.status_code for resp in responses] == [200] * 5 + [422, 422, 404]
+    assert sorted(fake_github.deleted) == branches[:5]
+    assert fake_github.requests == [('POST', '/graphql')] * 4
+
+
+@pytest.mark.parametrize('error, status_code', [
+    (dict(type='NOT_FOUND', message='Could not resolve to a Repository'), 404),
+    (dict(type='UNPROCESSABLE', message='Cannot delete protected branch'), 422),
+    (dict(message='Something went wrong'), 422),
+])
+def test_graphql_error_response(error, status_code):
+    """
+    Assert that GraphQL errors of an alias are answered like the REST API answers the same failure.
+    """
+    resp = hub._graphql_error_response(error)
+    assert not resp
+    assert resp.status_code == status_code
+    assert error['message'] in str(resp.body)
+
+
+def test_delete_branches_graphql_request_failure(fake_github):
+    """
+    Assert that a failed GraphQL request answers every branch of the batch with its status.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.failures.append((401, 'Bad credentials'))
+    responses = hub.delete_branches_graphql('token', [('octo/repo', 'feature')] * 2, fake_github.base_url)
+    assert [resp.status_code for resp in responses] == [401, 401]
+    assert not fake_github.deleted
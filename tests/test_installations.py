@@ -0,0 +1,152 @@
+"""
+    test/test_installations
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/installations` module.
+"""
+import threading
+import time
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from chalicelib import hub, installations
+
+
+class RecordingExchange:
+    """
+    Exchange that records the installations it created tokens for and issues tokens valid for a lifetime.
+    """
+    def __init__(self, lifetime=3600, delay=0):
+        self.calls = []
+        self.lifetime = lifetime
+        self.delay = delay
+
+    def __call__(self, installation_id):
+        self.calls.append(installation_id)
+        time.sleep(self.delay)
+        return 'installation-{}-{}'.format(installation_id, len(self.calls)), time.time() + self.lifetime
+
+
+def test_tokens_are_cached_per_installation():
+    """
+    Assert that the token of an installation is created once and reused, separately for every installation.
+    """
+    exchange = RecordingExchange()
+    tokens = installations.InstallationTokens(exchange)
+    assert tokens.token(1) == 'installation-1-1'
+    assert tokens.token(2) == 'installation-2-2'
+    assert tokens.token(1) == 'installation-1-1'
+    assert exchange.calls == [1, 2]
+    assert len(tokens) == 2
+
+
+def test_tokens_are_refreshed_before_expiry():
+    """
+    Assert that a token is replaced once it expires within the refresh margin and after it was invalidated.
+    """
+    exchange = RecordingExchange(lifetime=60)
+    tokens = installations.InstallationTokens(exchange, refresh_margin=120)
+    assert tokens.token(1) == 'installation-1-1'
+    assert tokens.token(1) == 'installation-1-2'
+
+    tokens.refresh_margin = 0
+    assert tokens.token(1) == 'installation-1-2'
+    tokens.invalidate(1)
+    assert tokens.token(1) == 'installation-1-3'
+
+
+def test_tokens_are_created_once_concurrently():
+    """
+    Assert that concurrent requests for the token of the same installation wait for a single exchange.
+    """
+    exchange = RecordingExchange(delay=0.05)
+    tokens = installations.InstallationTokens(exchange)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(tokens.token(1))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert exchange.calls == [1]
+    assert results == ['installation-1-1'] * 8
+
+
+def test_from_configuration():
+    """
+    Assert that :func:`~lopper.installations.from_configuration` only creates tokens for a configured GitHub App
+    and shares them per GitHub App.
+    """
+    class Configuration:
+        app_id = 0
+        app_private_key = ''
+        api_base_url = 'https://api.github.com'
+
+    assert installations.from_configuration(Configuration) is None
+
+    Configuration.app_id, Configuration.app_private_key = 1234, 'key'
+    tokens = installations.from_configuration(Configuration)
+    assert isinstance(tokens, installations.InstallationTokens)
+    assert installations.from_configuration(Configuration) is tokens
+    installations.get_tokens.cache_clear()
+
+
+@pytest.fixture(scope='function')
+def private_key():
+    """
+    Fixture that yields a PEM encoded RSA private key.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                             serialization.NoEncryption()).decode()
+
+
+def test_exchange_signs_jwt(fake_github, private_key):
+    """
+    Assert that :func:`~lopper.installations.exchange` authenticates as the GitHub App to create a token.
+    """
+    token, expires_at = installations.exchange(1234, private_key, fake_github.base_url, 42)
+    assert token == 'installation-42-1'
+    assert expires_at > time.time() + 3000
+    assert fake_github.requests == [('POST', '/app/installations/42/access_tokens')]
+    assert fake_github.authorizations[0].startswith('Bearer ')
+
+
+def test_exchange_rejected(fake_github, private_key):
+    """
+    Assert that :func:`~lopper.installations.exchange` raises a :class:`~RuntimeError` when GitHub rejects the JWT.
+    """
+    fake_github.failures.append((401, 'A JSON web token could not be decoded'))
+    with pytest.raises(RuntimeError):
+        installations.exchange(1234, private_key, fake_github.base_url, 42)
+
+
+def test_exchange_invalid_key(fake_github):
+    """
+    Assert that :func:`~lopper.installations.exchange` raises a :class:`~RuntimeError` when the JWT can't be signed.
+    """
+    with pytest.raises(RuntimeError):
+        installations.exchange(1234, 'not a key', fake_github.base_url, 42)
+    assert fake_github.requests == []
+
+
+def test_exchange_is_governed(fake_github, private_key, monkeypatch):
+    """
+    Assert that :func:`~lopper.installations.exchange` sends its request through the rate limit governor, so it
+    isn't retried while answering a delivery, and gives up after the exchange timeout.
+    """
+    fake_github.failures.append((502, 'Bad Gateway'))
+    with hub.without_waiting():
+        with pytest.raises(RuntimeError):
+            installations.exchange(1234, private_key, fake_github.base_url, 42)
+    assert fake_github.requests == [('POST', '/app/installations/42/access_tokens')]
+
+    monkeypatch.setattr(installations, 'EXCHANGE_TIMEOUT', 1)
+    fake_github.latency = 2
+    started = time.monotonic()
+    with hub.without_waiting():
+        with pytest.raises(RuntimeError):
+            installations.exchange(1234, private_key, fake_github.base_url, 42)
+    assert time.monotonic() - started < 1.8
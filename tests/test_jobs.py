@@ -0,0 +1,145 @@
+"""
+    test/jobs
+    ~~~~~~~~~
+
+    Tests for the :mod:`~lopper/jobs` module.
+"""
+import time
+
+import pytest
+
+from chalicelib import installations, jobs, policy
+
+
+@pytest.fixture(scope='function')
+def rules():
+    """
+    Fixture that yields a policy with a rule without and a rule with its own token.
+    """
+    defaults = policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',))
+    owned = policy.compile_filters('\\w+', '^master$', 'octo$', '\\w+', ('master',), 'rule-token')
+    return policy.Policy([(defaults, None, None), (owned, 'octo', None)])
+
+
+def test_dumps_loads_round_trip():
+    """
+    Assert that :func:`~lopper.jobs.loads` restores jobs serialized by :func:`~lopper.jobs.dumps`.
+    """
+    job = jobs.Job('octo/repo', 'feature', 'f00d')
+    assert jobs.loads(jobs.dumps(job)) == job
+
+    job = jobs.Job('octo/repo', 'feature', 'f00d', 42)
+    assert jobs.loads(jobs.dumps(job)) == job
+
+
+@pytest.mark.parametrize('url', ['memory://', 'file://{tmpdir}/queue.jsonl'])
+def test_queue_get_batch(url, tmpdir):
+    """
+    Assert that local queues return jobs in order in batches of at most the given size.
+    """
+    queue = jobs.get_queue(url.format(tmpdir=tmpdir))
+    for i in range(5):
+        queue.put(jobs.Job('octo/repo', 'feature-{}'.format(i), None))
+
+    assert [job.ref for job in queue.get_batch(3)] == ['feature-0', 'feature-1', 'feature-2']
+    assert [job.ref for job in queue.get_batch(3)] == ['feature-3', 'feature-4']
+    assert queue.get_batch(3) == []
+
+
+def test_get_queue_unsupported_url():
+    """
+    Assert that :func:`~lopper.jobs.get_queue` rejects unsupported queue URLs.
+    """
+    with pytest.raises(RuntimeError):
+        jobs.get_queue('redis://localhost')
+
+
+def test_token_for_uses_rule_token(rules):
+    """
+    Assert that :func:`~lopper.jobs.token_for` prefers the token of the rule that accepted the job.
+    """
+    default, owned = (rules.key(rule) for rule in rules.rules)
+    assert jobs.token_for(jobs.Job('octo/repo', 'feature', owned), rules, 'default') == 'rule-token'
+    assert jobs.token_for(jobs.Job('octo/repo', 'feature', default), rules, 'default') == 'default'
+
+
+def test_token_for_uses_installation_token(rules):
+    """
+    Assert that :func:`~lopper.jobs.token_for` uses the token of the installation of the job unless its rule
+    has a token.
+    """
+    tokens = installations.InstallationTokens(lambda installation_id: ('installation-{}'.format(installation_id),
+                                                                        time.time() + 3600))
+    default, owned = (rules.key(rule) for rule in rules.rules)
+    assert jobs.token_for(jobs.Job('octo/repo', 'feature', default, 42), rules, 'default', tokens) == 'installation-42'
+    assert jobs.token_for(jobs.Job('octo/repo', 'feature', owned, 42), rules, 'default', tokens) == 'rule-token'
+    assert jobs.token_for(jobs.Job('octo/repo', 'feature', default), rules, 'default', tokens) == 'default'
+    assert jobs.token_for(jobs.Job('octo/repo', 'feature', default, 42), rules, 'default') == 'default'
+
+
+def test_process_deletes_branches(rules, fake_github):
+    """
+    Assert that :func:`~lopper.jobs.process` deletes the branch of every job.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    key = rules.key(rules.rules[0])
+    batch = [jobs.Job('octo/repo', 'feature', key), jobs.Job('octo/repo', 'missing', key)]
+
+    responses = jobs.process(batch, rules, 'token', fake_github.base_url)
+    assert [resp.status_code for resp in responses] == [200, 422]
+    assert fake_github.deleted == [('octo/repo', 'feature')]
+
+
+def test_process_invalidates_rejected_installation_token(rules, fake_github):
+    """
+    Assert that :func:`~lopper.jobs.process` forgets the token of an installation once the API rejected it.
+    """
+    tokens = installations.InstallationTokens(lambda installation_id: ('installation-{}'.format(installation_id),
+                                                                        time.time() + 3600))
+    fake_github.failures.append((401, 'Bad credentials'))
+    job = jobs.Job('octo/repo', 'feature', rules.key(rules.rules[0]), 42)
+
+    responses = jobs.process([job], rules, 'token', fake_github.base_url, installations=tokens)
+    assert [resp.status_code for resp in responses] == [401]
+    assert len(tokens) == 0
+
+
+def test_process_rejects_job_of_changed_rule(rules, fake_github):
+    """
+    Assert that :func:`~lopper.jobs.process` doesn't run a job whose rule is no longer in the policy under the
+    token of another rule.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    changed = policy.Policy([(rules.rules[0], None, None)])
+    owned = rules.key(rules.rules[1])
+
+    responses = jobs.process([jobs.Job('octo/repo', 'feature', owned)], changed, 'token', fake_github.base_url)
+    assert responses == [jobs.RULE_NOT_IN_POLICY]
+    assert not fake_github.requests
+
+
+def test_sqs_queue_get_batch():
+    """
+    Assert that :meth:`~lopper.jobs.SQSQueue.get_batch` receives and deletes messages until the batch is full or
+    the queue is empty.
+    """
+    class Client:
+        def __init__(self, bodies):
+            self.bodies = bodies
+            self.deleted = []
+
+        def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+            messages, self.bodies = self.bodies[:MaxNumberOfMessages], self.bodies[MaxNumberOfMessages:]
+            return dict(Messages=[dict(Body=body, ReceiptHandle=body) for body in messages]) if messages else {}
+
+        def delete_message_batch(self, QueueUrl, Entries):
+            self.deleted.extend(entry['ReceiptHandle'] for entry in Entries)
+
+    queue = jobs.SQSQueue.__new__(jobs.SQSQueue)
+    queue._url = 'https://sqs.example.com/queue'
+    queue._client = Client([jobs.dumps(jobs.Job('octo/repo', 'feature-{}'.format(i), None)) for i in range(15)])
+
+    assert [job.ref for job in queue.get_batch(12)] == ['feature-{}'.format(i) for i in range(12)]
+    assert [job.ref for job in queue.get_batch(12)] == ['feature-{}'.format(i) for i in range(12, 15)]
+    assert queue.get_batch(12) == []
+    assert len(queue._client.deleted) == 15
@@ -0,0 +1,93 @@
+"""
+    test/test_journal
+    ~~~~~~~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/journal` module.
+"""
+import functools
+import time
+
+import pytest
+
+from chalicelib import jobs, journal, policy
+
+
+#: URLs of every supported journal, formatted with the temporary directory of the test.
+URLS = ['memory://', 'file://{tmpdir}/journal.jsonl', 'sqlite://{tmpdir}/journal.db']
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_journal_pending_entries(url, tmpdir):
+    """
+    Assert that journals yield unfinished and failed entries in the order they were accepted.
+    """
+    entries = journal.get_journal(url.format(tmpdir=tmpdir))
+    ids = [entries.accept(jobs.Job('octo/repo', 'feature-{}'.format(i), None)) for i in range(4)]
+    entries.complete(ids[0], 200)
+    entries.complete(ids[1], 502)
+    entries.complete(ids[3], 422)
+
+    pending = list(entries.pending())
+    assert [entry.id for entry in pending] == [ids[1], ids[2]]
+    assert [entry.job for entry in pending] == [jobs.Job('octo/repo', 'feature-1', None),
+                                                jobs.Job('octo/repo', 'feature-2', None)]
+    assert list(entries.pending(before=time.time() - 60)) == []
+
+    entries.complete(ids[1], 200)
+    entries.compact()
+    assert [entry.id for entry in entries.pending()] == [ids[2]]
+
+
+@pytest.mark.parametrize('url', URLS[1:])
+def test_journal_survives_restart(url, tmpdir):
+    """
+    Assert that persistent journals keep their entries for a new instance, e.g. after the process died.
+    """
+    url = url.format(tmpdir=tmpdir)
+    entry_id = journal.get_journal(url).accept(jobs.Job('octo/repo', 'feature', 1))
+    journal.get_journal.cache_clear()
+
+    assert [(entry.id, entry.job) for entry in journal.get_journal(url).pending()] == [
+        (entry_id, jobs.Job('octo/repo', 'feature', 1))]
+
+
+def test_get_journal_unsupported_url():
+    """
+    Assert that :func:`~lopper.journal.get_journal` rejects unsupported journal URLs.
+    """
+    with pytest.raises(RuntimeError):
+        journal.get_journal('redis://localhost')
+
+
+def test_replay_deletes_failed_branches(fake_github, tmpdir):
+    """
+    Assert that :func:`~lopper.journal.replay` deletes the branches of unfinished and failed jobs and records
+    their new outcomes.
+    """
+    rules = policy.Policy.from_filters(policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',)))
+    entries = journal.get_journal('file://{}/replay.jsonl'.format(tmpdir))
+    fake_github.refs.update([('octo/repo', 'failed'), ('octo/repo', 'unfinished'), ('octo/repo', 'deleted')])
+    key = rules.key(rules.rules[0])
+    entries.complete(entries.accept(jobs.Job('octo/repo', 'failed', key)), 502)
+    entries.accept(jobs.Job('octo/repo', 'unfinished', key))
+    entries.complete(entries.accept(jobs.Job('octo/repo', 'deleted', key)), 204)
+    entries.accept(jobs.Job('octo/repo', 'missing', key))
+
+    process = functools.partial(jobs.process, rules=rules, api_access_token='token',
+                                api_base_url=fake_github.base_url)
+    counts = journal.replay(entries, process, batch_size=2, min_age=0)
+    assert counts == dict(replayed=3, deleted=2, rejected=1)
+    assert sorted(fake_github.deleted) == [('octo/repo', 'failed'), ('octo/repo', 'unfinished')]
+    assert list(entries.pending()) == []
+    assert journal.replay(entries, process, min_age=0) == {}
+
+
+def test_file_journal_skips_torn_line(tmpdir):
+    """
+    Assert that a partially written last line, e.g. of a process that died while writing it, is skipped.
+    """
+    entries = journal.FileJournal(str(tmpdir.join('torn.jsonl')))
+    entry_id = entries.accept(jobs.Job('octo/repo', 'feature', None))
+    with open(entries.path, 'a') as f:
+        f.write('["d","{}",2'.format(entry_id))
+    assert [entry.id for entry in entries.pending()] == [entry_id]
@@ -0,0 +1,108 @@
+"""
+    test/metrics
+    ~~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/metrics` module.
+"""
+import io
+import json
+
+import pytest
+
+from chalicelib import hub, metrics
+
+
+def test_start_disabled_returns_null_collector():
+    """
+    Assert that :func:`~lopper.metrics.start` returns the shared no-op collector when no sink is configured.
+    """
+    collector = metrics.start(None)
+    assert collector is metrics.NULL_COLLECTOR
+    with collector.time('Stage'):
+        pass
+    collector.finish(200)
+    assert metrics.active() is metrics.NULL_COLLECTOR
+
+
+def test_collector_emits_emf_document():
+    """
+    Assert that :class:`~lopper.metrics.Collector` emits stage timings and API calls as an EMF document.
+    """
+    sink = metrics.MemorySink()
+    collector = metrics.Collector(sink, 'Test', dict(Function='lopper'))
+    assert metrics.active() is collector
+
+    with collector.time('Authentication'):
+        pass
+    collector.api_call(0.25, 204)
+    collector.api_call(0.5, 422)
+    collector.finish(200)
+
+    assert metrics.active() is metrics.NULL_COLLECTOR
+    document, = sink.documents
+    assert document['Function'] == 'lopper'
+    assert document['StatusCode'] == 200
+    assert document['AuthenticationTime'] >= 0
+    assert (document['ApiCalls'], document['ApiErrors'], document['ApiLatency']) == (2, 1, 750)
+
+    directive, = document['_aws']['CloudWatchMetrics']
+    assert directive['Namespace'] == 'Test'
+    assert directive['Dimensions'] == [['Function']]
+    assert [metric['Name'] for metric in directive['Metrics']] == ['AuthenticationTime', 'ApiCalls', 'ApiErrors',
+                                                                    'ApiLatency']
+
+
+def test_collector_emits_counts_and_properties():
+    """
+    Assert that counts are emitted as metrics and annotated properties only as values of the document.
+    """
+    sink = metrics.MemorySink()
+    collector = metrics.Collector(sink, 'Test', dict(Function='lopper'))
+    collector.count('IntendedDeletions')
+    collector.count('IntendedDeletions', 2)
+    collector.annotate(IntendedRef='feature', Function='other')
+    collector.finish(200)
+
+    document, = sink.documents
+    assert document['IntendedDeletions'] == 3
+    assert (document['IntendedRef'], document['Function']) == ('feature', 'lopper')
+    directive, = document['_aws']['CloudWatchMetrics']
+    units = {metric['Name']: metric['Unit'] for metric in directive['Metrics']}
+    assert units['IntendedDeletions'] == 'Count'
+    assert 'IntendedRef' not in units
+
+
+def test_emf_sink_writes_json_lines():
+    """
+    Assert that :class:`~lopper.metrics.EMFSink` writes every document as a single JSON line.
+    """
+    stream = io.StringIO()
+    sink = metrics.EMFSink(stream)
+    sink(dict(StatusCode=200))
+    sink(dict(StatusCode=401))
+    assert [json.loads(line) for line in stream.getvalue().splitlines()] == [dict(StatusCode=200),
+                                                                            dict(StatusCode=401)]
+
+
+def test_get_sink_unsupported():
+    """
+    Assert that :func:`~lopper.metrics.get_sink` rejects unsupported sinks.
+    """
+    with pytest.raises(RuntimeError):
+        metrics.get_sink('statsd')
+
+
+def test_api_calls_of_concurrent_deletions_are_recorded(fake_github):
+    """
+    Assert that API calls made by :func:`~lopper.hub.delete_branches` worker threads are recorded by the
+    active collector.
+    """
+    branches = [('octo/repo', 'feature-{}'.format(i)) for i in range(4)]
+    fake_github.refs.update(branches)
+
+    sink = metrics.MemorySink()
+    collector = metrics.Collector(sink)
+    hub.delete_branches('token', branches, max_workers=4, base_url=fake_github.base_url)
+    collector.finish(200)
+
+    assert sink.documents[0]['ApiCalls'] == 4
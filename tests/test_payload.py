@@ -4,11 +4,153 @@
 
     Tests for the :mod:`~lopper/payload` module.
 """
+import json
+import re
+
 import pytest
 
-from chalicelib import payload
+from chalicelib import payload, policy
+
+
+@pytest.fixture(scope='function')
+def rules():
+    """
+    Fixture that yields a policy with a single rule matching the default configuration.
+    """
+    return policy.Policy.from_filters(policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',)))
 
 
 @pytest.mark.xfail(reason='TODO')
 def test_sanity():
     return False
+
+
+def test_is_acceptable_payload_merged(merged_payload, rules):
+    """
+    Assert that :func:`~lopper.payload.is_acceptable_payload` accepts a merged pull request.
+    """
+    assert payload.is_acceptable_payload(merged_payload, rules)
+
+
+def test_is_acceptable_payload_not_merged(merged_payload, rules):
+    """
+    Assert that :func:`~lopper.payload.is_acceptable_payload` rejects a closed but unmerged pull request.
+    """
+    merged_payload['pull_request']['merged_at'] = None
+    assert not payload.is_acceptable_payload(merged_payload, rules)
+
+
+def test_is_acceptable_payload_excluded_head_branch(merged_payload, rules):
+    """
+    Assert that :func:`~lopper.payload.is_acceptable_payload` rejects a head branch in the exclusion set.
+    """
+    merged_payload['pull_request']['head']['ref'] = 'master'
+    assert not payload.is_acceptable_payload(merged_payload, rules)
+
+
+def test_is_acceptable_payload_base_branch_mismatch(merged_payload, rules):
+    """
+    Assert that :func:`~lopper.payload.is_acceptable_payload` rejects a base branch not matching the pattern.
+    """
+    merged_payload['pull_request']['base']['ref'] = 'develop'
+    assert not payload.is_acceptable_payload(merged_payload, rules)
+
+
+def test_get_matching_rule_uses_first_matching_rule(merged_payload, rules):
+    """
+    Assert that :func:`~lopper.payload.get_matching_rule` returns the first rule in definition order that accepts.
+    """
+    defaults = rules.rules[0]
+    exact = defaults._replace(repository_owner=re.compile('octo$'), token='exact-token')
+    excluding = defaults._replace(head_branch_exclusion=frozenset(['feature']), token='excluding-token')
+    rules = policy.Policy([(excluding, 'octo', 'repo'), (exact, 'octo', None), (defaults, None, None)])
+
+    assert payload.get_matching_rule(merged_payload, rules) is exact
+
+
+def test_is_acceptable_payload_no_matching_rule(merged_payload, rules):
+    """
+    Assert that :func:`~lopper.payload.is_acceptable_payload` rejects payloads for repositories without a rule.
+    """
+    rule = rules.rules[0]
+    rules = policy.Policy([(rule, 'other', 'repo')])
+
+    assert not payload.is_acceptable_payload(merged_payload, rules)
+
+
+def test_extract_merge_event(merged_payload):
+    """
+    Assert that :func:`~lopper.payload.extract` pulls the fields of the event into a compact record.
+    """
+    event = payload.extract(merged_payload)
+    assert event == payload.MergeEvent(
+        action='closed', number=merged_payload['number'], owner='octo', name='repo', repo='octo/repo',
+        head_repo='octo/repo', head_ref='feature', base_ref='master',
+        merged_at=merged_payload['pull_request']['merged_at'],
+        merge_commit_sha='e5bd3914e2e596debea16f433f57875b5b90bcd6', installation=None)
+    assert not hasattr(event, '__dict__')
+
+
+def test_extract_missing_sections():
+    """
+    Assert that :func:`~lopper.payload.extract` leaves the fields of missing sections empty instead of failing.
+    """
+    event = payload.extract(dict(action='closed', pull_request=dict(head=dict(repo=None))))
+    assert event == payload.MergeEvent('closed', *[None] * 10)
+
+
+def test_extract_installation(merged_payload):
+    """
+    Assert that :func:`~lopper.payload.extract` keeps the ID of the GitHub App installation that sent the event.
+    """
+    merged_payload['installation'] = dict(id=42, node_id='MDIzOkludGVncmF0aW9uSW5zdGFsbGF0aW9uNDI=')
+    assert payload.extract(merged_payload).installation == 42
+
+
+def test_match_rule_rejects_missing_sections(merged_payload, rules):
+    """
+    Assert that :func:`~lopper.payload.match_rule` rejects events without repository, pull request or head
+    repository with their reason.
+    """
+    event = payload.extract(merged_payload)
+    assert payload.match_rule(event._replace(repo=None), rules) == (None, payload.MISSING_REPOSITORY)
+    assert payload.match_rule(event._replace(number=None), rules) == (None, payload.MISSING_PULL_REQUEST)
+    assert payload.match_rule(event._replace(head_repo=None), rules) == (None, payload.MISSING_HEAD_REPOSITORY)
+    assert payload.match_rule(event, rules) == (rules.rules[0], payload.PAYLOAD_ACCEPTABLE)
+
+
+def test_scan_action_finds_top_level_action(merged_payload):
+    """
+    Assert that :func:`~lopper.payload.scan_action` finds the action without decoding the payload.
+    """
+    assert payload.scan_action(json.dumps(merged_payload).encode()) == 'closed'
+    assert payload.scan_action(b'{"action" : "opened", "pull_request": {}}') == 'opened'
+    assert payload.scan_action(b'{"ref": "refs/heads/master"}') is None
+
+
+def test_scan_repository_owner(merged_payload):
+    """
+    Assert that :func:`~lopper.payload.scan_repository_owner` finds the repository owner without decoding.
+    """
+    assert payload.scan_repository_owner(json.dumps(merged_payload).encode()) == 'octo'
+    assert payload.scan_repository_owner(b'{"action": "closed"}') is None
+
+
+def test_is_acceptable_event_rejects_other_events(merged_payload):
+    """
+    Assert that :func:`~lopper.payload.is_acceptable_event` only accepts closed pull request events.
+    """
+    raw_payload = json.dumps(merged_payload).encode()
+    assert payload.is_acceptable_event('pull_request', raw_payload)
+    assert payload.is_acceptable_event('push', raw_payload) is payload.NOT_PULL_REQUEST
+    assert not payload.is_acceptable_event('pull_request', raw_payload.replace(b'"closed"', b'"opened"'))
+
+
+def test_parse_rejects_non_object_payloads():
+    """
+    Assert that :func:`~lopper.payload.parse` only returns decoded JSON objects.
+    """
+    assert payload.parse(b'{"action": "closed"}') == dict(action='closed')
+    assert payload.parse(b'') is None
+    assert payload.parse(b'not json') is None
+    assert payload.parse(b'[1, 2]') is None
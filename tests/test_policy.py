@@ -0,0 +1,103 @@
+"""
+    test/policy
+    ~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/policy` module.
+"""
+import json
+
+import pytest
+
+from chalicelib import policy
+
+
+@pytest.fixture(scope='function')
+def defaults():
+    """
+    Fixture that yields a rule matching the default configuration.
+    """
+    return policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',))
+
+
+def test_compile_filters_compiles_patterns():
+    """
+    Assert that :func:`~lopper.policy.compile_filters` compiles patterns and freezes exclusions.
+    """
+    filters = policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master', 'develop'))
+    assert filters.base_branch.match('master')
+    assert filters.head_branch_exclusion == frozenset(('master', 'develop'))
+
+
+def test_compile_filters_invalid_pattern():
+    """
+    Assert that :func:`~lopper.policy.compile_filters` fails fast on an invalid regular expression.
+    """
+    with pytest.raises(RuntimeError):
+        policy.compile_filters('(', '^master$', '\\w+', '\\w+', ())
+
+
+def test_policy_candidates_are_indexed(defaults):
+    """
+    Assert that :meth:`~lopper.policy.Policy.candidates` only yields rules that can apply, in definition order.
+    """
+    rules = [defaults._replace(token=str(i)) for i in range(4)]
+    rule_set = policy.Policy([(rules[0], None, None), (rules[1], 'octo', 'repo'),
+                              (rules[2], 'other', None), (rules[3], 'octo', None)])
+
+    assert list(rule_set.candidates('octo', 'repo')) == [rules[0], rules[1], rules[3]]
+    assert list(rule_set.candidates('other', 'repo')) == [rules[0], rules[2]]
+    assert list(rule_set.candidates('nobody', 'repo')) == [rules[0]]
+
+
+def test_load_compiles_rules(defaults, tmpdir):
+    """
+    Assert that :func:`~lopper.policy.load` compiles exact and pattern rules, inheriting defaults.
+    """
+    path = tmpdir.join('policy.json')
+    path.write(json.dumps(dict(rules=[
+        dict(owner='octo.org', name='repo', head_branch_exclusion=[], token='token'),
+        dict(owner_pattern='^team-', base_branch_pattern='^develop$')
+    ])))
+    rule_set = policy.load(str(path), defaults)
+
+    exact, pattern = rule_set.rules
+    assert exact.repository_owner.match('octo.org')
+    assert not exact.repository_owner.match('octoxorg')
+    assert exact.head_branch_exclusion == frozenset()
+    assert pattern.base_branch.pattern == '^develop$'
+    assert pattern.head_branch_exclusion == defaults.head_branch_exclusion
+    assert list(rule_set.candidates('team-a', 'repo')) == [pattern]
+
+
+def test_load_yaml(defaults, tmpdir):
+    """
+    Assert that :func:`~lopper.policy.load` reads YAML policy files.
+    """
+    pytest.importorskip('yaml')
+    path = tmpdir.join('policy.yml')
+    path.write('rules:\n  - owner: octo\n    name: repo\n')
+
+    assert len(policy.load(str(path), defaults)) == 1
+
+
+def test_load_invalid_rule(defaults, tmpdir):
+    """
+    Assert that :func:`~lopper.policy.load` fails fast on an invalid rule.
+    """
+    path = tmpdir.join('policy.json')
+    path.write(json.dumps(dict(rules=[dict(name='repo')])))
+
+    with pytest.raises(RuntimeError):
+        policy.load(str(path), defaults)
+
+
+@pytest.mark.parametrize('exclusion', ['main', ['main', 1], dict(main=True)])
+def test_load_invalid_head_branch_exclusion(defaults, tmpdir, exclusion):
+    """
+    Assert that :func:`~lopper.policy.load` rejects head branch exclusions that aren't a list of branch names.
+    """
+    path = tmpdir.join('policy.json')
+    path.write(json.dumps(dict(rules=[dict(owner='octo', head_branch_exclusion=exclusion)])))
+
+    with pytest.raises(RuntimeError):
+        policy.load(str(path), defaults)
@@ -0,0 +1,85 @@
+"""
+    test/test_response
+    ~~~~~~~~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/response` module.
+"""
+import json
+
+import pytest
+
+from chalicelib import auth, dedup, payload, response, safety, server
+
+
+def test_response_does_not_mutate_headers():
+    """
+    Assert that creating a response copies the given headers instead of changing them in place.
+    """
+    headers = {'X-Request-Id': 'abc'}
+    resp = response.unprocessable_entity('Nope', headers=headers)
+    assert headers == {'X-Request-Id': 'abc'}
+    assert resp.headers == {'X-Request-Id': 'abc', 'Content-Type': 'application/json'}
+    assert resp.headers is not headers
+
+    resp.headers['X-Other'] = 'value'
+    assert dict(response.DEFAULT_HEADERS) == {'Content-Type': 'application/json'}
+    assert 'X-Other' not in response.success('Ok').headers
+
+
+def test_default_headers_are_read_only():
+    """
+    Assert that the shared default headers can't be changed by accident.
+    """
+    with pytest.raises(TypeError):
+        response.DEFAULT_HEADERS['Content-Type'] = 'text/plain'
+
+
+def test_fixed_response_is_preserialized():
+    """
+    Assert that fixed responses carry their reason code in a body serialized up front.
+    """
+    resp = payload.NOT_MERGED
+    assert not resp
+    assert resp.reason == 'pull_request_not_merged'
+    assert json.loads(resp.body) == dict(message=resp.message, status_code=422, reason='pull_request_not_merged')
+    assert resp.to_dict()['body'] is resp.body
+    assert resp.to_dict()['headers'] == {'Content-Type': 'application/json'}
+
+
+def test_fixed_response_is_immutable():
+    """
+    Assert that the shared fixed responses can't be changed and are copied to change their headers.
+    """
+    resp = auth.SIGNATURE_MISMATCH
+    with pytest.raises(AttributeError):
+        resp.status_code = 200
+    with pytest.raises(TypeError):
+        resp.headers['X-Other'] = 'value'
+
+    copy = resp.with_headers({'X-Other': 'value'})
+    assert copy.headers == {'Content-Type': 'application/json', 'X-Other': 'value'}
+    assert (copy.body, copy.status_code) == (resp.body, resp.status_code)
+    assert dict(resp.headers) == {'Content-Type': 'application/json'}
+
+
+def test_fixed_reason_codes_are_unique():
+    """
+    Assert that every fixed outcome has its own reason code.
+    """
+    responses = [value for module in (auth, dedup, payload, safety, server) for value in vars(module).values()
+                 if isinstance(value, response.FixedResponse)]
+    reasons = [resp.reason for resp in responses]
+    assert len(responses) >= 19
+    assert len(set(reasons)) == len(reasons)
+
+
+def test_rejection_returns_shared_instance(merged_payload):
+    """
+    Assert that fixed rejections return the preallocated instance instead of building a new response.
+    """
+    merged_payload['pull_request']['merged_at'] = None
+    rules = None
+    assert payload.is_acceptable_payload(merged_payload, rules) is payload.NOT_MERGED
+    assert payload.is_acceptable_event('pull_request', b'{"action": "opened"}') is payload.NOT_CLOSED
+    assert auth.is_authentic('sha1=00', b'{}', b'secret') is auth.SIGNATURE_MISMATCH
+    assert auth.is_authentic('md5=00', b'{}', b'secret') is auth.UNSUPPORTED_ALGORITHM
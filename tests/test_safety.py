@@ -0,0 +1,111 @@
+"""
+    test/test_safety
+    ~~~~~~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/safety` module.
+"""
+import pytest
+
+from chalicelib import jobs, policy, safety
+
+
+def pull_request(number, head, base='master', repo='octo/repo'):
+    """
+    Build a minimal raw pull request.
+    """
+    return dict(number=number, state='open', head=dict(ref=head, repo=dict(full_name=repo)), base=dict(ref=base))
+
+
+@pytest.fixture(scope='function')
+def index(fake_github):
+    """
+    Fixture that yields an empty safety index and a repository with a protected branch and stacked pull requests.
+    """
+    fake_github.protected.add(('octo/repo', 'release'))
+    fake_github.pulls['octo/repo'] = [pull_request(1, 'feature'), pull_request(2, 'stacked', base='feature'),
+                                      pull_request(3, 'master', repo='fork/repo')]
+    return safety.SafetyIndex(ttl=60)
+
+
+def test_check_loads_repository_once(index, fake_github):
+    """
+    Assert that a repository is loaded with one listing of protected branches and one of open pull requests.
+    """
+    assert index.check('token', 'octo/repo', 'release', fake_github.base_url) is safety.PROTECTED
+    assert index.check('token', 'octo/repo', 'feature', fake_github.base_url) is safety.OPEN_PULL_REQUEST
+    assert index.check('token', 'octo/repo', 'stacked', fake_github.base_url) is safety.OPEN_PULL_REQUEST
+    assert index.check('token', 'octo/repo', 'done', fake_github.base_url) is safety.SAFE
+    assert len(fake_github.requests) == 2
+    assert [path.split('?')[0] for _, path in fake_github.requests] == ['/repos/octo/repo/branches',
+                                                                         '/repos/octo/repo/pulls']
+
+
+def test_check_ignores_fork_head_branches(index, fake_github):
+    """
+    Assert that head branches of pull requests from forks don't keep the branch of the same name.
+    """
+    index.load('token', 'octo/repo', fake_github.base_url)
+    del fake_github.pulls['octo/repo'][:2]
+    assert index.load('token', 'octo/repo', fake_github.base_url).check('feature') is safety.SAFE
+
+
+def test_observe_updates_index(index, fake_github, merged_payload):
+    """
+    Assert that "pull_request" events keep an indexed repository current without API calls.
+    """
+    index.load('token', 'octo/repo', fake_github.base_url)
+    fake_github.reset()
+
+    index.observe(dict(merged_payload, action='opened', pull_request=pull_request(4, 'other')))
+    assert index.check('token', 'octo/repo', 'other') is safety.OPEN_PULL_REQUEST
+
+    index.observe(dict(merged_payload, action='closed', pull_request=pull_request(2, 'stacked', base='feature')))
+    index.observe(dict(merged_payload, action='closed', pull_request=pull_request(1, 'feature')))
+    assert index.check('token', 'octo/repo', 'feature') is safety.SAFE
+    assert index.check('token', 'octo/repo', 'stacked') is safety.SAFE
+    assert not fake_github.requests
+
+
+def test_observe_ignores_repository_not_indexed(merged_payload):
+    """
+    Assert that events of repositories that were never loaded are not indexed.
+    """
+    index = safety.SafetyIndex()
+    index.observe(dict(merged_payload, action='opened'))
+    assert len(index) == 0
+
+
+def test_check_reloads_expired_repository(index, fake_github):
+    """
+    Assert that the state of a repository is loaded again once its TTL expired.
+    """
+    index.ttl = 0
+    index.check('token', 'octo/repo', 'feature', fake_github.base_url)
+    index.check('token', 'octo/repo', 'feature', fake_github.base_url)
+    assert len(fake_github.requests) == 4
+
+
+def test_check_load_failure_returns_response(index, fake_github):
+    """
+    Assert that a repository that can't be loaded is not treated as safe.
+    """
+    fake_github.failures.append((404, 'Not Found'))
+    resp = index.check('token', 'octo/repo', 'done', fake_github.base_url)
+    assert not resp
+    assert resp.status_code == 404
+    assert len(index) == 0
+
+
+def test_process_skips_unsafe_branches(index, fake_github):
+    """
+    Assert that queued deletions of branches in use are answered without deleting them.
+    """
+    fake_github.refs.update({('octo/repo', 'feature'), ('octo/repo', 'done')})
+    filters = policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',))
+    rules = policy.Policy.from_filters(filters)
+    key = rules.key(filters)
+    batch = [jobs.Job('octo/repo', 'feature', key), jobs.Job('octo/repo', 'done', key)]
+    responses = jobs.process(batch, rules, 'token', fake_github.base_url, index=index)
+    assert responses == [safety.OPEN_PULL_REQUEST, responses[1]]
+    assert responses[1].status_code == 200
+    assert fake_github.deleted == [('octo/repo', 'done')]
@@ -0,0 +1,357 @@
+"""
+    test/test_server
+    ~~~~~~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/server` module.
+"""
+import asyncio
+import copy
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+import pytest
+
+from chalicelib import auth, conf, dedup, installations, journal, server
+
+
+@pytest.fixture(scope='function')
+def configuration(fake_github, monkeypatch):
+    """
+    Fixture that yields a valid configuration against the fake API with a small queue and a single worker.
+    """
+    monkeypatch.setattr(conf, 'API_ACCESS_TOKEN', 'token')
+    monkeypatch.setattr(conf, 'WEBHOOK_SECRET_TOKEN', b'secret')
+    monkeypatch.setattr(conf, 'WEBHOOK_PREVIOUS_SECRET_TOKEN', b'')
+    return conf.validate()._replace(api_base_url=fake_github.base_url, api_requests_per_second=0,
+                                    server_queue_size=1, deletion_max_workers=1, dedup_cache_size=0,
+                                    webhook_max_payload_size=64 * 1024)
+
+
+def delivery(body, secret=b'secret', event='pull_request'):
+    """
+    Build the headers and raw body of a signed webhook delivery.
+    """
+    body = json.dumps(body).encode()
+    signature = 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+    headers = [(b'content-type', b'application/json'), (b'x-github-event', event.encode()),
+               (b'x-hub-signature-256', signature.encode())]
+    return headers, body
+
+
+async def request(app, headers=(), body=b'', method='POST', path='/lopper', chunk_size=None):
+    """
+    Send a single HTTP request to the ASGI application and return the status and decoded body of its response.
+    """
+    chunk_size = chunk_size or max(1, len(body))
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b'']
+    messages = [dict(type='http.request', body=chunk, more_body=i < len(chunks) - 1) for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else dict(type='http.disconnect')
+
+    async def send(message):
+        sent.append(message)
+
+    scope = dict(type='http', method=method, path=path, headers=list(headers))
+    await app(scope, receive, send)
+    return sent[0]['status'], json.loads(sent[1]['body'])
+
+
+def test_server_queues_and_deletes_branch(configuration, fake_github, merged_payload):
+    """
+    Assert that an accepted delivery is answered right away and its branch is deleted before the server stops.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    app = server.Server(configuration)
+
+    async def run():
+        status, body = await request(app, *delivery(merged_payload))
+        await app.stop()
+        return status, body
+
+    status, body = asyncio.run(run())
+    assert status == 202
+    assert body['status_code'] == 202
+    assert fake_github.deleted == [('octo/repo', 'feature')]
+
+
+def test_server_stores_off_the_event_loop(configuration, fake_github, merged_payload, monkeypatch, tmpdir):
+    """
+    Assert that journal entries and SQLite deduplication claims are written on the storage thread and a
+    deletion that completes while the server stops is still journaled.
+    """
+    threads = []
+
+    def on_thread(function):
+        def wrapper(*args):
+            threads.append((function.__name__, threading.current_thread().name))
+            return function(*args)
+        return wrapper
+
+    monkeypatch.setattr(journal.SQLiteJournal, 'accept', on_thread(journal.SQLiteJournal.accept))
+    monkeypatch.setattr(journal.SQLiteJournal, 'complete', on_thread(journal.SQLiteJournal.complete))
+    monkeypatch.setattr(dedup.Deduplicator, 'claim', on_thread(dedup.Deduplicator.claim))
+    dedup.get_deduplicator.cache_clear()
+    journal.get_journal.cache_clear()
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.latency = 0.05
+    app = server.Server(configuration._replace(dedup_cache_size=16, dedup_database=str(tmpdir.join('dedup.db')),
+                                               journal='sqlite://{}'.format(tmpdir.join('journal.db'))))
+
+    async def run():
+        statuses = [(await request(app, *delivery(merged_payload)))[0] for _ in range(2)]
+        await app.stop()
+        return statuses
+
+    try:
+        assert asyncio.run(run()) == [202, 200]
+        assert fake_github.deleted == [('octo/repo', 'feature')]
+        assert list(journal.get_journal(app.configuration.journal).pending()) == []
+    finally:
+        dedup.get_deduplicator.cache_clear()
+        journal.get_journal.cache_clear()
+    assert sorted(name for name, _ in threads) == ['accept', 'claim', 'claim', 'complete']
+    assert all(thread.startswith('lopper-storage') for _, thread in threads)
+
+
+def test_server_rejects_with_reason(configuration, merged_payload):
+    """
+    Assert that rejected deliveries are answered with the pre-serialized response of their reason.
+    """
+    app = server.Server(configuration)
+
+    async def run():
+        results = [await request(app, *delivery(merged_payload, secret=b'forged')),
+                   await request(app, method='GET'),
+                   await request(app, *delivery(dict(merged_payload, action='opened')))]
+        await app.stop()
+        return results
+
+    results = asyncio.run(run())
+    assert [(status, body['reason']) for status, body in results] == [
+        (401, 'signature_mismatch'), (404, 'route_not_found'), (422, 'pull_request_not_closed')]
+
+
+def test_server_rejects_owner_outside_secret_route(configuration, fake_github, merged_payload):
+    """
+    Assert that a delivery signed with the secret of one owner can't name the repository of another owner
+    in a duplicate "repository" key that is only seen once the payload is decoded.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    secrets = auth.SecretRouter.from_document(dict(owners=dict(octo='octo-secret', mallory='mallory-secret')))
+    app = server.Server(configuration._replace(secrets=secrets))
+    body = b'{"repository": {"full_name": "mallory/repo"}, ' + json.dumps(merged_payload).encode()[1:]
+    signature = 'sha256=' + hmac.new(b'mallory-secret', body, hashlib.sha256).hexdigest()
+    headers = [(b'content-type', b'application/json'), (b'x-github-event', b'pull_request'),
+               (b'x-hub-signature-256', signature.encode())]
+
+    async def run():
+        result = await request(app, headers, body)
+        await app.stop()
+        return result
+
+    status, result = asyncio.run(run())
+    assert (status, result['reason']) == (401, 'signature_owner_mismatch')
+    assert fake_github.deleted == []
+
+
+def test_server_applies_backpressure(configuration, fake_github, merged_payload):
+    """
+    Assert that deliveries are answered with "503 Service Unavailable" once the deletion queue is full.
+    """
+    fake_github.latency = 0.1
+    app = server.Server(configuration)
+
+    def merged(ref):
+        body = copy.deepcopy(merged_payload)
+        body['pull_request']['head']['ref'] = ref
+        fake_github.refs.add(('octo/repo', ref))
+        return delivery(body)
+
+    async def run():
+        statuses = []
+        for ref in ('first', 'second', 'third'):
+            status, _ = await request(app, *merged(ref))
+            statuses.append(status)
+            await asyncio.sleep(0.01)
+        await app.stop()
+        return statuses
+
+    assert asyncio.run(run()) == [202, 202, 503]
+    assert sorted(fake_github.deleted) == [('octo/repo', 'first'), ('octo/repo', 'second')]
+
+
+def test_server_coalesces_deletions(configuration, fake_github, merged_payload):
+    """
+    Assert that deletions of the same repository within the batching window are sent as one GraphQL batch.
+    """
+    configuration = configuration._replace(server_queue_size=10, coalesce_window=0.2, deletion_mode='graphql')
+    app = server.Server(configuration)
+
+    def merged(ref):
+        body = copy.deepcopy(merged_payload)
+        body['pull_request']['head']['ref'] = ref
+        fake_github.refs.add(('octo/repo', ref))
+        return delivery(body)
+
+    async def run():
+        statuses = [(await request(app, *merged(ref)))[0] for ref in ('first', 'second', 'third')]
+        await asyncio.sleep(0.5)
+        await app.stop()
+        return statuses
+
+    assert asyncio.run(run()) == [202, 202, 202]
+    assert sorted(fake_github.deleted) == [('octo/repo', 'first'), ('octo/repo', 'second'), ('octo/repo', 'third')]
+    assert [path for method, path in fake_github.requests if method == 'POST'] == ['/graphql', '/graphql']
+
+
+def test_server_deletes_batches_concurrently(configuration, fake_github, merged_payload):
+    """
+    Assert that the branches of a coalesced REST batch are deleted by up to the configured number of workers.
+    """
+    configuration = configuration._replace(server_queue_size=10, coalesce_window=0.2, deletion_max_workers=3)
+    app = server.Server(configuration)
+    fake_github.latency = 0.2
+
+    def merged(ref):
+        body = copy.deepcopy(merged_payload)
+        body['pull_request']['head']['ref'] = ref
+        fake_github.refs.add(('octo/repo', ref))
+        return delivery(body)
+
+    async def run():
+        statuses = [(await request(app, *merged(ref)))[0] for ref in ('first', 'second', 'third')]
+        # Let the dispatcher hand the deletions to one batch before stopping sends it.
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        await app.stop()
+        return statuses, time.monotonic() - started
+
+    statuses, elapsed = asyncio.run(run())
+    assert statuses == [202, 202, 202]
+    assert sorted(fake_github.deleted) == [('octo/repo', 'first'), ('octo/repo', 'second'), ('octo/repo', 'third')]
+    assert elapsed < 0.5
+
+
+def test_server_dry_run(configuration, fake_github, merged_payload):
+    """
+    Assert that accepted deliveries are only recorded in dry run mode, without calling the GitHub API.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    app = server.Server(configuration._replace(dry_run=True))
+
+    async def run():
+        result = await request(app, *delivery(merged_payload))
+        await app.stop()
+        return result
+
+    status, body = asyncio.run(run())
+    assert status == 200
+    assert body['message'] == 'Dry run: would delete "feature" from repository "octo/repo"'
+    assert fake_github.requests == []
+
+
+def test_server_rejects_oversized_payload(configuration, merged_payload):
+    """
+    Assert that the body of a delivery is not read past the maximum payload size.
+    """
+    merged_payload['pull_request']['body'] = 'x' * 128 * 1024
+    app = server.Server(configuration)
+
+    async def run():
+        result = await request(app, *delivery(merged_payload), chunk_size=16 * 1024)
+        await app.stop()
+        return result
+
+    status, body = asyncio.run(run())
+    assert status == 413
+
+
+def test_server_lifespan(configuration):
+    """
+    Assert that the server starts and stops with the ASGI lifespan protocol and refuses deliveries once stopped.
+    """
+    app = server.Server(configuration)
+    messages = [dict(type='lifespan.startup'), dict(type='lifespan.shutdown')]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    async def run():
+        await app(dict(type='lifespan'), receive, send)
+        return await request(app)
+
+    status, body = asyncio.run(run())
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert (status, body['reason']) == (503, 'server_stopping')
+
+
+def test_server_lifespan_drains_queue(configuration, fake_github, merged_payload):
+    """
+    Assert that shutting down with the ASGI lifespan protocol deletes queued branches and leaves no task of the
+    server pending on the event loop, even when the server is started more than once.
+    """
+    fake_github.refs.add(('octo/repo', 'feature'))
+    fake_github.latency = 0.05
+    app = server.Server(configuration._replace(coalesce_window=60))
+    sent = []
+
+    async def run():
+        messages = asyncio.Queue()
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await messages.put(dict(type='lifespan.startup'))
+        lifespan = asyncio.ensure_future(app(dict(type='lifespan'), messages.get, send))
+        while not sent:
+            await asyncio.sleep(0)
+        await app.start()
+        status, _ = await request(app, *delivery(merged_payload))
+        await messages.put(dict(type='lifespan.shutdown'))
+        await lifespan
+        return status, [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    loop = asyncio.new_event_loop()
+    try:
+        status, pending = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert status == 202
+    assert pending == []
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert fake_github.deleted == [('octo/repo', 'feature')]
+    assert app.queue is None
+
+
+def test_server_uses_installation_token(configuration, fake_github, merged_payload, monkeypatch):
+    """
+    Assert that deliveries of a GitHub App installation are processed with the access token of that installation.
+    """
+    monkeypatch.setattr(installations, 'exchange',
+                        lambda app_id, private_key, base_url, installation_id: (
+                            'installation-{}'.format(installation_id), time.time() + 3600))
+    installations.get_tokens.cache_clear()
+    fake_github.refs.add(('octo/repo', 'feature'))
+    merged_payload['installation'] = dict(id=42)
+    app = server.Server(configuration._replace(app_id=1234, app_private_key='key'))
+
+    async def run():
+        status, _ = await request(app, *delivery(merged_payload))
+        await app.stop()
+        return status
+
+    try:
+        assert asyncio.run(run()) == 202
+    finally:
+        installations.get_tokens.cache_clear()
+    assert fake_github.deleted == [('octo/repo', 'feature')]
+    assert set(fake_github.authorizations) == {'token installation-42'}
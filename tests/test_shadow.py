@@ -0,0 +1,81 @@
+"""
+    test/test_shadow
+    ~~~~~~~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/shadow` module.
+"""
+import copy
+import json
+
+import pytest
+
+from chalicelib import jobs, metrics, payload, policy, shadow
+
+
+@pytest.fixture(scope='function')
+def rules():
+    """
+    Fixture that yields a policy with a single rule matching the default configuration.
+    """
+    return policy.Policy.from_filters(policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',)))
+
+
+@pytest.fixture(scope='function')
+def captured(tmpdir, merged_payload):
+    """
+    Fixture that yields a directory of captured payloads: merged, unmerged, opened, excluded and invalid ones.
+    """
+    unmerged = copy.deepcopy(merged_payload)
+    unmerged['pull_request']['merged_at'] = None
+    excluded = copy.deepcopy(merged_payload)
+    excluded['pull_request']['head']['ref'] = 'master'
+    opened = dict(merged_payload, action='opened')
+
+    tmpdir.join('single.json').write(json.dumps(merged_payload))
+    tmpdir.mkdir('2020').join('events.jsonl').write('\n'.join(
+        [json.dumps(merged_payload), json.dumps(unmerged), json.dumps(opened), json.dumps(excluded), 'not json', '']))
+    tmpdir.join('notes.txt').write('not a payload')
+    return tmpdir
+
+
+def test_record_counts_intended_deletion():
+    """
+    Assert that :func:`~lopper.shadow.record` counts the intended deletion in the metrics of the request.
+    """
+    sink = metrics.MemorySink()
+    metrics.Collector(sink)
+    resp = shadow.record(jobs.Job('octo/repo', 'feature', 0))
+    metrics.active().finish(resp.status_code)
+
+    document, = sink.documents
+    assert resp.status_code == 200
+    assert document['IntendedDeletions'] == 1
+    assert (document['IntendedRepository'], document['IntendedRef'], document['IntendedRule']) == (
+        'octo/repo', 'feature', 0)
+    directive, = document['_aws']['CloudWatchMetrics']
+    assert 'IntendedRepository' not in [metric['Name'] for metric in directive['Metrics']]
+
+
+def test_iter_files(captured):
+    """
+    Assert that :func:`~lopper.shadow.iter_files` finds captured payload files in a stable order.
+    """
+    assert [path[len(str(captured)):] for path in shadow.iter_files(str(captured))] == [
+        '/single.json', '/2020/events.jsonl']
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_evaluate_counts_decisions(captured, rules, processes):
+    """
+    Assert that :func:`~lopper.shadow.evaluate` counts the decision of every captured payload, in this process
+    or in worker processes.
+    """
+    decisions, deletions = shadow.evaluate(shadow.iter_files(str(captured)), rules, processes)
+    assert decisions == {
+        payload.PAYLOAD_ACCEPTABLE.reason: 2,
+        payload.NOT_MERGED.reason: 1,
+        payload.NOT_CLOSED.reason: 1,
+        payload.HEAD_BRANCH_EXCLUDED.reason: 1,
+        payload.INVALID_BODY.reason: 1
+    }
+    assert deletions == {'octo/repo': 2}
@@ -0,0 +1,156 @@
+"""
+    test/sweep
+    ~~~~~~~~~~
+
+    Tests for the :mod:`~lopper/sweep` module.
+"""
+import copy
+
+import pytest
+
+from chalicelib import hub, policy, safety, sweep
+
+
+@pytest.fixture(scope='function')
+def rules():
+    """
+    Fixture that yields a policy with a single rule matching the default configuration.
+    """
+    return policy.Policy.from_filters(policy.compile_filters('\\w+', '^master$', '\\w+', '\\w+', ('master',)))
+
+
+@pytest.fixture(scope='function')
+def organization(fake_github, merged_payload, monkeypatch):
+    """
+    Fixture that populates the fake API with an organization of two repositories with closed pull requests.
+    """
+    monkeypatch.setattr(hub, 'PAGE_SIZE', 2)
+    fake_github.repositories['octo'] = [merged_payload['repository'],
+                                        dict(name='archived', full_name='octo/archived', archived=True,
+                                             owner=dict(login='octo'))]
+
+    pulls = []
+    for i in range(5):
+        pull_request = copy.deepcopy(merged_payload['pull_request'])
+        pull_request['head']['ref'] = 'feature-{}'.format(i)
+        pull_request['updated_at'] = '2017-01-0{}T00:00:00Z'.format(5 - i)
+        pulls.append(pull_request)
+    pulls[3]['merged_at'] = None
+    fake_github.pulls['octo/repo'] = pulls
+    fake_github.refs.update(('octo/repo', 'feature-{}'.format(i)) for i in (0, 1, 3, 4))
+    fake_github.refs.add(('octo/repo', 'master'))
+    return fake_github
+
+
+def test_sweep_deletes_existing_merged_heads(organization, rules):
+    """
+    Assert that :func:`~lopper.sweep.sweep` only deletes existing head branches of accepted merged pull requests.
+    """
+    counts = sweep.sweep(['octo'], rules, 'token', organization.base_url)
+
+    assert sorted(organization.deleted) == [('octo/repo', 'feature-0'), ('octo/repo', 'feature-1'),
+                                            ('octo/repo', 'feature-4')]
+    assert counts == dict(repositories=1, pull_requests=5, deleted=3)
+
+
+def test_sweep_deletes_with_graphql(organization, rules):
+    """
+    Assert that :func:`~lopper.sweep.sweep` deletes all branches of a repository with one batched GraphQL deletion.
+    """
+    counts = sweep.sweep(['octo'], rules, 'token', organization.base_url, deletion_mode=hub.GRAPHQL)
+
+    assert counts == dict(repositories=1, pull_requests=5, deleted=3)
+    assert [request for request in organization.requests if request[0] != 'GET'] == [('POST', '/graphql')] * 2
+
+
+def test_sweep_resumes_from_checkpoint(organization, rules, tmpdir):
+    """
+    Assert that :func:`~lopper.sweep.sweep` only examines pull requests updated since the last complete sweep
+    and doesn't list the branches of a repository without new candidates.
+    """
+    path = str(tmpdir.join('checkpoint.json'))
+    sweep.sweep(['octo'], rules, 'token', organization.base_url, sweep.Checkpoint(path))
+    assert sweep.Checkpoint(path).since('octo/repo') == '2017-01-05T00:00:00Z'
+
+    organization.reset()
+    organization.refs.add(('octo/repo', 'feature-2'))
+    counts = sweep.sweep(['octo'], rules, 'token', organization.base_url, sweep.Checkpoint(path))
+
+    assert organization.deleted == []
+    assert counts == dict(repositories=1)
+    assert not [path for _, path in organization.requests if path.startswith('/repos/octo/repo/branches')]
+
+
+def test_sweep_bounds_pending_repositories(rules, monkeypatch):
+    """
+    Assert that :func:`~lopper.sweep.sweep` only lists further repositories once a worker is free.
+    """
+    listed, swept, pending = [], [], []
+
+    def iter_repositories(owners, rules, api_access_token, api_base_url):
+        for i in range(10):
+            listed.append(i)
+            yield dict(full_name='octo/repo-{}'.format(i))
+
+    def sweep_repository(repository, *args):
+        pending.append(len(listed) - len(swept))
+        swept.append(repository['full_name'])
+        return dict(repositories=1)
+
+    monkeypatch.setattr(sweep, 'iter_repositories', iter_repositories)
+    monkeypatch.setattr(sweep, 'sweep_repository', sweep_repository)
+    counts = sweep.sweep(['octo'], rules, 'token', max_workers=2)
+
+    assert counts == dict(repositories=10)
+    assert max(pending) <= 3
+
+
+def test_sweep_keeps_branches_in_use(organization, rules):
+    """
+    Assert that :func:`~lopper.sweep.sweep` keeps protected branches and branches backing an open pull request.
+    """
+    organization.protected.add(('octo/repo', 'feature-4'))
+    open_pull_request = copy.deepcopy(organization.pulls['octo/repo'][0])
+    open_pull_request.update(number=99, state='open', merged_at=None)
+    open_pull_request['head']['ref'], open_pull_request['base']['ref'] = 'feature-2', 'feature-1'
+    organization.pulls['octo/repo'].append(open_pull_request)
+
+    counts = sweep.sweep(['octo'], rules, 'token', organization.base_url)
+
+    assert organization.deleted == [('octo/repo', 'feature-0')]
+    assert counts == dict(repositories=1, pull_requests=5, deleted=1, unsafe=2)
+
+
+def test_sweep_repository_unable_to_load_safety(organization, rules, tmpdir):
+    """
+    Assert that :func:`~lopper.sweep.sweep_repository` deletes nothing and keeps the checkpoint when the
+    protected branches and open pull requests of the repository can't be listed.
+    """
+    def load(api_access_token, repo, base_url):
+        raise hub.github.GithubException(403, dict(message='Resource not accessible by integration'))
+
+    index = safety.SafetyIndex()
+    index.load = load
+    checkpoint = sweep.Checkpoint(str(tmpdir.join('checkpoint.json')))
+
+    counts = sweep.sweep_repository(organization.repositories['octo'][0], rules, 'token', organization.base_url,
+                                    checkpoint, index=index)
+
+    assert organization.deleted == []
+    assert counts == dict(repositories=1, pull_requests=5, failed=1)
+    assert checkpoint.since('octo/repo') is None
+
+
+def test_main_requires_access_token(monkeypatch):
+    """
+    Assert that :func:`~lopper.sweep.main` refuses to sweep with GitHub App installation tokens only.
+    """
+    from chalicelib import conf
+
+    monkeypatch.setattr(conf, 'API_ACCESS_TOKEN', 'token')
+    monkeypatch.setattr(conf, 'WEBHOOK_SECRET_TOKEN', b'secret')
+    configuration = conf.validate()._replace(api_access_token=None, app_id=1234, app_private_key='key')
+    monkeypatch.setattr(conf, 'get', lambda: configuration)
+    with pytest.raises(SystemExit) as e:
+        sweep.main(['--owner', 'octo'])
+    assert e.value.code == 2